@@ -3,7 +3,6 @@ import pandas as pd
 import json
 import openai
 from dotenv import load_dotenv
-import re
 import pickle
 import numpy as np
 import sys
@@ -11,7 +10,9 @@ from multiprocessing import Pool, cpu_count
 
 import sys
 import json
-import re
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from schemas import StructuredOutputError, parse_structured, response_format
 
 NUM_RUN = 3
 MODEL = sys.argv[1]
@@ -42,45 +43,21 @@ df = pd.concat(dfs, ignore_index=True)
 analyses_full = df['analyses_full'].tolist()
 home_dir = "/home/groups/jamesz/salber/scAgent_v2"
 
-def fix_malformed_json(json_str):
-    """Fix common JSON formatting issues"""
-    # Clean basic formatting
-    clean_str = re.sub(r'[\x00-\x1F\x7F]', '', json_str)
-    clean_str = clean_str.replace('```json', '').replace('```python', '').replace('```', '').strip()
-    
-    # Fix the specific issue: missing comma and field name between strings
-    # This pattern looks for: "some text"    "more text" and fixes it
-    pattern = r'(")\s+("(?:None of the ground truth|The closest ground truth).*?")'
-    replacement = r'\1,\n    "comparison": \2'
-    clean_str = re.sub(pattern, replacement, clean_str)
-    
-    return clean_str
+def parse_verdict(response):
+    """Repair and validate a single judge verdict locally"""
+    try:
+        return parse_structured(response, "judge_verdict")
+    except StructuredOutputError as e:
+        print(f"JSON Error: {e}")
+        print(f"Raw string: {response}")
+        return {"error": "Invalid JSON", "text": response}
 
 def parse_response(response):
     try:
         if isinstance(response, str):
-            clean_response = fix_malformed_json(response)
-            try:
-                return json.loads(clean_response)
-            except json.JSONDecodeError as e:
-                print(f"JSON Error: {e}")
-                print(f"Error at position: {e.pos}")
-                print(f"Fixed string: {clean_response}")
-                return {"error": "Invalid JSON", "text": clean_response}
+            return parse_verdict(response)
         elif isinstance(response, list):
-            parsed = []
-            for i, r in enumerate(response):
-                if isinstance(r, str):
-                    try:
-                        clean_r = fix_malformed_json(r)
-                        parsed.append(json.loads(clean_r))
-                    except json.JSONDecodeError as e:
-                        print(f"JSON Error at index {i}: {e}")
-                        print(f"Fixed string: {clean_r}")
-                        parsed.append({"error": "Invalid JSON", "text": clean_r})
-                else:
-                    parsed.append(r)
-            return parsed
+            return [parse_verdict(r) if isinstance(r, str) else r for r in response]
         else:
             return response
     except Exception as e:
@@ -98,7 +75,7 @@ def get_response(prompt, system_prompt, use_json=False):
             response_format={"type": "json_object"}
         )
         result = response.choices[0].message.content
-        return json.loads(result)
+        return parse_structured(result)
     else:
         response = client.chat.completions.create(
             model=MODEL,
@@ -286,7 +263,7 @@ def run_single_iteration(run_index):
                     messages=[
                         {"role": "user", "content": prompt}
                     ],
-                    response_format={"type": "json_object"}
+                    response_format=response_format("judge_verdict", "gpt-4o")
                 )
                 response = response.choices[0].message.content
                 judge_responses.append(response)
@@ -1,27 +1,25 @@
 import pandas as pd
 import os
-import json
 from tqdm import tqdm
 import openai
 
 from dotenv import load_dotenv
 load_dotenv()
 
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from schemas import StructuredOutputError, parse_structured
+
 openai.api_key = os.getenv("OPENAI_API_KEY")
 client = openai.OpenAI()
 
 def parse_response(response):
     try:
         if isinstance(response, str):
-            response = response.replace('```json', '').replace('```', '').strip()
-            parsed = json.loads(response)
+            parsed = parse_structured(response, "judge_verdict")
         elif isinstance(response, list):
-            parsed = []
-            for r in response:
-                r = r.replace('```json', '').replace('```', '').strip()
-                r = json.loads(r)
-                parsed.append(r)
-    except json.JSONDecodeError:
+            parsed = [parse_structured(r, "judge_verdict") for r in response]
+    except StructuredOutputError:
         print(f"Failed to parse response: {response}")
         return response
     return parsed
@@ -1,28 +1,71 @@
-import openai
 import os
 import json
 import nbformat as nbf
-import pandas as pd
-from nbconvert.preprocessors import ExecutePreprocessor
-import numpy as np
 import datetime
 from logger import Logger
 import base64
-import h5py
-from h5py import Dataset, Group
 import re
+import ast
+import hashlib
 import shutil
-from jupyter_client import KernelManager
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from kernel_providers import LocalKernelProvider, place_kernel
 from nbformat.v4 import new_code_cell, new_output
 from deepresearch import DeepResearcher
-from utils import get_documentation
+from utils import get_documentation, cache_path, documentation_index
+from doc_index import KernelDocSource
+from doc_retrieval import DocRetriever
+from notebook_context import NotebookContext
+from usage import UsageTracker, count_tokens, count_message_tokens
+import time
+from prompt_registry import PromptRegistry
+from image_pipeline import ImagePipeline, InterpretationCache
+from streaming import collect_stream
+from schemas import StructuredOutputError, parse_structured, response_format
+from routing import ModelRouter
+from background_context import BRIEF_BUDGET, CONTEXT_BUDGETS, BackgroundCompressor, context_budget
+from fast_fixes import FastFixer
+from fix_memory import FixMemory
+from speculative import KERNEL_HELPER, candidates_expression
+from tracing import NULL_TRACER, Tracer
+from metrics import AgentMetrics
+import kernel_state
+import cpu_budget
 
 AVAILABLE_PACKAGES = "scanpy, scvi, anndata, matplotlib, numpy, seaborn, pandas, scipy"
+
+# Size of the documentation retrieved for fix prompts
+FIX_DOCUMENTATION_TOKENS = 750
+
+# Prompt templates used by the agent: name -> (path relative to prompt_dir, fields filled in per call)
+PROMPT_TEMPLATES = {
+    "coding_guidelines": ("coding_guidelines.txt", ("analyses_overview",)),
+    "coding_guidelines_no_vlm": (os.path.join("ablations", "coding_guidelines_NO_VLM_ABLATION.txt"), ("analyses_overview",)),
+    "coding_system_prompt": ("coding_system_prompt.txt", ()),
+    "static_context": ("static_context.txt", ("CODING_GUIDELINES", "adata_summary", "paper_txt")),
+    "first_draft": ("first_draft.txt", ("past_analyses",)),
+    "next_step": ("next_step.txt", ("hypothesis", "analysis_plan", "num_steps_left", "jupyter_notebook", "past_analyses")),
+    "next_step_seeded": ("next_step_seeded.txt", ("hypothesis", "analysis_plan", "num_steps_left", "jupyter_notebook")),
+    "critic": ("critic.txt", ("hypothesis", "analysis_plan", "first_step_code", "past_analyses", "jupyter_notebook", "documentation")),
+    "critic_no_documentation": (os.path.join("ablations", "critic_NO_DOCUMENTATION.txt"),
+                                ("hypothesis", "analysis_plan", "first_step_code", "past_analyses", "jupyter_notebook")),
+    "incorporate_critique": ("incorporate_critque.txt", ("hypothesis", "analysis_plan", "first_step_code", "feedback", "jupyter_notebook")),
+    "interp_results": ("interp_results.txt", ("hypothesis", "analysis_plan", "code", "text_output", "past_analyses")),
+    "analysis_from_hypothesis": (os.path.join("ablations", "analysis_from_hypothesis.txt"), ("hypothesis",)),
+}
+
 class AnalysisAgent:
     def __init__(self, h5ad_path, paper_summary_path, openai_api_key, model_name, analysis_name, 
                 num_analyses=5, max_iterations=6, prompt_dir="prompts", output_home=".", log_home=".",
                 use_self_critique=True, use_VLM=True, use_documentation=True, log_prompts = False,
-                max_fix_attempts=3, use_deepresearch_background=True):
+                max_fix_attempts=3, use_deepresearch_background=True, notebook_context_tokens=6000,
+                hot_reload_prompts=False, vlm_max_image_side=1024, vlm_max_image_bytes=400_000,
+                stream_responses=False, fast_model_name="gpt-4o-mini", use_fix_memory=True,
+                speculative_fixes=1, speculative_timeout=300, kernel_checkpoints=True,
+                checkpoint_max_bytes=200_000_000, cpu_cores=None, kernel_providers=None,
+                deepresearch_timeout=1800, deepresearch_wait=0, trace=False,
+                metrics_port=None, metrics_textfile=None, metrics_interval=15):
         self.h5ad_path = h5ad_path
         self.paper_summary = open(paper_summary_path).read()
         self.openai_api_key = openai_api_key
@@ -34,17 +77,64 @@ class AnalysisAgent:
         self.log_prompts = log_prompts
         self.max_fix_attempts = max_fix_attempts
         self.use_deepresearch_background = use_deepresearch_background
+        # Seconds before a DeepResearch request is abandoned, and that the first analysis waits for it
+        self.deepresearch_timeout = deepresearch_timeout
+        self.deepresearch_wait = deepresearch_wait
         
         # Create unique output directory based on analysis name and timestamp
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         self.output_dir = os.path.join(output_home, "outputs", f"{analysis_name}_{timestamp}")
+
+        # Phase-level spans (run → analysis → step → phase); a no-op unless tracing is requested
+        self.tracer = Tracer() if trace else NULL_TRACER
+
+        # Live operational metrics (Prometheus text format), served on a local port and/or written to a textfile
+        self.metrics = AgentMetrics(const_labels={"analysis_name": analysis_name})
+        if metrics_port is not None:
+            port = self.metrics.serve(metrics_port)
+            print(f"📈 Serving metrics at http://127.0.0.1:{port}/metrics")
+        if metrics_textfile:
+            self.metrics.start_textfile(metrics_textfile, interval=metrics_interval)
         
+        # The SDK and the scientific stack are imported where first needed, so importing this module stays fast
+        import openai
+
         self.client = openai.OpenAI(api_key=openai_api_key)
+
+        # Token usage and latency of every LLM call, grouped by call type
+        self.usage = UsageTracker()
+
+        # Auxiliary calls (descriptions, fixes, critiques) try a fast model before the main model
+        self.router = ModelRouter(self.model_name, fast_model=fast_model_name)
+
+        # Rule-based fixes for predictable errors, tried before asking the LLM for a fix
+        self.fast_fixer = FastFixer()
+
+        # Successful fixes persist across analyses and runs on the same dataset
+        self.fix_memory = FixMemory(cache_path("fix_memory", f"{self.dataset_id()}.json")) if use_fix_memory else None
+        self._fix_memory_key = None
+
+        # Number of candidate fixes requested per fix round and tested in parallel in forked kernels (1 = sequential)
+        self.speculative_fixes = max(1, speculative_fixes)
+        self.speculative_timeout = speculative_timeout
+
+        # Checkpoint the kernel namespace before each step and roll back to it before each fix attempt
+        self.kernel_checkpoints = kernel_checkpoints
+        self.checkpoint_max_bytes = checkpoint_max_bytes
+
+        # Stream LLM responses so work on a response can start before it completes
+        self.stream_responses = stream_responses
+        self._background = ThreadPoolExecutor(max_workers=2)
+        self._documentation_futures = {}  # first_step_code -> future of its documentation
         
         # Initialize code memory to track the last few cells of code
         self.code_memory = []
         self.code_memory_size = 5  # Number of code cells to remember
 
+        # Token-budgeted notebook digest shared by all prompts within a step
+        self.notebook_context = NotebookContext(token_budget=notebook_context_tokens,
+                                                count_tokens=lambda text: count_tokens(text, self.model_name))
+
         # Create output directory if it doesn't exist
         os.makedirs(self.output_dir, exist_ok=True)
 
@@ -52,62 +142,287 @@ class AnalysisAgent:
         self.use_self_critique = use_self_critique
         self.use_VLM = use_VLM
         self.use_documentation = use_documentation
+        self.doc_retriever = None
+        if use_documentation:
+            # Docstrings come from this agent's analysis kernel, so they match the package versions the code runs against
+            self.doc_retriever = DocRetriever(documentation_index(
+                KernelDocSource(self._kernel_json, lambda: self.kernel_client is not None)))
 
-        # Coding guidelines: guide agent on how to write code and conduct analyses
+        # Figures sent to the VLM are deduped and downscaled; interpretations are reused for near-identical results
+        self.image_pipeline = ImagePipeline(max_side=vlm_max_image_side, max_bytes=vlm_max_image_bytes)
+        self.interpretation_cache = InterpretationCache()
+
+        # Load, validate and pre-render all prompt templates once
         self._analyses_overview = open(os.path.join(self.prompt_dir, "DeepResearch_Analyses.txt")).read()
-        if self.use_VLM:
-            self.coding_guidelines_template = open(os.path.join(self.prompt_dir, "coding_guidelines.txt")).read()
-        else:
-            self.coding_guidelines_template = open(os.path.join(self.prompt_dir, "ablations", "coding_guidelines_NO_VLM_ABLATION.txt")).read()
+        self.prompts = PromptRegistry(self.prompt_dir, PROMPT_TEMPLATES, static_values={
+            "max_iterations": self.max_iterations,
+            "adata_path": self.h5ad_path,
+            "available_packages": AVAILABLE_PACKAGES,
+        }, hot_reload=hot_reload_prompts)
+
+        # Coding guidelines: guide agent on how to write code and conduct analyses
+        self.coding_guidelines_template = "coding_guidelines" if self.use_VLM else "coding_guidelines_no_vlm"
+
+        # Background sources are distilled once per run to the token budget of each call type
+        self.background = BackgroundCompressor(self._distill_background,
+                                               count_tokens=lambda text: count_tokens(text, self.model_name),
+                                               path=os.path.join(self.output_dir, "background_context.json"))
+        self._static_contexts = {}  # token budget -> static context
 
         # System prompt for coding agents
-        self.coding_system_prompt = open(os.path.join(self.prompt_dir, "coding_system_prompt.txt")).read().format(max_iterations=self.max_iterations)
-
-        # Finalize coding guidelines with the (possibly augmented) overview
-        self.coding_guidelines = self.coding_guidelines_template.format(
-            name=self.analysis_name,
-            adata_path=self.h5ad_path,
-            available_packages=AVAILABLE_PACKAGES,
-            analyses_overview=self._analyses_overview,
-        )
+        self.coding_system_prompt = self.prompts.render("coding_system_prompt")
 
         # Initialize logger: keeps track of all actions, prompts, responses, errors, etc.
         self.logger = Logger(self.analysis_name, log_dir=os.path.join(log_home, "logs"))
-        # Initialize notebook executor
-        self.executor = ExecutePreprocessor(timeout=600, kernel_name='python3')
         
         # Initialize persistent kernel for efficient cell execution
         self.kernel_manager = None
         self.kernel_client = None
+        # Background documentation lookups share the kernel client with cell execution
+        self._kernel_lock = threading.RLock()
+        # Where kernels run: local by default, or attached remote kernels chosen by free memory
+        self.kernel_providers = kernel_providers or [LocalKernelProvider()]
+
+        # Kernels on this machine share a CPU budget; each is pinned to its share of the cores
+        self.cpu_budget = cpu_budget.CPUBudget(cache_path("cpu_budget.json"), cores=cpu_cores)
+        self._cpu_token = None
 
         # Load the .obs data from the anndata file
         if self.h5ad_path == "": # JUST FOR BENCHMARKING
             self.adata_summary = ""
         else:
             print("Loading anndata .obs for summarization...")
-            self.adata_obs = self.load_h5ad_obs(self.h5ad_path)
-            self.adata_summary = self.summarize_adata_metadata()
+            with self.tracer.span("load_obs", "setup"):
+                self.adata_obs = self.load_h5ad_obs(self.h5ad_path)
+                self.adata_summary = self.summarize_adata_metadata()
             print("ADATA SUMMARY: ", self.adata_summary)
             print(f"✅ Loaded {self.h5ad_path}")
 
+        # DeepResearch background for idea generation: reused from the disk cache, or researched in a
+        # background thread while analyses start without it
+        self.deepresearch_background = ""
+        self._deepresearch_future = None
         if self.use_deepresearch_background:
-            # DeepResearch for idea generation
-            print("Running DeepResearch...")
-            try:
-                deepresearch = DeepResearcher(self.openai_api_key)
+            self.start_deepresearch()
+
+        
+
+
+    def start_deepresearch(self):
+        """Use a cached DeepResearch background, or start researching it in a daemon thread"""
+        deepresearch = DeepResearcher(self.openai_api_key, usage_tracker=self.usage,
+                                      cache_dir=cache_path("deepresearch"), timeout=self.deepresearch_timeout)
+        # Provide both the paper summary and dataset metadata so deep research can tailor background
+        cached = deepresearch.cached_research(self.paper_summary, self.adata_summary, AVAILABLE_PACKAGES)
+        self.metrics.record_cache("deepresearch", cached is not None)
+        if cached is not None:
+            self.deepresearch_background = cached.strip()
+            print("✅ DeepResearch background loaded from cache")
+            return
 
-                # Always initialize background string so attribute exists even if DeepResearch fails
-                self.deepresearch_background = ""
+        print("Running DeepResearch in the background...")
+        future = Future()
 
-                # Provide both the paper summary and dataset metadata so deep research can tailor background
-                dr_summary = deepresearch.research_from_paper_summary(self.paper_summary, self.adata_summary, AVAILABLE_PACKAGES)
-                self.deepresearch_background = dr_summary.strip()
-                print("✅ DeepResearch completed")
-                print("DEEPRESEARCH BACKGROUND: ", self.deepresearch_background[:100])
+        def research():
+            try:
+                future.set_result(deepresearch.research_from_paper_summary(
+                    self.paper_summary, self.adata_summary, AVAILABLE_PACKAGES))
             except Exception as e:
-                print(f"Warning: DeepResearch failed or was skipped: {e}")
-        
+                future.set_exception(e)
+
+        # A daemon thread, so an unfinished request does not keep the process alive after the run
+        threading.Thread(target=research, name="deepresearch", daemon=True).start()
+        self._deepresearch_future = future
+
+    def refresh_deepresearch_background(self, wait=0):
+        """
+        Adopt the DeepResearch background once it is ready, rebuilding the static context
+
+        Args:
+            wait (float): Seconds to wait for a background still being researched
+        """
+        future = self._deepresearch_future
+        if future is None:
+            return
+        try:
+            background = future.result(timeout=wait)
+        except FutureTimeoutError:
+            print("⏳ DeepResearch background not ready yet; continuing without it")
+            return
+        except Exception as e:
+            background = ""
+            print(f"Warning: DeepResearch failed or was skipped: {e}")
+        self._deepresearch_future = None
+        self.deepresearch_background = (background or "").strip()
+        if self.deepresearch_background:
+            print("✅ DeepResearch completed")
+            print("DEEPRESEARCH BACKGROUND: ", self.deepresearch_background[:100])
+            self._static_contexts.clear()
+            self._background.submit(self.background.prepare, {"deepresearch": self.deepresearch_background},
+                                    CONTEXT_BUDGETS.values())
+        else:
+            print("Warning: DeepResearch returned no background")
+
+    def build_static_context(self, budget=None):
+        """
+        Assemble the static context (coding guidelines, anndata summary, paper summary and
+        DeepResearch background) that opens every analysis prompt. Keeping it identical across
+        calls lets the provider reuse its cached prefix.
+
+        Args:
+            budget (int): Tokens allowed for each of the analyses overview, paper summary and
+                DeepResearch background, which are distilled to fit (None keeps them verbatim)
+        """
+        analyses_overview = self.background.compress("analyses_overview", self._analyses_overview, budget)
+        coding_guidelines = self.prompts.render(self.coding_guidelines_template, analyses_overview=analyses_overview)
+        paper_summary = self.background.compress("paper_summary", self.paper_summary, budget)
+        static_context = self.prompts.render("static_context", CODING_GUIDELINES=coding_guidelines,
+                                             adata_summary=self.adata_summary, paper_txt=paper_summary)
+        if self.use_deepresearch_background and getattr(self, "deepresearch_background", ""):
+            deepresearch_background = self.background.compress("deepresearch", self.deepresearch_background, budget)
+            static_context += f"\nHere is a summary of relevant biological information for finding a novel idea:\n{deepresearch_background}\n"
+        return static_context
+
+    def static_context_for(self, call_type):
+        """Static context at the background budget of `call_type`; one shared prefix per budget"""
+        budget = context_budget(call_type)
+        if budget not in self._static_contexts:
+            self._static_contexts[budget] = self.build_static_context(budget)
+        return self._static_contexts[budget]
+
+    def background_brief(self):
+        """Digest of the paper summary for calls that get no static context (fixes, code descriptions)"""
+        return self.background.compress("paper_summary", self.paper_summary, BRIEF_BUDGET)
+
+    def prepare_background_contexts(self):
+        """Distill the background sources for every call type up front, so later calls find them cached"""
+        sources = {"analyses_overview": self._analyses_overview, "paper_summary": self.paper_summary}
+        if self.use_deepresearch_background and self.deepresearch_background:
+            sources["deepresearch"] = self.deepresearch_background
+        self.background.prepare(sources, CONTEXT_BUDGETS.values())
+        self.background_brief()
+
+    def _distill_background(self, text, budget, name):
+        """Ask the LLM (fast model first) to distill a background source to about `budget` tokens"""
+        labels = {"paper_summary": "research paper summary", "analyses_overview": "overview of single-cell analyses",
+                  "deepresearch": "biological background"}
+        prompt = (f"Distill the following {labels.get(name, 'background')} to at most {budget} tokens "
+                  f"(about {budget * 3 // 4} words) for a single-cell analysis agent. Keep the concrete facts: "
+                  "disease or condition, samples and cohorts, cell types, genes, methods and their key "
+                  "parameters, and findings. Drop motivation, citations and repetition. Return only the "
+                  f"distilled text.\n\n{text}")
+        return self.router.call("compress", lambda model: (self._chat("compress",
+            model=model,
+            messages=[
+                {"role": "system", "content": "You condense background material without losing specifics."},
+                {"role": "user", "content": prompt}
+            ]
+        ).choices[0].message.content or "").strip())
 
+    def _messages(self, call_type, system_prompt, user_content):
+        """Build chat messages that start with the call type's static context, followed by the per-call content"""
+        return [
+            {"role": "system", "content": self.static_context_for(call_type)},
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+
+    def _chat(self, call_type, model, messages, on_field=None, stream=None, **kwargs):
+        """
+        Send a chat completion request, recording prompt size, API usage and latency
+
+        Args:
+            call_type (str): Kind of call used to group usage statistics (e.g. "next_step", "fix")
+            model (str): Model to query
+            messages (list): Chat messages
+            on_field (callable): When streaming a JSON response, called with (key, value) as each top-level field closes
+            stream (bool): Override stream_responses for this call (e.g. for multi-choice requests)
+            **kwargs: Passed through to the chat completions API
+        """
+        span = self.tracer.begin(f"llm:{call_type}", "llm", model=model)
+        prompt_tokens = count_message_tokens(messages, model)
+        start = time.perf_counter()
+        try:
+            if self.stream_responses if stream is None else stream:
+                stream = self.client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                             stream_options={"include_usage": True}, **kwargs)
+                is_json = kwargs.get("response_format", {}).get("type") in ("json_object", "json_schema")
+                response = collect_stream(stream, parse_json=is_json, on_field=on_field, label=call_type)
+            else:
+                response = self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+        except Exception as e:
+            self.usage.record(call_type, prompt_tokens, time.perf_counter() - start)
+            self.metrics.record_llm_call(call_type, model, time.perf_counter() - start, prompt_tokens, error=True)
+            self.logger.log_event("llm_call", call_type=call_type, model=model, prompt_tokens=prompt_tokens,
+                                  duration_s=round(time.perf_counter() - start, 3), error=f"{type(e).__name__}: {e}")
+            self.tracer.end(span)
+            raise
+        usage = getattr(response, "usage", None)
+        self.usage.record(call_type, prompt_tokens, time.perf_counter() - start, usage)
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.metrics.record_llm_call(call_type, model, time.perf_counter() - start,
+                                     getattr(usage, "prompt_tokens", None) or prompt_tokens,
+                                     getattr(usage, "completion_tokens", None), getattr(details, "cached_tokens", None))
+        logged = {}
+        if self.log_prompts:
+            # Full prompts and responses go to the content-addressed blob store; the event references them
+            logged["messages"] = self.logger.message_refs(messages)
+            logged["response"] = self.logger.blobs.put_text("\n\n".join(
+                choice.message.content or "" for choice in getattr(response, "choices", None) or []))
+        self.logger.log_event("llm_call", call_type=call_type, model=model,
+                              prompt_tokens=getattr(usage, "prompt_tokens", None) or prompt_tokens,
+                              completion_tokens=getattr(usage, "completion_tokens", None),
+                              cached_tokens=getattr(details, "cached_tokens", None),
+                              duration_s=round(time.perf_counter() - start, 3), **logged)
+        self.tracer.end(span)
+        return response
+
+    def _on_analysis_field(self, key, value, prefetch_documentation=False):
+        """
+        Start work on a streamed analysis as soon as its first step code is complete
+
+        Args:
+            prefetch_documentation (bool): Also start the documentation lookup that the critique of this code uses
+        """
+        if key != "first_step_code" or not isinstance(value, str):
+            return
+
+        # Pre-flight syntax check so problems show up while the rest of the response streams in
+        try:
+            ast.parse(strip_code_markers(value))
+        except SyntaxError as e:
+            print(f"⚠️ Pre-flight check: first step code has a syntax error (line {e.lineno}): {e.msg}")
+
+        if prefetch_documentation and self.use_documentation and value not in self._documentation_futures:
+            self._documentation_futures[value] = self._background.submit(get_documentation, value,
+                                                                          retriever=self.doc_retriever)
+
+    def _on_critiqued_analysis_field(self, key, value):
+        """on_field callback for analyses that are critiqued next (initial analyses and next steps)"""
+        self._on_analysis_field(key, value, prefetch_documentation=self.use_self_critique)
+
+    def _get_documentation(self, code, error="", token_budget=None):
+        """
+        Documentation for `code` (ranked against `error` if given), reusing a lookup prefetched while
+        the response was streaming
+        """
+        with self.tracer.span("documentation"):
+            if error:
+                return get_documentation(code, error=error, token_budget=token_budget, retriever=self.doc_retriever)
+            future = self._documentation_futures.pop(code, None)
+            if self.use_documentation:
+                self.metrics.record_cache("documentation_prefetch", future is not None)
+            if future is not None:
+                return future.result()
+            return get_documentation(code, token_budget=token_budget, retriever=self.doc_retriever)
+
+    def dataset_id(self):
+        """Stable identifier of the analyzed dataset, used to scope persistent caches"""
+        if not self.h5ad_path:
+            return "default"
+        name = os.path.splitext(os.path.basename(self.h5ad_path))[0]
+        digest = hashlib.sha1(os.path.abspath(self.h5ad_path).encode("utf-8")).hexdigest()[:8]
+        return f"{name}_{digest}"
 
     def summarize_adata_metadata(self, length_cutoff=25):
         """
@@ -128,19 +443,21 @@ class AnalysisAgent:
         return summarization_str
 
     def generate_jupyter_summary(self, notebook_cells):
-        """Generate a comprehensive summary of notebook code cells, markdown, and errors"""
-        if notebook_cells is None:
-            return ""
-            
-        jupyter_summary = ""
-        for cell in notebook_cells:
-            if cell['cell_type'] == 'code' or cell['cell_type'] == 'markdown' or cell['cell_type'] == 'error':
-                jupyter_summary += f"{cell['source']}\n"
-        
-        return jupyter_summary
+        """Generate a token-budgeted digest of notebook code cells, markdown, and errors
+
+        Recent cells are included verbatim and older cells as cached summaries. The digest is
+        memoized on the notebook state, so the next-step, critique and incorporate prompts of
+        a step share a single computation.
+        """
+        return self.notebook_context.digest(notebook_cells)
 
     def load_h5ad_obs(self, h5ad_path):
         """Load just the .obs data from an h5ad file while preserving data types"""
+        import h5py
+        import numpy as np
+        import pandas as pd
+        from h5py import Dataset, Group
+
         with h5py.File(h5ad_path, 'r') as f:
             obs_dict = {}
             
@@ -215,21 +532,16 @@ class AnalysisAgent:
         return df
 
     def generate_initial_analysis(self, attempted_analyses):
-        prompt = open(os.path.join(self.prompt_dir, "first_draft.txt")).read()
-        prompt = prompt.format(CODING_GUIDELINES=self.coding_guidelines, adata_summary=self.adata_summary, 
-                               past_analyses=attempted_analyses, paper_txt=self.paper_summary,
-                               deepresearch_background=self.deepresearch_background if self.use_deepresearch_background else "")
+        prompt = self.prompts.render("first_draft", past_analyses=attempted_analyses)
 
         if self.log_prompts:
             self.logger.log_prompt("user", prompt, "Initial Analysis")
         
-        response = self.client.chat.completions.create(
+        response = self._chat("initial",
             model=self.model_name,
-            messages=[
-                {"role": "system", "content": self.coding_system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+            messages=self._messages("initial", self.coding_system_prompt, prompt),
+            response_format=response_format("analysis_plan", self.model_name),
+            on_field=self._on_critiqued_analysis_field
         )
         result = response.choices[0].message.content
         
@@ -246,9 +558,9 @@ class AnalysisAgent:
                 raise ValueError("OpenAI API returned None response for initial analysis")
         
         try:
-            analysis = json.loads(result)
-        except json.JSONDecodeError as e:
-            print(f"⚠️ JSON decode error in generate_initial_analysis: {e}")
+            analysis = parse_structured(result, "analysis_plan")
+        except StructuredOutputError as e:
+            print(f"⚠️ Could not repair response in generate_initial_analysis: {e}")
             print(f"   Raw result: {repr(result)}")
             raise
         
@@ -265,7 +577,7 @@ class AnalysisAgent:
         # Keep only the most recent cells up to code_memory_size
         self.code_memory = code_cells[-self.code_memory_size:] if len(code_cells) > 0 else []
         
-    def generate_next_step_analysis(self, analysis, attempted_analyses, notebook_cells, results_interpretation, num_steps_left):
+    def generate_next_step_analysis(self, analysis, attempted_analyses, notebook_cells, results_interpretation, num_steps_left, seeded=False):
         hypothesis = analysis["hypothesis"]
         analysis_plan = analysis["analysis_plan"]
         first_step_code = analysis["first_step_code"]
@@ -279,26 +591,19 @@ class AnalysisAgent:
         recent_code = "\n\n# Next Cell\n".join(reversed(self.code_memory))
 
         if seeded:
-            prompt = open(os.path.join(self.prompt_dir, "next_step_seeded.txt")).read()
-            prompt = prompt.format(hypothesis=hypothesis, analysis_plan = analysis_plan, num_steps_left=num_steps_left,
-                                 CODING_GUIDELINES=self.coding_guidelines, jupyter_notebook=jupyter_summary,
-                                 jupyter_notebook=jupyter_summary, adata_summary=self.adata_summary, past_analyses=attempted_analyses,
-                                 paper_txt=self.paper_summary)
+            prompt = self.prompts.render("next_step_seeded", hypothesis=hypothesis, analysis_plan = analysis_plan, num_steps_left=num_steps_left,
+                                 jupyter_notebook=jupyter_summary)
         else:
-            prompt = open(os.path.join(self.prompt_dir, "next_step.txt")).read()
-            prompt = prompt.format(hypothesis=hypothesis, analysis_plan=analysis_plan,
-                                CODING_GUIDELINES=self.coding_guidelines, jupyter_notebook=jupyter_summary,
-                                adata_summary=self.adata_summary, past_analyses=attempted_analyses,
-                                paper_txt=self.paper_summary, num_steps_left=num_steps_left)
+            prompt = self.prompts.render("next_step", hypothesis=hypothesis, analysis_plan=analysis_plan,
+                                jupyter_notebook=jupyter_summary, past_analyses=attempted_analyses,
+                                num_steps_left=num_steps_left)
         
         
-        response = self.client.chat.completions.create(
+        response = self._chat("next_step",
             model=self.model_name,
-            messages=[
-                {"role": "system", "content": self.coding_system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+            messages=self._messages("next_step", self.coding_system_prompt, prompt),
+            response_format=response_format("next_step", self.model_name),
+            on_field=self._on_critiqued_analysis_field
         )
         result = response.choices[0].message.content
 
@@ -315,9 +620,9 @@ class AnalysisAgent:
                 raise ValueError("OpenAI API returned None response for next step")
         
         try:
-            analysis = json.loads(result)
-        except json.JSONDecodeError as e:
-            print(f"⚠️ JSON decode error in generate_next_step: {e}")
+            analysis = parse_structured(result, "next_step")
+        except StructuredOutputError as e:
+            print(f"⚠️ Could not repair response in generate_next_step: {e}")
             print(f"   Raw result: {repr(result)}")
             raise
         
@@ -340,30 +645,23 @@ class AnalysisAgent:
             recent_code = "\n\n# Next Cell\n".join(reversed(self.code_memory))
 
         if self.use_documentation:
-            prompt = open(os.path.join(self.prompt_dir, "critic.txt")).read()
             # Get relevant documentation on the single-cell packages being used in the first step code
             try:
-                documentation = get_documentation(first_step_code)
+                documentation = self._get_documentation(first_step_code)
             except Exception as e:
                 print(f"⚠️ Documentation extraction failed: {e}")
                 documentation = ""
-            prompt = prompt.format(hypothesis=hypothesis, analysis_plan=analysis_plan, first_step_code=first_step_code,
-                                CODING_GUIDELINES=self.coding_guidelines, adata_summary=self.adata_summary, past_analyses=past_analyses,
-                                paper_txt=self.paper_summary, jupyter_notebook=jupyter_summary, documentation=documentation)
+            prompt = self.prompts.render("critic", hypothesis=hypothesis, analysis_plan=analysis_plan, first_step_code=first_step_code,
+                                past_analyses=past_analyses, jupyter_notebook=jupyter_summary, documentation=documentation)
         else:
-            prompt = open(os.path.join(self.prompt_dir, "ablations", "critic_NO_DOCUMENTATION.txt")).read()
-            prompt = prompt.format(hypothesis=hypothesis, analysis_plan=analysis_plan, first_step_code=first_step_code,
-                                CODING_GUIDELINES=self.coding_guidelines, adata_summary=self.adata_summary, past_analyses=past_analyses,
-                                paper_txt=self.paper_summary, jupyter_notebook=jupyter_summary)
-
-        response = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=[
-                {"role": "system", "content": "You are a single-cell bioinformatics expert providing feedback on code and analysis plan."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        feedback = response.choices[0].message.content
+            prompt = self.prompts.render("critic_no_documentation", hypothesis=hypothesis, analysis_plan=analysis_plan, first_step_code=first_step_code,
+                                past_analyses=past_analyses, jupyter_notebook=jupyter_summary)
+
+        # Try the fast model first; escalate to the main model if the call fails or returns nothing
+        feedback = self.router.call("critique", lambda model: self._chat("critique",
+            model=model,
+            messages=self._messages("critique", "You are a single-cell bioinformatics expert providing feedback on code and analysis plan.", prompt)
+        ).choices[0].message.content)
         return feedback
 
     def incorporate_critique(self, analysis, feedback, notebook_cells):
@@ -381,18 +679,14 @@ class AnalysisAgent:
         #recent_code = "\n\n# Next Cell\n".join(reversed(self.code_memory))
         jupyter_summary = self.generate_jupyter_summary(notebook_cells)
 
-        prompt = open(os.path.join(self.prompt_dir, "incorporate_critque.txt")).read()
-        prompt = prompt.format(hypothesis=hypothesis, analysis_plan=analysis_plan, first_step_code=first_step_code,
-                               CODING_GUIDELINES=self.coding_guidelines, adata_summary=self.adata_summary,
+        prompt = self.prompts.render("incorporate_critique", hypothesis=hypothesis, analysis_plan=analysis_plan, first_step_code=first_step_code,
                                feedback=feedback, jupyter_notebook=jupyter_summary)
         
-        response = self.client.chat.completions.create(
+        response = self._chat("incorporate",
             model=self.model_name,
-            messages=[
-                {"role": "system", "content": self.coding_system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+            messages=self._messages("incorporate", self.coding_system_prompt, prompt),
+            response_format=response_format("analysis_plan", self.model_name),
+            on_field=self._on_analysis_field
         )
         result = response.choices[0].message.content
         
@@ -409,9 +703,9 @@ class AnalysisAgent:
                 raise ValueError("OpenAI API returned None response for critique incorporation")
         
         try:
-            modified_analysis = json.loads(result)
-        except json.JSONDecodeError as e:
-            print(f"⚠️ JSON decode error in incorporate_critique: {e}")
+            modified_analysis = parse_structured(result, "analysis_plan")
+        except StructuredOutputError as e:
+            print(f"⚠️ Could not repair response in incorporate_critique: {e}")
             print(f"   Raw result: {repr(result)}")
             raise
 
@@ -420,14 +714,34 @@ class AnalysisAgent:
 
         return modified_analysis
     
-    def fix_code(self, code, error, other_code="", documentation=""):
-        """Attempts to fix code that produced an error"""
+    def fix_code(self, code, error, other_code="", documentation="", model=None):
+        """Attempts to fix code that produced an error (with `model`, defaulting to the main model)"""
+        response = self._chat("fix", model=model or self.model_name,
+                              messages=self._fix_messages(code, error, other_code, documentation))
+        fixed_code = response.choices[0].message.content
+        
+        return fixed_code
+
+    def fix_code_candidates(self, code, error, n, other_code="", documentation="", model=None):
+        """Request `n` alternative fixes in a single call; returns the distinct candidate codes"""
+        response = self._chat("fix", model=model or self.model_name,
+                              messages=self._fix_messages(code, error, other_code, documentation),
+                              n=n, stream=False)
+        candidates = []
+        for choice in response.choices:
+            candidate = strip_code_markers(choice.message.content or "")
+            if candidate.strip() and candidate not in candidates:
+                candidates.append(candidate)
+        return candidates or [code]
+
+    def _fix_messages(self, code, error, other_code="", documentation=""):
+        """Chat messages asking for a fix of code that produced an error"""
         
         # Manage context length for fix_code to prevent token limit errors
         max_error_chars = 2000          # ~500 tokens
         max_other_code_chars = 3000     # ~750 tokens  
         max_past_context_chars = 4000   # ~1000 tokens
-        max_documentation_chars = 3000  # ~750 tokens
+        max_documentation_chars = FIX_DOCUMENTATION_TOKENS * 4
         
         # Truncate error message (keep end as it's usually most relevant)
         truncated_error = error[-max_error_chars:] if len(error) > max_error_chars else error
@@ -482,20 +796,14 @@ class AnalysisAgent:
         {truncated_documentation}"""
         
         # Check prompt length before sending
-        estimated_tokens = len(prompt) // 4  # Rough estimation
-        if estimated_tokens > 50000:  # Conservative limit for fix_code
-            print(f"⚠️ Warning: Large fix_code prompt detected ({estimated_tokens} estimated tokens)")
-        
-        response = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=[
-                {"role": "system", "content": "You are a coding assistant helping to fix code."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        fixed_code = response.choices[0].message.content
+        prompt_tokens = count_tokens(prompt, self.model_name)
+        if prompt_tokens > 50000:  # Conservative limit for fix_code
+            print(f"⚠️ Warning: Large fix_code prompt detected ({prompt_tokens} tokens)")
         
-        return fixed_code
+        return [
+            {"role": "system", "content": f"You are a coding assistant helping to fix code.\n\nStudy context: {self.background_brief()}"},
+            {"role": "user", "content": prompt}
+        ]
 
     def generate_code_description(self, code, context=""):
         """Generate a description for a code cell based on its content"""
@@ -507,15 +815,16 @@ class AnalysisAgent:
         ```
         """
         
-        response = self.client.chat.completions.create(
-            model=self.model_name,
+        description = self.router.call("description", lambda model: (self._chat("description",
+            model=model,
             messages=[
-                {"role": "system", "content": "You are a single-cell bioinformatics expert providing concise code descriptions."},
+                {"role": "system", "content": "You are a single-cell bioinformatics expert providing concise code descriptions.\n\n"
+                                              f"Study context: {self.background_brief()}"},
                 {"role": "user", "content": prompt}
             ]
-        )
+        ).choices[0].message.content or "").strip())
         
-        return response.choices[0].message.content.strip()
+        return description
 
     def interpret_results(self, notebook, past_analyses, hypothesis, analysis_plan, code):
         # Get the last cell
@@ -566,67 +875,61 @@ class AnalysisAgent:
 
             if not text_output and not image_outputs: # no output found
                 return no_interpretation
+
+            # Drop repeated figures and downscale/recompress them to the upload budget
+            prepared_images = self.image_pipeline.prepare([img['data'] for img in image_outputs])
+            image_outputs.clear()
         else:
             if not text_output:
                 return no_interpretation
+            prepared_images = []
+
+        # Fix retries often reproduce the same figures and text; reuse their interpretation
+        cache_key = self.interpretation_cache.key([img['digest'] for img in prepared_images], text_output)
+        cached_interpretation = self.interpretation_cache.get(cache_key)
+        self.metrics.record_cache("interpretation", cached_interpretation is not None)
+        if cached_interpretation is not None:
+            print("♻️ Reusing cached interpretation for identical results")
+            return cached_interpretation
         
-        prompt = open(os.path.join(self.prompt_dir, "interp_results.txt")).read()
-        prompt = prompt.format(text_output=text_output, paper_txt=self.paper_summary,
-                               CODING_GUIDELINES=self.coding_guidelines, past_analyses=past_analyses,
+        prompt = self.prompts.render("interp_results", text_output=text_output, past_analyses=past_analyses,
                                hypothesis=hypothesis, analysis_plan=analysis_plan, code=code)
 
         if self.use_VLM:
             user_content = []
             user_content.append({"type": "text", "text": prompt})
             try:
-                for img in image_outputs:
-                    try:
-                        # Get the image data 
-                        image_data = img['data']
-                        
-                        # Remove the base64 prefix if present
-                        if isinstance(image_data, str) and "," in image_data:
-                            image_data = image_data.split(",")[1]
-                        
-                        # Add the image to the content
-                        user_content.append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{image_data}"
-                            }
-                        })
-                    except Exception as e:
-                        print(f"Warning: Error processing image: {str(e)}")
-                        continue  # Skip this image and continue with others
+                for img in prepared_images:
+                    user_content.append({
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{img['mime']};base64,{img['data']}"
+                        }
+                    })
                         
-                response = self.client.chat.completions.create(
+                response = self._chat("interpret",
                     model = "gpt-4o",
-                    messages = [
-                        {"role": "system", "content": "You are a single-cell transcriptomics expert providing feedback on Python code and analysis plan."},
-                        {"role": "user", "content": user_content}
-                    ]
+                    messages = self._messages("interpret", "You are a single-cell transcriptomics expert providing feedback on Python code and analysis plan.", user_content)
                 )
                 feedback = response.choices[0].message.content
                 if self.log_prompts:
                     self.logger.log_prompt("user", text_output, "Results Interpretation")
             finally:
                 # Clean up image data to prevent memory leaks
-                image_outputs.clear()
+                prepared_images.clear()
                 user_content.clear()
                 import gc
                 gc.collect()
         else:
-            response = self.client.chat.completions.create(
+            response = self._chat("interpret",
                 model = self.model_name,
-                messages = [
-                    {"role": "system", "content": "You are a single-cell bioinformatics expert providing feedback on Python code and analysis plan."},
-                    {"role": "user", "content": prompt}
-                ]
+                messages = self._messages("interpret", "You are a single-cell bioinformatics expert providing feedback on Python code and analysis plan.", prompt)
             )
             feedback = response.choices[0].message.content
             if self.log_prompts:
                 self.logger.log_prompt("user", text_output, "Results Interpretation")
-            
+
+        self.interpretation_cache.put(cache_key, feedback)
         return feedback
     
     def get_feedback(self, analysis, past_analyses, notebook_cells, iterations=1):
@@ -659,24 +962,59 @@ class AnalysisAgent:
             self.stop_persistent_kernel()
         except Exception as e:
             print(f"⚠️ Warning: Error during cleanup: {e}")
+        self._documentation_futures.clear()
+        self._background.shutdown(wait=False)
+        self.metrics.close()
+        self.logger.close()
 
     def start_persistent_kernel(self):
         """Start a persistent kernel for efficient cell execution"""
+        with self.tracer.span("kernel_start", "kernel"):
+            return self._start_persistent_kernel()
+
+    def _start_persistent_kernel(self):
         try:
-            # Create kernel manager
-            self.kernel_manager = KernelManager(kernel_name='python3')
-            self.kernel_manager.start_kernel()
+            # Place the kernel on the provider (host) with the most free memory
+            provider = place_kernel(self.kernel_providers)
+
+            env, cores = None, None
+            if provider.is_local:
+                # Reserve a share of the CPU budget and cap native thread pools to it
+                self._cpu_token, cores = self.cpu_budget.reserve()
+                env = dict(os.environ, **self.cpu_budget.thread_env(len(cores)))
+
+            # Start the kernel and its client
+            self.kernel_manager, self.kernel_client = provider.start(env=env)
+            kernel_process = self._kernel_process()
+            if self._cpu_token is not None and kernel_process is not None:
+                cores = self.cpu_budget.register(self._cpu_token, kernel_process.pid)
             
-            # Create kernel client
-            self.kernel_client = self.kernel_manager.client()
-            self.kernel_client.start_channels()
-            self.kernel_client.wait_for_ready()
-            
-            print("✅ Persistent kernel started")
+            print(f"✅ Persistent kernel started on {provider.name}" + (f" ({len(cores)} cores)" if cores else ""))
             return True
         except Exception as e:
             print(f"⚠️ Failed to start persistent kernel: {str(e)}")
+            self._release_cpu_share()
             return False
+
+    def _kernel_process(self):
+        """Process handle (with pid and poll()) of the local kernel, if available"""
+        return (getattr(getattr(self.kernel_manager, "provisioner", None), "process", None)
+                or getattr(self.kernel_manager, "kernel", None))
+
+    def _release_cpu_share(self):
+        if self._cpu_token is not None:
+            try:
+                self.cpu_budget.release(self._cpu_token)
+            except OSError as e:
+                print(f"⚠️ Warning: Could not release CPU share: {e}")
+            self._cpu_token = None
+
+    def apply_thread_budget(self):
+        """Re-pin the kernel to its current CPU share and resize its thread pools (scanpy, numba, BLAS, torch)"""
+        if self._cpu_token is None or self.kernel_client is None:
+            return
+        num_threads = len(self.cpu_budget.cores_for(self._cpu_token))
+        self._kernel_request(f"{cpu_budget.KERNEL_HELPER}\n_cv_set_threads({num_threads})")
     
     def stop_persistent_kernel(self):
         """Stop the persistent kernel with proper error handling"""
@@ -697,13 +1035,64 @@ class AnalysisAgent:
         except Exception as e:
             print(f"⚠️ Warning: Error during kernel cleanup: {e}")
         finally:
-            # Reset kernel references
+            # Reset kernel references and return the kernel's cores to the budget
             self.kernel_client = None
             self.kernel_manager = None
+            self._release_cpu_share()
     
 
+    def kernel_alive(self):
+        """Whether the persistent kernel process is still running"""
+        try:
+            return self.kernel_manager is not None and self.kernel_manager.is_alive()
+        except Exception:
+            return False
+
+    def kernel_crash_reason(self):
+        """Best-effort description of why the kernel process exited"""
+        process = self._kernel_process()
+        exit_code = process.poll() if process is not None else None
+        if exit_code is None:
+            return "unknown cause"
+        if exit_code < 0:
+            reasons = {9: "killed with SIGKILL, most likely by the out-of-memory killer",
+                       11: "segmentation fault in native code", 6: "aborted by native code", 7: "bus error"}
+            return reasons.get(-exit_code, f"terminated by signal {-exit_code}")
+        return f"exited with code {exit_code}"
+
+    def restart_kernel_and_replay(self, cells):
+        """
+        Start a fresh kernel and re-run the code cells among `cells` that previously ran without errors
+
+        Returns:
+            bool: Whether the kernel restarted
+        """
+        self.stop_persistent_kernel()
+        if not self.start_persistent_kernel():
+            self.metrics.kernel_restarts.inc(outcome="failed")
+            return False
+        replayable = [cell for cell in cells if cell.cell_type == 'code' and cell.source.strip()
+                      and not any(output.get('output_type') == 'error' for output in cell.get('outputs', []))]
+        start = time.time()
+        for i, cell in enumerate(replayable):
+            reply = self._kernel_request(cell.source, timeout=600)
+            if reply is None or reply.get('status') != 'ok':
+                error = f"{reply.get('ename')}: {reply.get('evalue')}" if reply else "no reply"
+                print(f"  ⚠️ Replay of cell {i + 1}/{len(replayable)} failed: {error}")
+                if not self.kernel_alive():
+                    self.metrics.kernel_restarts.inc(outcome="failed")
+                    return False
+        print(f"  ✅ Replayed {len(replayable)} cells in {time.time() - start:.1f}s")
+        self.metrics.kernel_restarts.inc(outcome="replayed")
+        self.checkpoint_kernel()
+        return True
+
     def run_last_cell(self, nb):
         """Executes the most recently added code cell and updates its outputs."""
+        with self._kernel_lock, self.tracer.span("kernel_execute", "kernel"):
+            return self._run_last_cell(nb)
+
+    def _run_last_cell(self, nb):
         if not nb.cells:
             raise ValueError("No cells in notebook to run.")
 
@@ -718,16 +1107,22 @@ class AnalysisAgent:
             raise ValueError("No code cells found in notebook.")
             
         code = last_code_cell.source
+        if self.kernel_client is None:
+            # The kernel died earlier and could not be restarted
+            error = new_output(output_type='error', ename='KernelDiedError', traceback=[],
+                               evalue="No kernel is running: it died and could not be restarted.")
+            last_code_cell.outputs = [error]
+            return False, f"{error.ename}: {error.evalue}", nb
         #print("Running code: ", code)
         msg_id = self.kernel_client.execute(code)
         outputs = []
 
         # Set up strict timeout mechanism
-        import time
         start_time = time.time()
         max_execution_time = 600  # 10 minutes maximum (600 seconds)
-        message_timeout = 30  # 30 seconds timeout for individual messages
+        message_timeout = 5  # seconds between kernel liveness checks while waiting for messages
         timed_out = False
+        crash_reason = None
         
         while True:
             # Check if we've exceeded the overall maximum execution time
@@ -744,6 +1139,10 @@ class AnalysisAgent:
             try:
                 msg = self.kernel_client.get_iopub_msg(timeout=current_timeout)
             except Exception as e:
+                # A dead kernel sends nothing more; detect it instead of waiting for the timeout
+                if not self.kernel_alive():
+                    crash_reason = self.kernel_crash_reason()
+                    break
                 # Check if we still have time left
                 if time.time() - start_time >= max_execution_time:
                     print(f"⏰ Timeout reached during message wait ({elapsed_time/60:.1f} minutes)")
@@ -805,7 +1204,30 @@ Consider these alternatives for the next analysis step:
         # Update outputs in the last code cell by finding its index
         #last_code_cell.outputs = outputs
         code_cell_index = nb.cells.index(last_code_cell)
+        duration = time.time() - start_time
+
+        if crash_reason is not None:
+            print(f"💥 Kernel died ({crash_reason}); restarting and replaying successful cells")
+            self.logger.log_response(f"KERNEL DIED ({crash_reason})\n\nCode:\n```python\n{code}\n```", "kernel_died")
+            if self.restart_kernel_and_replay(nb.cells[:code_cell_index]):
+                evalue = (f"The kernel died while running this cell ({crash_reason}). It was restarted and the "
+                          "earlier successful cells were replayed. Rewrite the step to use less memory and compute, "
+                          "e.g. subsample cells, keep matrices sparse, use fewer genes or fewer training epochs.")
+            else:
+                self.stop_persistent_kernel()
+                evalue = (f"The kernel died while running this cell ({crash_reason}) and could not be restarted "
+                          "with the earlier cells, so the analysis cannot continue.")
+                print("  ❌ Kernel could not be restarted; ending this analysis")
+            outputs.append(new_output(output_type='error', ename='KernelDiedError', evalue=evalue, traceback=[]))
+
         nb.cells[code_cell_index].outputs = outputs
+        errors = [output for output in outputs if output.output_type == "error"]
+        status = "timeout" if timed_out else "error" if errors else "ok"
+        self.logger.log_event("cell_executed", duration_s=round(duration, 3), cell=code_cell_index,
+                              status=status, ename=errors[0].ename if errors else None, outputs=len(outputs))
+        self.metrics.cell_seconds.observe(duration, status=status)
+        if timed_out:
+            self.metrics.timeouts.inc(operation="cell_execution")
 
         # Check for errors
         for output in outputs:
@@ -826,6 +1248,213 @@ Consider these alternatives for the next analysis step:
         # Return success even if timed out - the timeout message in outputs will guide the agent
         return True, None, nb
 
+    def _kernel_request(self, code, user_expressions=None, timeout=30):
+        """
+        Run code in the persistent kernel without adding a cell, producing outputs or touching its history
+
+        Returns:
+            dict: Content of the execute reply, or None if none arrived within `timeout` seconds
+        """
+        with self._kernel_lock:
+            return self._kernel_request_locked(code, user_expressions, timeout)
+
+    def _kernel_request_locked(self, code, user_expressions, timeout):
+        if self.kernel_client is None:
+            return None
+        msg_id = self.kernel_client.execute(code, silent=True, store_history=False,
+                                            user_expressions=user_expressions or {})
+        deadline = time.time() + timeout
+        reply = None
+        while reply is None and time.time() < deadline:
+            try:
+                msg = self.kernel_client.get_shell_msg(timeout=min(5, max(0.1, deadline - time.time())))
+            except Exception:
+                if not self.kernel_alive():
+                    break
+                continue
+            if msg['parent_header'].get('msg_id') == msg_id:
+                reply = msg
+
+        # Consume this request's iopub messages so run_last_cell does not mistake its idle status for its own
+        while time.time() < deadline:
+            try:
+                msg = self.kernel_client.get_iopub_msg(timeout=min(5, max(0.1, deadline - time.time())))
+            except Exception:
+                break
+            if (msg['parent_header'].get('msg_id') == msg_id and msg['msg_type'] == 'status'
+                    and msg['content'].get('execution_state') == 'idle'):
+                break
+
+        if reply is None and self.kernel_alive():
+            self.metrics.timeouts.inc(operation="kernel_request")
+        return reply['content'] if reply is not None else None
+
+    def _kernel_eval(self, expression, code="", timeout=30):
+        """
+        Evaluate an expression in the persistent kernel without adding a cell or touching its history
+
+        Args:
+            expression (str): Expression to evaluate
+            code (str): Statements run silently before the expression (e.g. helper definitions)
+            timeout (float): Seconds to wait for the result
+
+        Returns:
+            str: The plain-text repr of the value, or None if evaluation failed
+        """
+        reply = self._kernel_request(code, {"value": expression}, timeout)
+        if reply is None or reply.get('status') != 'ok':
+            return None
+        value = reply.get('user_expressions', {}).get('value', {})
+        if value.get('status') != 'ok':
+            return None
+        return value.get('data', {}).get('text/plain')
+
+    def _kernel_json(self, expression, code="", timeout=30):
+        """Evaluate an expression producing a JSON string in the kernel and decode it"""
+        text = self._kernel_eval(expression, code=code, timeout=timeout)
+        if text is None:
+            return None
+        try:
+            return json.loads(ast.literal_eval(text))
+        except (ValueError, SyntaxError):
+            return None
+
+    def _last_traceback(self, notebook):
+        """Plain-text traceback of the last cell, or "" if it did not raise"""
+        for output in notebook.cells[-1].get("outputs", []):
+            if output.get("output_type") == "error":
+                return re.sub(r"\x1b\[[0-9;]*m", "", "\n".join(output.get("traceback", [])))
+        return ""
+
+    def try_fast_fix(self, notebook, code, error_msg):
+        """
+        Try a remembered fix, then the rule-based fixer, on the error of the last cell
+
+        Returns:
+            tuple: (patched code, fix source, hint); the source is "fix_memory" or a rule name, and None
+                if nothing applies. The hint is a remembered diff for a similar error to show the LLM.
+        """
+        ename, _, evalue = (error_msg or "").partition(": ")
+        traceback = self._last_traceback(notebook)
+
+        hint = ""
+        if self.fix_memory is not None:
+            key, patched, diff = self.fix_memory.lookup(code, error_msg, traceback)
+            self.metrics.record_cache("fix_memory", key is not None)
+            if key is not None:
+                self._fix_memory_key = key
+                self.logger.log_response(f"REMEMBERED FIX for {error_msg}\n\nCode:\n```python\n{patched}\n```", "fast_fix_fix_memory")
+                return patched, "fix_memory", ""
+            if diff:
+                hint = f"A similar error was fixed earlier in this dataset with the following change:\n{diff}"
+
+        # Obs schema from the h5ad file, updated with columns added in the kernel (e.g. clusterings)
+        obs_dtypes = {}
+        if getattr(self, "adata_obs", None) is not None:
+            obs_dtypes = {str(col): str(dtype) for col, dtype in self.adata_obs.dtypes.items()}
+        kernel_obs = None
+        if ename in ("KeyError", "TypeError", "ValueError") and self.kernel_client is not None:
+            kernel_obs = self._kernel_json(
+                "__import__('json').dumps({str(c): str(t) for c, t in adata.obs.dtypes.items()}) "
+                "if 'adata' in globals() else 'null'")
+        obs_dtypes.update(kernel_obs or {})
+
+        def namespace():
+            names = self._kernel_json(
+                "__import__('json').dumps([n for n in globals() if not n.startswith('_') "
+                "and n not in ('In', 'Out', 'exit', 'quit', 'get_ipython')])")
+            return names or []
+
+        patched, rule = self.fast_fixer.suggest(code, ename, evalue, traceback, obs_dtypes, namespace)
+        if rule is not None:
+            self.logger.log_response(f"RULE-BASED FIX ({rule}) for {error_msg}\n\nCode:\n```python\n{patched}\n```",
+                                     f"fast_fix_{rule}")
+        return patched, rule, hint
+
+    def checkpoint_kernel(self, code="", extend=False):
+        """
+        Checkpoint the kernel namespace before `code` runs, copying only the variables it may modify in place
+
+        Args:
+            code (str): Code about to run (a step, or a fix of it)
+            extend (bool): Add the variables `code` may modify to the current checkpoint instead of replacing it
+        """
+        if not self.kernel_checkpoints:
+            return
+        with self.tracer.span("kernel_checkpoint", "kernel"):
+            names = kernel_state.mutated_names(code)
+            summary = self._kernel_json(kernel_state.checkpoint_expression(self.checkpoint_max_bytes, names, extend),
+                                        code=kernel_state.KERNEL_HELPER, timeout=300)
+        if summary is None:
+            print("⚠️ Warning: Could not checkpoint the kernel state")
+        elif summary["uncopied"]:
+            print(f"⚠️ Too large to checkpoint (only rebinding can be rolled back): {', '.join(summary['uncopied'])}")
+
+    def rollback_kernel(self):
+        """Restore the kernel namespace to the last checkpoint"""
+        if not self.kernel_checkpoints:
+            return
+        with self.tracer.span("kernel_rollback", "kernel"):
+            result = self._kernel_json(kernel_state.ROLLBACK_EXPRESSION, code=kernel_state.KERNEL_HELPER, timeout=300)
+        if not result:
+            return
+        changes = [f"{label}: {', '.join(result[key])}" for key, label in
+                   (("restored", "restored"), ("rebound", "rebound"), ("removed", "removed")) if result[key]]
+        if changes:
+            print(f"  ↩️ Rolled back kernel state ({'; '.join(changes)})")
+        if result["unrecoverable"]:
+            print(f"  ⚠️ Modified in place and not checkpointed: {', '.join(result['unrecoverable'])}")
+        self.logger.log_response(json.dumps(result), "kernel_rollback")
+
+    def pick_fix_candidate(self, candidates):
+        """
+        Run candidate fixes in parallel in forked copies of the kernel and pick the first that succeeds
+
+        Falls back to the first candidate if none succeeds or forking is not available in the kernel (or
+        its host lacks the memory for even one fork); when memory is short, fewer children run at once
+        (see speculative.py). If no candidate ran to completion (every child died or timed out),
+        forking is unreliable in this kernel and later fixes are requested sequentially.
+
+        Returns:
+            tuple: (code to run as the next cell, number of other candidates that ran and raised)
+        """
+        if len(candidates) == 1:
+            return candidates[0], 0
+        result = self._kernel_json(candidates_expression(candidates, self.speculative_timeout),
+                                   code=KERNEL_HELPER, timeout=self.speculative_timeout + 30)
+        if not result or not result.get("supported"):
+            reason = f" ({result['reason']})" if result and result.get("reason") else ""
+            print(f"  ⚠️ Forked kernels unavailable{reason}; using the first candidate")
+            return candidates[0], 0
+        if result["parallel"] < len(candidates):
+            print(f"  ⚠️ Free memory allows {result['parallel']} forked kernel(s) at a time "
+                  f"for {len(candidates)} candidates")
+        outcomes = result["outcomes"]
+        self.logger.log_response("\n".join(f"Candidate {i + 1} ({outcome}): {error or 'ran successfully'}"
+                                           for i, (outcome, error) in enumerate(zip(outcomes, result["errors"]))),
+                                 "speculative_fix_candidates")
+        winner = result["winner"]
+        if winner is None and "error" not in outcomes:
+            print(f"  ⚠️ No forked kernel finished its candidate ({', '.join(outcomes)}); "
+                  "testing the first candidate directly and fixing sequentially from now on")
+            self.speculative_fixes = 1
+            return candidates[0], 0
+        chosen = 0 if winner is None else winner
+        # Only candidates that ran and raised are failed attempts; children lost to the fork are not
+        failed = sum(1 for i, outcome in enumerate(outcomes) if i != chosen and outcome == "error")
+        if winner is None:
+            print(f"  ❌ None of the {len(candidates)} candidate fixes succeeded in a forked kernel")
+        else:
+            print(f"  🏁 Candidate {winner + 1}/{len(candidates)} succeeded in a forked kernel")
+        return candidates[chosen], failed
+
+    def record_fast_fix(self, source, success):
+        """Record whether a fix returned by try_fast_fix made the cell run"""
+        if source == "fix_memory":
+            self.fix_memory.record(self._fix_memory_key, success)
+        else:
+            self.fast_fixer.record(source, success)
+
     def generate_idea(self, past_analyses, analysis_idx=None, seeded_hypothesis=None):
         """
         Phase 1: Idea Generation
@@ -891,11 +1520,7 @@ Consider these alternatives for the next analysis step:
             dict: Analysis containing hypothesis, analysis_plan, first_step_code, etc.
         """
         # Create a modified prompt that incorporates the seeded hypothesis
-        prompt = open(os.path.join(self.prompt_dir, "ablations", "analysis_from_hypothesis.txt")).read()
-        prompt = prompt.format(hypothesis=hypothesis, 
-                               coding_guidelines=self.coding_guidelines,
-                               adata_summary=self.adata_summary, 
-                               paper_summary=self.paper_summary)
+        prompt = self.prompts.render("analysis_from_hypothesis", hypothesis=hypothesis)
 
 
 
@@ -903,13 +1528,11 @@ Consider these alternatives for the next analysis step:
             self.logger.log_prompt("user", prompt, "Seeded Hypothesis Analysis")
 
         
-        response = self.client.chat.completions.create(
+        response = self._chat("initial",
             model=self.model_name,
-            messages=[
-                {"role": "system", "content": self.coding_system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+            messages=self._messages("initial", self.coding_system_prompt, prompt),
+            response_format=response_format("analysis_plan", self.model_name),
+            on_field=self._on_analysis_field
         )
         result = response.choices[0].message.content
         
@@ -926,9 +1549,9 @@ Consider these alternatives for the next analysis step:
                 raise ValueError("OpenAI API returned None response for hypothesis analysis")
         
         try:
-            analysis = json.loads(result)
-        except json.JSONDecodeError as e:
-            print(f"⚠️ JSON decode error in generate_analysis_from_hypothesis: {e}")
+            analysis = parse_structured(result, "analysis_plan")
+        except StructuredOutputError as e:
+            print(f"⚠️ Could not repair response in generate_analysis_from_hypothesis: {e}")
             print(f"   Raw result: {repr(result)}")
             raise
         
@@ -964,8 +1587,11 @@ Consider these alternatives for the next analysis step:
             
         hypotheses_analysis = []
         
-        # Reset code memory for this analysis
+        # Reset code memory, notebook digest and interpretations (hypothesis-specific) for this analysis
         self.code_memory = []
+        self._documentation_futures.clear()
+        self.notebook_context.reset()
+        self.interpretation_cache.clear()
         
         print(f"\n🚀 Executing Analysis {analysis_idx+1}")
 
@@ -1000,8 +1626,14 @@ Consider these alternatives for the next analysis step:
         current_code = strip_code_markers(current_code)
         notebook.cells.append(new_code_cell(current_code))
 
+        step_span = None
         for iteration in range(self.max_iterations):
             step_name = namer(analysis_idx, iteration + 1)
+            self.logger.set_context(analysis=analysis_idx + 1, step=iteration + 1)
+            self.tracer.end(step_span)
+            step_span = self.tracer.begin(f"step {iteration + 1}", "step")
+            self.apply_thread_budget()
+            self.checkpoint_kernel(current_code)
             # Execute the notebook
             #success, error_msg, notebook = self.execute_notebook(notebook)
             success, error_msg, notebook = self.run_last_cell(notebook)
@@ -1021,35 +1653,82 @@ Consider these alternatives for the next analysis step:
                 print(f"⚠️ Code errored with: {error_msg}")
                 self.logger.log_response(f"STEP {iteration + 1} FAILED - Analysis {analysis_idx+1}\n\nCode:\n```python\n{current_code}\n\n Error:\n{error_msg}```", f"step_execution_failed_{step_name}")
                 fix_attempt, fix_successful = 0, False
+                # The original failure is what the fix memory learns from
+                failed_code, first_error, first_traceback = current_code, error_msg, self._last_traceback(notebook)
+                fix_hint = ""
+                fix_tier = 0  # Escalation level of the fix model (fast model first, then the main model)
                 results_interpretation = ""  # Initialize at start of error block
-                while fix_attempt < self.max_fix_attempts and not fix_successful:
-                    fix_attempt += 1
-                    print(f"  🔧 Fix attempt {fix_attempt}/{self.max_fix_attempts}")
-                    
-                    # Log fix attempt start
-                    #self.logger.log_response(f"FIX ATTEMPT {fix_attempt}/{max_fix_attempts} - Analysis {analysis_idx+1}, Step {iteration + 1}", "fix_attempt_start")
-
-                    # Get relevant documentation on the single-cell packages being used
-                    documentation = ""
-                    if self.use_documentation:
-                        try:
-                            documentation = get_documentation(current_code)
-                        except Exception as e:
-                            print(f"⚠️ Documentation extraction failed: {e}")
-                            documentation = ""
-                    
-                    current_code = self.fix_code(current_code, error_msg, documentation=documentation)
-                    current_code = strip_code_markers(current_code)
+                fast_fixes_left = 2  # Rule-based fixes may chain (e.g. a missing import, then a misspelled column)
+                fix_span = self.tracer.begin("fix_loop", "fix")
+                # No fix can run once the kernel is gone (it died and could not be restarted)
+                while fix_attempt < self.max_fix_attempts and not fix_successful and self.kernel_client is not None:
+                    # Fixes run against the pre-step state, not the one left behind by the failed code
+                    self.rollback_kernel()
+
+                    # Predictable errors are patched locally; only novel errors cost an LLM call
+                    fast_fix_rule = None
+                    if fast_fixes_left > 0:
+                        fast_fix_code, fast_fix_rule, fix_hint = self.try_fast_fix(notebook, current_code, error_msg)
+                    if fast_fix_rule is not None:
+                        fast_fixes_left -= 1
+                        attempt_label = f"rule-based fix ({fast_fix_rule})"
+                        print(f"  ⚡ Applying {attempt_label}")
+                        current_code = fast_fix_code
+                    else:
+                        fix_attempt += 1
+                        attempt_label = f"attempt {fix_attempt}/{self.max_fix_attempts}"
+                        print(f"  🔧 Fix attempt {fix_attempt}/{self.max_fix_attempts}")
+
+                        # Log fix attempt start
+                        #self.logger.log_response(f"FIX ATTEMPT {fix_attempt}/{max_fix_attempts} - Analysis {analysis_idx+1}, Step {iteration + 1}", "fix_attempt_start")
+
+                        # Get relevant documentation on the single-cell packages being used
+                        documentation = ""
+                        if self.use_documentation:
+                            try:
+                                documentation = self._get_documentation(
+                                    current_code, error=f"{error_msg}\n{self._last_traceback(notebook)}",
+                                    token_budget=FIX_DOCUMENTATION_TOKENS)
+                            except Exception as e:
+                                print(f"⚠️ Documentation extraction failed: {e}")
+                                documentation = ""
+
+                        fix_model = self.router.model_for("fix", fix_tier)
+                        num_candidates = min(self.speculative_fixes, self.max_fix_attempts - fix_attempt + 1)
+                        if num_candidates > 1:
+                            # Candidates that fail in a forked kernel count as sequential attempts would
+                            candidates = self.fix_code_candidates(current_code, error_msg, num_candidates, other_code=fix_hint or "",
+                                                                  documentation=documentation, model=fix_model)
+                            current_code, failed_candidates = self.pick_fix_candidate(candidates)
+                            fix_attempt += failed_candidates
+                            attempt_label = f"attempt {fix_attempt}/{self.max_fix_attempts} ({len(candidates)} parallel candidates)"
+                        else:
+                            current_code = self.fix_code(current_code, error_msg, other_code=fix_hint or "",
+                                                         documentation=documentation, model=fix_model)
+                            current_code = strip_code_markers(current_code)
+                    # The fix may modify variables the failed code did not
+                    self.checkpoint_kernel(current_code, extend=True)
                     notebook.cells[-1] = nbf.v4.new_code_cell(current_code)
 
                     success, error_msg, notebook = self.run_last_cell(notebook)
+                    if fast_fix_rule is not None:
+                        self.record_fast_fix(fast_fix_rule, success)
+                    else:
+                        # Escalate to the next model in the fix route if the fixed code still errors
+                        self.router.record("fix", fix_tier, success)
+                        if not success:
+                            fix_tier += 1
 
                     if success:
                         fix_successful = True
-                        print(f"  ✅ Fix successful on attempt {fix_attempt}")
+                        if self.fix_memory is not None and fast_fix_rule != "fix_memory":
+                            self.fix_memory.learn(first_error, first_traceback, failed_code, current_code)
+                        print(f"  ✅ Fix successful on {attempt_label}")
                         
                         # Log successful fix
-                        self.logger.log_response(f"FIX SUCCESSFUL on attempt {fix_attempt}/{self.max_fix_attempts} - Analysis {analysis_idx+1}, Step {iteration + 2}", f"fix_attempt_success_{step_name}_{fix_attempt}")
+                        self.logger.log_response(f"FIX SUCCESSFUL on {attempt_label} - Analysis {analysis_idx+1}, Step {iteration + 2}", f"fix_attempt_success_{step_name}_{fix_attempt}")
+                        self.logger.log_event("fix_attempt", attempt=attempt_label, rule=fast_fix_rule, success=True)
+                        self.metrics.fix_attempts.inc(source=fast_fix_rule or "llm", outcome="success")
                         
                         # Generate updated code description for the fixed code
                         updated_description = self.generate_code_description(current_code)
@@ -1071,12 +1750,15 @@ Consider these alternatives for the next analysis step:
                         notebook.cells.append(interpretation_cell)
                         break
                     else:
-                        print(f"  ❌ Fix attempt {fix_attempt} failed")
+                        print(f"  ❌ Fix {attempt_label} failed")
                         
                         # Log failed fix attempt with error details
-                        self.logger.log_response(f"FIX ATTEMPT FAILED {fix_attempt}/{self.max_fix_attempts} - Analysis {analysis_idx+1}, Step {iteration + 1}: {error_msg}\n\nCode:\n```python\n{current_code}\n```", f"fix_attempt_failed_{step_name}_{fix_attempt}")
+                        self.logger.log_response(f"FIX FAILED ({attempt_label}) - Analysis {analysis_idx+1}, Step {iteration + 1}: {error_msg}\n\nCode:\n```python\n{current_code}\n```", f"fix_attempt_failed_{step_name}_{fix_attempt}")
+                        self.logger.log_event("fix_attempt", attempt=attempt_label, rule=fast_fix_rule, success=False,
+                                              error=error_msg)
+                        self.metrics.fix_attempts.inc(source=fast_fix_rule or "llm", outcome="failure")
 
-                        if fix_attempt == self.max_fix_attempts:
+                        if fix_attempt == self.max_fix_attempts and fast_fix_rule is None:
                             print(f"  ⚠️ Failed to fix after {self.max_fix_attempts} attempts. Moving to next iteration.")
                             self.logger.log_response(f"ALL FIX ATTEMPTS EXHAUSTED - Analysis {analysis_idx+1}, Step {iteration + 1}. Failed after {self.max_fix_attempts} attempts.", f"fix_attempt_exhausted_{step_name}")
                             
@@ -1086,6 +1768,13 @@ Consider these alternatives for the next analysis step:
                             results_interpretation = "Current analysis step failed to run. Try an alternative approach"
                             interpretation_cell = nbf.v4.new_markdown_cell(f"### Agent Interpretation\n\n{results_interpretation}")
                             notebook.cells.append(interpretation_cell)
+                self.tracer.end(fix_span)
+                if self.kernel_client is None:
+                    self.logger.log_response(f"KERNEL LOST - Ending Analysis {analysis_idx+1} at step {iteration + 1}: {error_msg}", f"kernel_lost_{step_name}")
+                    termination_note = (f"### Analysis Terminated Early\n\n{error_msg}\n\n"
+                                        f"Completed {iteration} of {self.max_iterations} planned iterations.")
+                    notebook.cells.append(nbf.v4.new_markdown_cell(termination_note))
+                    break
                 if not results_interpretation:  # Only get interpretation if we haven't set the failure message
                     results_interpretation = self.interpret_results(notebook, past_analyses, hypothesis, analysis_plan, current_code)
                     interpretation_cell = nbf.v4.new_markdown_cell(f"### Agent Interpretation\n\n{results_interpretation}")
@@ -1149,14 +1838,16 @@ Consider these alternatives for the next analysis step:
                 
             # Update the code memory with the current notebook state
             self.update_code_memory(notebook.cells)
+        self.tracer.end(step_span)
 
         # Save the notebook
         notebook_path = os.path.join(self.output_dir, f"{self.analysis_name}_analysis_{analysis_idx+1}.ipynb")
-        with open(notebook_path, 'w', encoding='utf-8') as f:
+        with self.tracer.span("notebook_write"), open(notebook_path, 'w', encoding='utf-8') as f:
             # Clean notebook outputs before writing
             clean_notebook = self.cleanup_notebook_outputs(notebook)
             nbf.write(clean_notebook, f)
             print(f"💾 Saved notebook to: {notebook_path}")
+        self.metrics.notebook_bytes.observe(os.path.getsize(notebook_path))
 
         # Log analysis completion
         self.logger.log_response(f"ANALYSIS {analysis_idx+1} COMPLETED - Notebook saved to: {notebook_path}", "analysis_complete")
@@ -1180,6 +1871,10 @@ Consider these alternatives for the next analysis step:
             seeded_hypotheses: Optional list of hypothesis strings for AI to develop into full analyses.
         """
         past_analyses = ""
+        run_span = self.tracer.begin("run", "run")
+
+        # Distill the background for the non-idea call types while the first idea is generated
+        self._background.submit(self.prepare_background_contexts)
 
         for analysis_idx in range(self.num_analyses):
             # Phase 1: Idea Generation
@@ -1189,6 +1884,13 @@ Consider these alternatives for the next analysis step:
                 seeded_hypothesis = seeded_hypotheses[analysis_idx]
                 seeded = True
             
+            self.logger.set_context(analysis=analysis_idx + 1, step=0)
+            self.tracer.set_context(analysis=analysis_idx + 1)
+            analysis_span = self.tracer.begin(f"analysis {analysis_idx + 1}", "analysis")
+
+            # Only the first analysis may wait for a DeepResearch background still in progress
+            self.refresh_deepresearch_background(wait=self.deepresearch_wait if analysis_idx == 0 else 0)
+
             try:
                 analysis = self.generate_idea(past_analyses, analysis_idx, seeded_hypothesis)
                 print(f"🚀 Generated Initial Analysis Plan for Analysis {analysis_idx+1}")
@@ -1206,11 +1908,43 @@ Consider these alternatives for the next analysis step:
                 else:
                     # Re-raise other ValueErrors
                     raise
+            finally:
+                self.tracer.end(analysis_span)
+        self.tracer.set_context(analysis=None)
+        self.tracer.end(run_span)
+        self.export_trace()
+
+        # Report token usage and latency per call type
+        usage_summary = self.usage.summary_table()
+        print(f"\n📊 LLM usage summary (cached prefix share: {self.usage.cached_share():.1%}):\n{usage_summary}")
+        self.logger.log_response(usage_summary, "usage_summary")
+        print(f"   Interpretation cache: {self.interpretation_cache.hits} hits / "
+              f"{self.interpretation_cache.hits + self.interpretation_cache.misses} lookups")
+        routing_summary = self.router.summary_table()
+        print(f"\n🔀 Model routing summary:\n{routing_summary}")
+        self.logger.log_response(routing_summary, "routing_summary")
+        fast_fix_summary = self.fast_fixer.summary()
+        if self.fix_memory is not None:
+            fast_fix_summary += f"; fix memory: {self.fix_memory.summary()}"
+        print(f"   Rule-based fixes: {fast_fix_summary}")
+        self.logger.log_response(fast_fix_summary, "fast_fix_summary")
+
         # Clean up resources
         self.cleanup()
         import gc
         gc.collect()
 
+    def export_trace(self):
+        """Write the run's trace to the output directory (Chrome trace JSON, folded stacks) and report its top time sinks"""
+        if not self.tracer.enabled:
+            return
+        trace_path = os.path.join(self.output_dir, "trace.json")
+        self.tracer.export_chrome(trace_path)
+        self.tracer.export_folded(os.path.join(self.output_dir, "trace.folded"))
+        trace_summary = self.tracer.summary()
+        print(f"\n⏱️ Top time sinks per analysis (trace: {trace_path}):\n{trace_summary}")
+        self.logger.log_response(trace_summary, "trace_summary")
+
     def create_initial_notebook(self, hypothesis):
         notebook = nbf.v4.new_notebook()
         
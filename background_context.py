@@ -0,0 +1,129 @@
+"""Background context distilled to a fixed token budget per call type.
+
+The paper summary, the overview of common analyses and the DeepResearch background open
+nearly every prompt. Idea generation gets them verbatim; every other call type gets versions
+distilled by the LLM to its budget. Each (source, budget) pair is distilled once per run: the
+results are memoized and saved in the run's output directory, and a source is only distilled
+again if its text changes (e.g. when the DeepResearch background arrives).
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Tokens allowed for each background source in the shared context of a call type (None: verbatim)
+CONTEXT_BUDGETS = {
+    "initial": None,
+    "next_step": 1000,
+    "incorporate": 1000,
+    "critique": 600,
+    "interpret": 600,
+}
+DEFAULT_BUDGET = 1000
+
+# Fixes and code descriptions get no shared context, only a digest of the paper of this size
+BRIEF_BUDGET = 150
+
+
+def context_budget(call_type):
+    return CONTEXT_BUDGETS.get(call_type, DEFAULT_BUDGET)
+
+
+def truncate_tokens(text, budget, count_tokens):
+    """Longest prefix of `text` within `budget` tokens, cut at a line break when possible"""
+    if count_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    prefix = text[:low]
+    line_break = prefix.rfind("\n")
+    if line_break > low // 2:
+        prefix = prefix[:line_break]
+    return prefix.rstrip() + "\n...(truncated)"
+
+
+class BackgroundCompressor:
+    """Per-run cache of background texts distilled to token budgets"""
+
+    def __init__(self, distill, count_tokens, path=None, tolerance=1.25):
+        """
+        Args:
+            distill (callable): (text, budget, source name) -> distilled text; may raise
+            count_tokens (callable): text -> number of tokens
+            path (str): JSON file persisting the distilled texts of this run (None keeps them in memory)
+            tolerance (float): Distillations longer than budget * tolerance are truncated
+        """
+        self.distill = distill
+        self.count_tokens = count_tokens
+        self.path = path
+        self.tolerance = tolerance
+        self._cache = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = {}
+
+    def _key(self, name, text, budget):
+        return f"{name}:{budget}:{hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]}"
+
+    def compress(self, name, text, budget):
+        """`text` distilled to at most about `budget` tokens (verbatim if it fits or budget is None)"""
+        if budget is None or not text or self.count_tokens(text) <= budget:
+            return text
+        key = self._key(name, text, budget)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # Concurrent requests for the same distillation wait for the first one
+        with key_lock:
+            if key in self._cache:
+                return self._cache[key]
+            try:
+                distilled = (self.distill(text, budget, name) or "").strip()
+            except Exception as e:
+                print(f"⚠️ Could not distill {name} to {budget} tokens ({e}); truncating it")
+                distilled = ""
+            if not distilled:
+                distilled = truncate_tokens(text, budget, self.count_tokens)
+            elif self.count_tokens(distilled) > budget * self.tolerance:
+                distilled = truncate_tokens(distilled, budget, self.count_tokens)
+            with self._lock:
+                self._cache[key] = distilled
+                self._save()
+            return distilled
+
+    def prepare(self, sources, budgets, max_workers=4):
+        """
+        Distill every (source, budget) pair up front, concurrently
+
+        Args:
+            sources (dict): Source name -> text
+            budgets (iterable): Token budgets to prepare
+        """
+        pairs = [(name, text, budget) for name, text in sources.items() if text
+                 for budget in sorted({budget for budget in budgets if budget is not None})]
+        if not pairs:
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda pair: self.compress(*pair), pairs))
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self._cache, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            print(f"⚠️ Warning: Could not save distilled background context: {e}")
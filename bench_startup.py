@@ -0,0 +1,92 @@
+"""Startup benchmark of the agent's entry points.
+
+Each measurement runs in a fresh interpreter, so modules already imported by this script do
+not hide costs. Reports the median wall time of `run.py --help` and of importing the main
+modules, and the slowest imports below each module (from `python -X importtime`).
+
+Usage:
+    python bench_startup.py [--repeat 5] [--top 8] [--max-help-seconds 1.0] [modules ...]
+
+Exits with status 1 if `run.py --help` is slower than --max-help-seconds.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = ("utils", "deepresearch", "agent")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_command(command, repeat):
+    """Median wall time in seconds of `command` over `repeat` runs, and the last run's return code"""
+    durations, returncode = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+        returncode = result.returncode
+    return statistics.median(durations), returncode
+
+
+def import_profile(module):
+    """
+    Import `module` in a fresh interpreter with -X importtime
+
+    Returns:
+        tuple: ([(self µs, cumulative µs, imported module)], error message or None)
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=HERE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    rows, other = [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            other.append(line)
+            continue
+        fields = [field.strip() for field in line[len("import time:"):].split("|")]
+        try:
+            rows.append((int(fields[0]), int(fields[1]), fields[2].strip()))
+        except (ValueError, IndexError):
+            continue  # header line
+    error = other[-1] if result.returncode != 0 and other else None
+    return rows, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup and import times of CellVoyager")
+    parser.add_argument("modules", nargs="*", default=list(DEFAULT_MODULES), help="Modules to import")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (default: 5)")
+    parser.add_argument("--top", type=int, default=8, help="Slowest imports listed per module (default: 8)")
+    parser.add_argument("--max-help-seconds", type=float, default=1.0,
+                        help="Fail if `run.py --help` takes longer (default: 1.0)")
+    args = parser.parse_args()
+
+    baseline, _ = time_command([sys.executable, "-c", "pass"], args.repeat)
+    print(f"Interpreter startup: {baseline * 1000:.0f} ms")
+
+    help_seconds, returncode = time_command([sys.executable, "run.py", "--help"], args.repeat)
+    status = "ok" if returncode == 0 else f"exit {returncode}"
+    print(f"run.py --help: {help_seconds * 1000:.0f} ms ({status})")
+
+    for module in args.modules:
+        seconds, returncode = time_command([sys.executable, "-c", f"import {module}"], args.repeat)
+        rows, error = import_profile(module)
+        if error:
+            print(f"\nimport {module}: failed ({error})")
+            continue
+        print(f"\nimport {module}: {seconds * 1000:.0f} ms ({(seconds - baseline) * 1000:.0f} ms over startup)")
+        # Top-level cost of each imported package, by cumulative time
+        for self_us, cumulative_us, name in sorted(rows, key=lambda row: row[1], reverse=True)[:args.top]:
+            print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    if help_seconds > args.max_help_seconds:
+        print(f"\n❌ run.py --help took {help_seconds:.2f} s (limit {args.max_help_seconds:.2f} s)")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
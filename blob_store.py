@@ -0,0 +1,184 @@
+"""Content-addressed store for logged prompts and responses.
+
+Prompts repeat the same large parts on every call (static context, coding guidelines, paper
+summary, DeepResearch background). With prompt logging enabled, each message is split into
+paragraph-aligned parts and every part is stored once as a zlib-compressed file named by
+its SHA-256 (`blobs/ab/cdef...`), shared by all runs logging to the same directory. Log
+events only hold the part digests.
+
+Reassemble logged prompts with `load_messages`, or from the command line:
+
+    python blob_store.py logs/covid19_events_20250101_120000.jsonl --list
+    python blob_store.py logs/covid19_events_20250101_120000.jsonl --index 12 [--response]
+"""
+import argparse
+import hashlib
+import os
+import threading
+import uuid
+import zlib
+
+
+def split_parts(text, min_chars=2048):
+    """
+    Split text at paragraph breaks into parts of at least `min_chars` (except the last)
+
+    Boundaries depend only on the text before them, so prompts sharing a prefix share its parts.
+    """
+    parts, current = [], []
+    size = 0
+    for paragraph in text.split("\n\n"):
+        current.append(paragraph)
+        size += len(paragraph) + 2
+        if size >= min_chars:
+            parts.append("\n\n".join(current))
+            current, size = [], 0
+    if current:
+        parts.append("\n\n".join(current))
+    return parts
+
+
+class BlobStore:
+    """Texts stored once under their SHA-256 digest, zlib-compressed"""
+
+    def __init__(self, root):
+        self.root = root
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def put(self, text):
+        """Store `text` (if new) and return its digest"""
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self._known:
+            return digest
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(data, 6))
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._known.add(digest)
+        return digest
+
+    def get(self, digest):
+        with open(self._path(digest), "rb") as f:
+            return zlib.decompress(f.read()).decode("utf-8")
+
+    def put_text(self, text):
+        """Store a text as paragraph-aligned parts; returns their digests"""
+        return [self.put(part) for part in split_parts(text)]
+
+    def get_text(self, digests):
+        return "\n\n".join(self.get(digest) for digest in digests)
+
+    def size(self):
+        """Number of blobs and their total compressed size in bytes"""
+        count, total = 0, 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(".tmp"):
+                    count += 1
+                    total += os.path.getsize(os.path.join(directory, name))
+        return count, total
+
+
+def store_messages(store, messages):
+    """
+    Store chat messages; returns JSON-serializable references to them
+
+    Text contents become lists of part digests; multimodal contents keep their structure with
+    each text or image URL stored as a blob.
+    """
+    refs = []
+    for message in messages:
+        content = message.get("content")
+        ref = {"role": message.get("role")}
+        if isinstance(content, str):
+            ref["parts"] = store.put_text(content)
+        elif isinstance(content, list):
+            items = []
+            for item in content:
+                if item.get("type") == "text":
+                    items.append({"type": "text", "parts": store.put_text(item.get("text", ""))})
+                elif item.get("type") == "image_url":
+                    items.append({"type": "image_url", "blob": store.put(item.get("image_url", {}).get("url", ""))})
+                else:
+                    items.append({"type": item.get("type")})
+            ref["items"] = items
+        refs.append(ref)
+    return refs
+
+
+def load_messages(store, refs):
+    """Reassemble the chat messages stored by store_messages"""
+    messages = []
+    for ref in refs:
+        message = {"role": ref.get("role")}
+        if "parts" in ref:
+            message["content"] = store.get_text(ref["parts"])
+        elif "items" in ref:
+            items = []
+            for item in ref["items"]:
+                if "parts" in item:
+                    items.append({"type": "text", "text": store.get_text(item["parts"])})
+                elif "blob" in item:
+                    items.append({"type": "image_url", "image_url": {"url": store.get(item["blob"])}})
+                else:
+                    items.append({"type": item.get("type")})
+            message["content"] = items
+        messages.append(message)
+    return messages
+
+
+def format_messages(messages, max_image_chars=80):
+    """Plain-text rendering of chat messages (image data shortened)"""
+    blocks = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            texts = []
+            for item in content:
+                if item.get("type") == "text":
+                    texts.append(item["text"])
+                elif item.get("type") == "image_url":
+                    url = item["image_url"]["url"]
+                    texts.append(f"[image {url[:max_image_chars]}...]")
+            content = "\n\n".join(texts)
+        blocks.append(f"===== {message.get('role')} =====\n{content}")
+    return "\n\n".join(blocks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reassemble prompts logged with --log-prompts")
+    parser.add_argument("events", help="JSONL event log")
+    parser.add_argument("--blobs", help="Blob directory (default: 'blobs' next to the event log)")
+    parser.add_argument("--list", action="store_true", help="List the logged prompts")
+    parser.add_argument("--index", type=int, help="Position of the prompt in --list to reassemble")
+    parser.add_argument("--response", action="store_true", help="Also print the logged response")
+    args = parser.parse_args()
+
+    from logger import read_events
+
+    store = BlobStore(args.blobs or os.path.join(os.path.dirname(os.path.abspath(args.events)), "blobs"))
+    prompts = [record for record in read_events(args.events) if "messages" in record]
+    if args.list or args.index is None:
+        for i, record in enumerate(prompts):
+            ids = ", ".join(f"{key}={record[key]}" for key in ("analysis", "step") if key in record)
+            print(f"{i:>5}  {record.get('call_type', record.get('name', ''))}  {record.get('model', '')}  {ids}")
+        count, total = store.size()
+        print(f"\n{len(prompts)} prompts; {count} blobs, {total / 1e6:.1f} MB compressed")
+        return
+    record = prompts[args.index]
+    print(format_messages(load_messages(store, record["messages"])))
+    if args.response and "response" in record:
+        print(f"\n===== response =====\n{store.get_text(record['response'])}")
+
+
+if __name__ == "__main__":
+    main()
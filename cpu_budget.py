@@ -0,0 +1,177 @@
+"""CPU budget shared by all kernels started on this machine.
+
+Scanpy, numba and BLAS default to every core in each kernel, so concurrent analyses
+oversubscribe the node. Kernels register in a small JSON registry (guarded by a file lock,
+so separate agent processes share one budget) and the cores of the budget are split evenly
+among the live kernels. Each kernel is pinned to its core set and started with matching
+thread-count environment variables; when kernels finish, the remaining ones are re-pinned to
+the freed cores and their thread pools are resized in place.
+"""
+import json
+import os
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: the registry is used without a lock
+    fcntl = None
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                   "NUMEXPR_NUM_THREADS")
+
+# Defined in the kernel to resize thread pools that were already created
+KERNEL_HELPER = r'''
+def _cv_set_threads(n):
+    import sys
+    try:
+        from threadpoolctl import threadpool_limits
+        globals()["_cv_thread_limits"] = threadpool_limits(limits=n)
+    except ImportError:
+        pass
+    if "numba" in sys.modules:
+        import numba
+        numba.set_num_threads(max(1, min(n, numba.config.NUMBA_NUM_THREADS)))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(n)
+    if "scanpy" in sys.modules:
+        sys.modules["scanpy"].settings.n_jobs = n
+    return n
+'''
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _pid_alive(pid):
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def set_affinity(pid, cores):
+    """Pin every thread of process `pid` to `cores` (Linux only; a no-op elsewhere)"""
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+    task_dir = f"/proc/{pid}/task"
+    thread_ids = os.listdir(task_dir) if os.path.isdir(task_dir) else [pid]
+    for thread_id in thread_ids:
+        try:
+            os.sched_setaffinity(int(thread_id), cores)
+        except OSError:
+            pass
+    return True
+
+
+class CPUBudget:
+    """Even split of a core budget among the live kernels in a shared registry"""
+
+    def __init__(self, registry_path, cores=None):
+        """
+        Args:
+            registry_path (str): JSON file shared by all processes drawing from the budget
+            cores (int or list): Number of cores (the first ones available to this process) or explicit
+                core ids forming the budget; defaults to all available cores
+        """
+        self.registry_path = registry_path
+        if cores is None:
+            cores = available_cores()
+        elif isinstance(cores, int):
+            cores = available_cores()[:max(1, cores)]
+        self.cores = list(cores)
+
+    def _locked(self, update):
+        """Run update(entries) under the registry lock, pruning entries of dead processes, and save"""
+        with open(self.registry_path, "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    entries = json.loads(f.read() or "{}")
+                except ValueError:
+                    entries = {}
+                entries = {token: entry for token, entry in entries.items()
+                           if _pid_alive(entry["owner"]) and _pid_alive(entry.get("pid"))}
+                result = update(entries)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(entries))
+                f.flush()
+                return result
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _assign(self, entries):
+        """Split the budget evenly over the live kernels, oldest first; kernels share cores if there are too many"""
+        tokens = sorted(entries, key=lambda token: entries[token]["started"])
+        if len(tokens) > len(self.cores):
+            return {token: [self.cores[i % len(self.cores)]] for i, token in enumerate(tokens)}
+        assignment, start = {}, 0
+        base, extra = divmod(len(self.cores), max(1, len(tokens)))
+        for i, token in enumerate(tokens):
+            size = base + (1 if i < extra else 0)
+            assignment[token] = self.cores[start:start + size]
+            start += size
+        return assignment
+
+    def _apply(self, entries):
+        assignment = self._assign(entries)
+        for token, cores in assignment.items():
+            entries[token]["cores"] = cores
+            if entries[token].get("pid"):
+                set_affinity(entries[token]["pid"], cores)
+        return assignment
+
+    def reserve(self):
+        """
+        Reserve a share of the budget for a kernel about to start
+
+        Returns:
+            tuple: (token identifying the reservation, list of assigned cores)
+        """
+        token = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        def update(entries):
+            entries[token] = {"owner": os.getpid(), "pid": None, "started": time.time()}
+            return self._apply(entries)[token]
+
+        return token, self._locked(update)
+
+    def register(self, token, kernel_pid):
+        """Attach the started kernel's process to its reservation and pin it"""
+        def update(entries):
+            if token in entries:
+                entries[token]["pid"] = kernel_pid
+            return self._apply(entries).get(token, self.cores)
+
+        return self._locked(update)
+
+    def release(self, token):
+        """Return a kernel's cores to the budget and rebalance the remaining kernels"""
+        def update(entries):
+            entries.pop(token, None)
+            self._apply(entries)
+
+        self._locked(update)
+
+    def cores_for(self, token):
+        """Current core set of a reservation (changes as other kernels start and finish)"""
+        return self._locked(lambda entries: self._apply(entries).get(token, self.cores))
+
+    def thread_env(self, num_threads):
+        """Environment variables limiting native thread pools to `num_threads`"""
+        env = {name: str(num_threads) for name in THREAD_ENV_VARS}
+        # numba cannot grow past NUMBA_NUM_THREADS later, so allow the whole budget and resize at runtime
+        env["NUMBA_NUM_THREADS"] = str(len(self.cores))
+        return env
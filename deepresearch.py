@@ -1,7 +1,9 @@
 from __future__ import annotations
+import hashlib
 import os
+import time
 from typing import Optional
-import openai
+from usage import count_tokens
 
 
 class DeepResearcher:
@@ -10,14 +12,30 @@ class DeepResearcher:
     Keeps the original public interface so callers in `agent.py` do not need to change.
     """
 
-    def __init__(self, openai_api_key: str):
-        self.client = openai.OpenAI(api_key=openai_api_key)
+    def __init__(self, openai_api_key: str, usage_tracker=None, cache_dir: Optional[str] = None,
+                 timeout: Optional[float] = None):
+        self.openai_api_key = openai_api_key
+        self._client = None
+        # Optional UsageTracker shared with the agent for per-run token/latency accounting
+        self.usage_tracker = usage_tracker
+        # Results are stored per (model, prompt) so the same paper and dataset are researched once
+        self.cache_dir = cache_dir
+        # Seconds after which a Deep Research request is abandoned
+        self.timeout = timeout
         # Allow overriding via env; default to lightweight for faster turnaround
         self.model = os.environ.get(
             "DEEP_RESEARCH_MODEL",
             "o4-mini-deep-research",
         )
 
+    @property
+    def client(self):
+        if self._client is None:
+            import openai  # imported on first use: cache hits never need the SDK
+
+            self._client = openai.OpenAI(api_key=self.openai_api_key)
+        return self._client
+
     def _extract_output_text(self, response) -> str:
         # Best effort extraction across SDK snapshots
         try:
@@ -56,19 +74,60 @@ class DeepResearcher:
             # Respect optional max tokens; some users report truncation defaults
             if max_output_tokens is not None:
                 kwargs["max_output_tokens"] = max_output_tokens
+            if self.timeout is not None:
+                kwargs["timeout"] = self.timeout
 
+            start = time.perf_counter()
             response = self.client.responses.create(**kwargs)
+            if self.usage_tracker is not None:
+                self.usage_tracker.record("deepresearch", count_tokens(prompt, self.model),
+                                          time.perf_counter() - start, getattr(response, "usage", None))
             text = self._extract_output_text(response)
             return text or ""
         except Exception as e:
             # Be silent to keep upstream behavior unchanged; caller already guards
             return ""
 
+    def _prompt(self, paper_summary: str, adata_summary: Optional[str], available_packages: str) -> str:
+        user_prompt = open(os.path.join(os.path.dirname(__file__), "prompts", "deepresearch.txt")).read()
+        return user_prompt.format(paper_summary=paper_summary, adata_summary=adata_summary, available_packages=available_packages)
+
+    def _cache_file(self, prompt: str) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        key = hashlib.sha256(f"{self.model}\0{prompt}".encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def cached_research(
+        self, paper_summary: str, adata_summary: Optional[str], available_packages: str) -> Optional[str]:
+        """Stored result of an earlier identical request (same model, paper and dataset summaries), or None"""
+        path = self._cache_file(self._prompt(paper_summary, adata_summary, available_packages))
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
     def research_from_paper_summary(
         self, paper_summary: str, adata_summary: Optional[str], available_packages: str) -> str:
         """Invoke Deep Research using provided dataset/paper context.
         """
-        user_prompt = open(os.path.join(os.path.dirname(__file__), "prompts", "deepresearch.txt")).read()
-        user_prompt = user_prompt.format(paper_summary=paper_summary, adata_summary=adata_summary, available_packages=available_packages)
+        user_prompt = self._prompt(paper_summary, adata_summary, available_packages)
+        cached = self.cached_research(paper_summary, adata_summary, available_packages)
+        if cached is not None:
+            return cached
 
-        return self._run_deep_research(user_prompt, max_output_tokens=64_000)
+        text = self._run_deep_research(user_prompt, max_output_tokens=64_000)
+        path = self._cache_file(user_prompt)
+        # Failed or timed-out requests return "" and are retried next run
+        if path is not None and text.strip():
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(path + ".tmp", path)
+            except OSError:
+                pass
+        return text
@@ -0,0 +1,430 @@
+"""Persisted index of the signatures and docstrings of the analysis packages.
+
+Generated code refers to functions through aliases (`sc.pp.normalize_total`). The aliases are
+resolved statically from the code's imports and assignments, and the resulting qualified names
+are looked up in an index of each package's public API. The index is built once per package
+version by introspecting the package and stored as JSON, so lookups are dictionary accesses
+and never execute the code being documented. Installing another version of a package builds
+a new index for it.
+
+The agent reads the index from its analysis kernel (KernelDocSource): the introspection
+helpers below are sent to the kernel by silent execution, so the documentation matches the
+package versions the code actually runs against and the agent process never imports the
+scientific stack. Symbols the package walk does not reach are described one at a time and
+added to the persisted index of that package version. Before the kernel starts, the index
+of the last version seen is used.
+"""
+import ast
+import functools
+import json
+import os
+import textwrap
+import threading
+
+# Aliases the notebook setup cell and common practice make available without an import in the cell
+DEFAULT_ALIASES = {
+    "sc": "scanpy",
+    "scanpy": "scanpy",
+    "scvi": "scvi",
+    "ad": "anndata",
+    "anndata": "anndata",
+    "np": "numpy",
+    "numpy": "numpy",
+    "pd": "pandas",
+    "pandas": "pandas",
+    "plt": "matplotlib.pyplot",
+    "matplotlib": "matplotlib",
+    "sns": "seaborn",
+    "seaborn": "seaborn",
+    "stats": "scipy.stats",
+    "scipy": "scipy",
+}
+
+# Distribution names that differ from the import name
+DISTRIBUTIONS = {"scvi": "scvi-tools"}
+
+
+def parse_source(source):
+    try:
+        return ast.parse(source)
+    except (IndentationError, SyntaxError):
+        try:
+            return ast.parse(textwrap.dedent(source))
+        except (IndentationError, SyntaxError):
+            return None
+
+
+def dotted_name(node):
+    """Dotted name of an ast.Name/ast.Attribute chain, or None"""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        parent = dotted_name(node.value)
+        return f"{parent}.{node.attr}" if parent else None
+    return None
+
+
+def resolve_aliases(tree, aliases=None):
+    """
+    Map local names to qualified names from imports, and from assignments of constructed
+    objects (`model = scvi.model.SCVI(adata)` makes `model.train` resolve to `scvi.model.SCVI.train`)
+    """
+    resolved = dict(DEFAULT_ALIASES if aliases is None else aliases)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    resolved[alias.asname] = alias.name
+                else:
+                    top = alias.name.split(".")[0]
+                    resolved[top] = top
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            for alias in node.names:
+                resolved[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+                and isinstance(node.value, ast.Call)):
+            constructor = qualify(dotted_name(node.value.func), resolved)
+            if constructor and constructor.rsplit(".", 1)[-1][:1].isupper():
+                resolved[node.targets[0].id] = constructor
+    return resolved
+
+
+def qualify(name, aliases):
+    """Replace the leading alias of a dotted name by its qualified name"""
+    if not name:
+        return None
+    head, _, rest = name.partition(".")
+    if head not in aliases:
+        return None
+    return f"{aliases[head]}.{rest}" if rest else aliases[head]
+
+
+def called_symbols(source, aliases=None):
+    """
+    Qualified names of the functions called in `source`, resolved without executing it
+
+    Returns:
+        list: (name as written, qualified name) pairs, sorted by name
+    """
+    tree = parse_source(source)
+    if tree is None:
+        return []
+    resolved = resolve_aliases(tree, aliases)
+    calls = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            name = dotted_name(node.func)
+            qualified = qualify(name, resolved)
+            if qualified and name not in calls:
+                calls[name] = qualified
+    return sorted(calls.items())
+
+
+def introspect_package(package, max_doc_chars=8000, max_depth=3):
+    """
+    Signatures and docstrings of the public API of `package`
+
+    Self-contained so that it can also be sent to and run in another interpreter.
+
+    Returns:
+        dict: {"version": installed version, "entries": {qualified name: {"signature", "doc"}}}
+    """
+    import importlib
+    import inspect
+    import types
+    from importlib import metadata
+
+    distributions = {"scvi": "scvi-tools"}
+    # Submodules that are commonly used but not imported by the package itself
+    submodules = {"matplotlib": ["matplotlib.pyplot"], "scipy": ["scipy.stats", "scipy.sparse"],
+                  "scanpy": ["scanpy.external"]}
+    try:
+        version = metadata.version(distributions.get(package, package))
+    except metadata.PackageNotFoundError:
+        version = None
+    root = importlib.import_module(package)
+    for submodule in submodules.get(package, []):
+        try:
+            importlib.import_module(submodule)
+        except ImportError:
+            pass
+    version = version or getattr(root, "__version__", "unknown")
+
+    def describe(obj):
+        try:
+            signature = str(inspect.signature(obj))
+        except (TypeError, ValueError):
+            signature = ""
+        doc = inspect.getdoc(obj) or ""
+        return {"signature": signature, "doc": doc[:max_doc_chars]}
+
+    entries = {}
+    seen = {id(root)}
+    queue = [(package, root)]
+    while queue:
+        module_name, module = queue.pop(0)
+        for name in dir(module):
+            if name.startswith("_"):
+                continue
+            try:
+                obj = getattr(module, name)
+            except Exception:
+                continue
+            qualified = f"{module_name}.{name}"
+            if isinstance(obj, types.ModuleType):
+                # Only submodules the package exposes itself; nothing is imported that it did not import
+                if (obj.__name__.split(".")[0] == package and id(obj) not in seen
+                        and qualified.count(".") < max_depth):
+                    seen.add(id(obj))
+                    queue.append((qualified, obj))
+                continue
+            if not callable(obj) or qualified in entries:
+                continue
+            entries[qualified] = describe(obj)
+            if inspect.isclass(obj) and (getattr(obj, "__module__", "") or "").split(".")[0] == package:
+                for member_name in dir(obj):
+                    if member_name.startswith("_"):
+                        continue
+                    try:
+                        member = getattr(obj, member_name)
+                    except Exception:
+                        continue
+                    if inspect.isroutine(member):
+                        entries[f"{qualified}.{member_name}"] = describe(member)
+    return {"version": str(version), "entries": entries}
+
+
+def describe_symbol(qualified_name, max_doc_chars=8000):
+    """
+    Signature and docstring of one object given by its qualified name, or None if it does not exist
+
+    Self-contained so that it can also be sent to and run in another interpreter.
+    """
+    import importlib
+    import inspect
+
+    parts = qualified_name.split(".")
+    obj, i = None, len(parts)
+    while i > 0:
+        try:
+            obj = importlib.import_module(".".join(parts[:i]))
+            break
+        except ImportError:
+            i -= 1
+    if obj is None:
+        return None
+    for attribute in parts[i:]:
+        try:
+            obj = getattr(obj, attribute)
+        except Exception:
+            return None
+    if not callable(obj):
+        return None
+    try:
+        signature = str(inspect.signature(obj))
+    except (TypeError, ValueError):
+        signature = ""
+    return {"signature": signature, "doc": (inspect.getdoc(obj) or "")[:max_doc_chars]}
+
+
+def installed_version(package):
+    """Version of an installed package from its metadata (without importing it), or None"""
+    from importlib import metadata
+
+    try:
+        return metadata.version(DISTRIBUTIONS.get(package, package))
+    except metadata.PackageNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def kernel_helper():
+    """Source of the introspection functions, renamed with the `_cv_` prefix, to define them in a kernel"""
+    import inspect
+
+    return "\n\n".join(inspect.getsource(function).replace(f"def {function.__name__}(", f"def _cv_{function.__name__}(", 1)
+                       for function in (introspect_package, describe_symbol))
+
+# Evaluated in the kernel: installed version of a distribution (fails if it is not installed)
+VERSION_EXPRESSION = ("__import__('json').dumps(__import__('importlib.metadata', fromlist=['version'])"
+                      ".version({distribution!r}))")
+
+
+class DocSourceUnavailable(RuntimeError):
+    """The interpreter documentation is read from cannot be queried right now (e.g. no kernel is running)"""
+
+
+class KernelDocSource:
+    """Versions, package indexes and single symbols read from a Jupyter kernel by silent execution"""
+
+    def __init__(self, evaluate_json, is_available, timeout=300):
+        """
+        Args:
+            evaluate_json (callable): (expression, code, timeout) -> decoded JSON value, or None on failure
+            is_available (callable): () -> whether the kernel can be queried
+            timeout (float): Seconds allowed for introspecting one package
+        """
+        self.evaluate_json = evaluate_json
+        self.is_available = is_available
+        self.timeout = timeout
+
+    def _evaluate(self, expression, timeout):
+        if not self.is_available():
+            raise DocSourceUnavailable("the analysis kernel is not running")
+        # The helpers are sent with every request since the kernel may have been restarted
+        return self.evaluate_json(expression, kernel_helper(), timeout)
+
+    def version_of(self, package):
+        return self._evaluate(VERSION_EXPRESSION.format(distribution=DISTRIBUTIONS.get(package, package)), 30)
+
+    def introspect(self, package):
+        built = self._evaluate(f"__import__('json').dumps(_cv_introspect_package({package!r}))", self.timeout)
+        if built is None:
+            raise RuntimeError(f"introspection of {package} failed in the kernel")
+        return built
+
+    def describe(self, qualified_name):
+        return self._evaluate(f"__import__('json').dumps(_cv_describe_symbol({qualified_name!r}))", 30)
+
+
+class DocIndex:
+    """Per-package, per-version index of signatures and docstrings, built lazily and persisted"""
+
+    def __init__(self, cache_dir, introspect=introspect_package, version_of=installed_version,
+                 describe=describe_symbol):
+        """
+        Args:
+            cache_dir (str): Directory holding one JSON index per (package, version)
+            introspect (callable): package -> {"version", "entries"}; builds a missing index
+            version_of (callable): package -> version string or None; selects the persisted index
+            describe (callable): qualified name -> {"signature", "doc"} or None; documents symbols
+                missing from the index (None to disable)
+
+        The callables may raise DocSourceUnavailable; lookups then fall back to the index of the
+        last version seen and are retried later.
+        """
+        self.cache_dir = cache_dir
+        self.introspect = introspect
+        self.version_of = version_of
+        self.describe = describe
+        self._packages = {}
+        self._versions = {}
+        self._missing = set()
+        self._lock = threading.Lock()
+
+    def _path(self, package, version):
+        return os.path.join(self.cache_dir, f"{package}-{version}.json")
+
+    def _versions_path(self):
+        return os.path.join(self.cache_dir, "versions.json")
+
+    def is_loaded(self, package):
+        return package in self._packages
+
+    def entries(self, package):
+        """Index of one package ({} if it cannot be introspected or its source is unavailable)"""
+        if package in self._packages:
+            return self._packages[package]
+        with self._lock:
+            if package in self._packages:
+                return self._packages[package]
+            entries = self._load(package)
+            if entries is None:
+                return {}
+            self._packages[package] = entries
+            return entries
+
+    def _read(self, package, version):
+        try:
+            with open(self._path(package, version)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, package, version, entries):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._path(package, version) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self._path(package, version))
+        except OSError as e:
+            print(f"⚠️ Warning: Could not save documentation index of {package}: {e}")
+
+    def _last_versions(self):
+        try:
+            with open(self._versions_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _remember_version(self, package, version):
+        self._versions[package] = version
+        versions = self._last_versions()
+        if versions.get(package) == version:
+            return
+        versions[package] = version
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._versions_path() + ".tmp", "w") as f:
+                json.dump(versions, f)
+            os.replace(self._versions_path() + ".tmp", self._versions_path())
+        except OSError:
+            pass
+
+    def _load(self, package):
+        """Entries of a package, or None if its source is unavailable and nothing is persisted"""
+        try:
+            version = self.version_of(package)
+        except DocSourceUnavailable:
+            version = self._last_versions().get(package)
+            entries = self._read(package, version) if version is not None else None
+            if entries is not None:
+                self._versions[package] = version
+            return entries
+        if version is not None:
+            entries = self._read(package, version)
+            if entries is not None:
+                self._remember_version(package, version)
+                return entries
+        try:
+            built = self.introspect(package)
+        except DocSourceUnavailable:
+            return None
+        except Exception as e:
+            print(f"⚠️ Warning: Could not index documentation of {package}: {e}")
+            return {}
+        self._write(package, built["version"], built["entries"])
+        self._remember_version(package, built["version"])
+        return built["entries"]
+
+    def lookup(self, qualified_name):
+        """{"signature", "doc"} of a qualified name, or None if it is not documented"""
+        package = qualified_name.split(".")[0]
+        entries = self.entries(package)
+        entry = entries.get(qualified_name)
+        if entry is not None or self.describe is None or qualified_name in self._missing:
+            return entry
+        if package not in self._packages:
+            return None
+        try:
+            entry = self.describe(qualified_name)
+        except DocSourceUnavailable:
+            return None
+        except Exception:
+            entry = None
+        if entry is None:
+            self._missing.add(qualified_name)
+            return None
+        with self._lock:
+            entries[qualified_name] = entry
+            if package in self._versions:
+                self._write(package, self._versions[package], entries)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._packages.clear()
+            self._versions.clear()
+            self._missing.clear()
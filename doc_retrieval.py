@@ -0,0 +1,232 @@
+"""Local, error-aware retrieval over the documentation index.
+
+Docstrings of the allowed packages are split into sections, with one chunk per documented
+parameter, and indexed with BM25. A query combines the traceback, the failing line and the
+functions and keyword arguments used in the code. Chunks of functions the code actually calls
+are boosted, with a further boost for the ones on the failing line. The best chunks are
+returned grouped by function, within a token budget, so the documentation of the call that
+failed is not cut off by that of unrelated calls.
+"""
+import ast
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from doc_index import called_symbols, parse_source
+from fix_memory import failing_line
+from notebook_context import estimate_tokens
+
+# Packages whose documentation is indexed (the packages the agent may use)
+DOCUMENTED_PACKAGES = ("scanpy", "scvi", "anndata", "matplotlib", "numpy", "seaborn", "pandas", "scipy")
+
+_SECTION_UNDERLINE = re.compile(r"^\s*-{3,}\s*$")
+_PARAMETER = re.compile(r"^(\*{0,2}[A-Za-z_][\w, *]*?)\s*(?::.*)?$")
+_TOKEN = re.compile(r"[a-z0-9]+(?:_[a-z0-9]+)*")
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def tokenize(text):
+    """Lowercase word tokens; snake_case identifiers also contribute their parts"""
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        if "_" in token:
+            tokens.extend(part for part in token.split("_") if part)
+    return tokens
+
+
+def split_sections(doc, max_chars=800):
+    """
+    Split a numpydoc-style docstring into (section, text) chunks, one per parameter in parameter
+    sections; text outside sections is the "Summary", and long sections are split into paragraphs
+    """
+    lines = doc.splitlines()
+    chunks, section, current = [], "Summary", []
+
+    def flush():
+        text = "\n".join(current).strip()
+        if len(text) <= max_chars:
+            if text:
+                chunks.append((section, text))
+            return
+        # Long prose sections are split into paragraphs so they fit a budget
+        paragraph = ""
+        for block in re.split(r"\n\s*\n", text):
+            if paragraph and len(paragraph) + len(block) > max_chars:
+                chunks.append((section, paragraph))
+                paragraph = ""
+            paragraph = f"{paragraph}\n\n{block}" if paragraph else block
+        if paragraph:
+            chunks.append((section, paragraph[:max_chars * 2]))
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if i + 1 < len(lines) and line.strip() and _SECTION_UNDERLINE.match(lines[i + 1]):
+            flush()
+            section, current = line.strip(), []
+            i += 2
+            continue
+        # In parameter sections every unindented "name : type" line starts a chunk
+        if (section in ("Parameters", "Other Parameters", "Attributes", "Keyword Arguments")
+                and line.strip() and not line[:1].isspace() and _PARAMETER.match(line)):
+            flush()
+            current = []
+        current.append(line)
+        i += 1
+    flush()
+    return chunks
+
+
+class BM25:
+    """Okapi BM25 over tokenized documents"""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.lengths = [len(document) for document in documents]
+        self.average_length = sum(self.lengths) / max(1, len(documents))
+        self.postings = defaultdict(list)  # term -> [(document index, term frequency)]
+        for index, document in enumerate(documents):
+            for term, frequency in Counter(document).items():
+                self.postings[term].append((index, frequency))
+        self.num_documents = len(documents)
+
+    def scores(self, query_terms):
+        scores = defaultdict(float)
+        for term in set(query_terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (self.num_documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, frequency in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / self.average_length)
+                scores[index] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return scores
+
+
+class DocRetriever:
+    """BM25 retrieval over the documentation index of the allowed packages"""
+
+    def __init__(self, doc_index, packages=DOCUMENTED_PACKAGES):
+        self.doc_index = doc_index
+        self.packages = packages
+        self._index = None  # ([(qualified name, section, text)], BM25 over them)
+        self._pending = list(packages)  # packages whose documentation source was unavailable
+        self._lock = threading.Lock()
+
+    def _build(self):
+        with self._lock:
+            if self._index is not None and not self._pending:
+                return
+            pending = [package for package in self.packages
+                       if not self.doc_index.entries(package) and not self.doc_index.is_loaded(package)]
+            # Rebuilt once packages that were unavailable (e.g. before the kernel started) can be read
+            if self._index is None or pending != self._pending:
+                self._index = self._build_index()
+            self._pending = pending
+
+    def _build_index(self):
+        chunks, documents = [], []
+        for package in self.packages:
+            for name, entry in list(self.doc_index.entries(package).items()):
+                for section, text in split_sections(entry["doc"]) or [("Summary", "")]:
+                    chunks.append((name, section, text))
+                    # The symbol's own name and signature are part of every chunk's text
+                    documents.append(tokenize(f"{name} {entry['signature']} {section} {text}"))
+        return chunks, BM25(documents)
+
+    def retrieve(self, code, error="", token_budget=1000):
+        """
+        Documentation sections most relevant to `code` and the error it raised
+
+        Args:
+            code (str): Code being fixed or critiqued
+            error (str): Error message and traceback, if any
+            token_budget (int): Approximate maximum size of the result in tokens
+
+        Returns:
+            str: Signatures and documentation sections grouped by function
+        """
+        if self._index is None or self._pending:
+            self._build()
+        chunks, bm25 = self._index
+
+        error = _ANSI_ESCAPE.sub("", error or "")
+        calls = dict(called_symbols(code))
+        called = set(calls.values())
+        failing = failing_line(error)
+        failing_calls = {qualified for name, qualified in calls.items() if failing and name in failing}
+
+        # Query: error text (paths dropped), then the names and keywords used in the code, weighted up
+        query = tokenize(re.sub(r"(?:/[\w.\-]+)+", " ", error[-4000:]))
+        query += tokenize(failing) * 2
+        query += tokenize(" ".join(called)) + _keyword_tokens(code)
+
+        scores = bm25.scores(query)
+        for index, (name, _, _) in enumerate(chunks):
+            if name in called:
+                scores[index] = scores.get(index, 0.0) * 2 + (4.0 if name in failing_calls else 1.0)
+
+        # Called symbols the package walk did not reach are described on demand (and then cached)
+        indexed = {name for name, _, _ in chunks}
+        extra = []
+        for name in sorted(called - indexed):
+            if name.split(".")[0] not in self.packages:
+                continue
+            entry = self.doc_index.lookup(name)
+            if entry is None:
+                continue
+            for section, text in split_sections(entry["doc"]) or [("Summary", "")]:
+                scores[len(chunks) + len(extra)] = 4.0 if name in failing_calls else 1.0
+                extra.append((name, section, text))
+        chunks = chunks + extra if extra else chunks
+
+        if not error:
+            # Without an error to match, only document what the code calls
+            scores = {index: score for index, score in scores.items() if chunks[index][0] in called}
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        sections = defaultdict(list)
+        order = []
+        used = 0
+        # Signatures of the failing calls always come first
+        for name in sorted(failing_calls):
+            entry = self.doc_index.lookup(name)
+            if entry is not None:
+                order.append(name)
+                used += estimate_tokens(f"{name}{entry['signature']}")
+        selected_texts = set()
+        for index in ranked:
+            name, section, text = chunks[index]
+            # The same object is often reachable under several names
+            if text in selected_texts:
+                continue
+            cost = estimate_tokens(text) + (0 if name in order else estimate_tokens(name) + 20)
+            if used + cost > token_budget:
+                continue
+            if name not in order:
+                order.append(name)
+            sections[name].append((index, section, text))
+            selected_texts.add(text)
+            used += cost
+            if used >= token_budget * 0.95:
+                break
+
+        blocks = []
+        for name in order:
+            entry = self.doc_index.lookup(name) or {"signature": ""}
+            parts = [f"{name}{entry['signature']}"]
+            # Sections in docstring order
+            for _, section, text in sorted(sections[name]):
+                parts.append(text if section == "Summary" else f"[{section}]\n{text}")
+            blocks.append("\n".join(parts))
+        return "\n\n".join(blocks)
+
+
+def _keyword_tokens(code):
+    """Keyword argument names used in calls of the code"""
+    tree = parse_source(code)
+    if tree is None:
+        return []
+    return [token for node in ast.walk(tree) if isinstance(node, ast.Call)
+            for keyword in node.keywords if keyword.arg for token in tokenize(keyword.arg)]
@@ -0,0 +1,284 @@
+"""Deterministic fixes for common, predictable error classes.
+
+Each rule inspects the error of a failed cell together with the obs schema and the kernel
+namespace and, if it recognises the error, returns a patched version of the code. The agent
+re-runs the patched cell before spending an LLM call on the error.
+"""
+import difflib
+import re
+from collections import OrderedDict
+
+# Conventional aliases of the packages the agent may use
+KNOWN_IMPORTS = {
+    "sc": "import scanpy as sc",
+    "scanpy": "import scanpy",
+    "np": "import numpy as np",
+    "pd": "import pandas as pd",
+    "plt": "import matplotlib.pyplot as plt",
+    "matplotlib": "import matplotlib",
+    "sns": "import seaborn as sns",
+    "stats": "from scipy import stats",
+    "scipy": "import scipy",
+    "sparse": "from scipy import sparse",
+    "sp": "import scipy.sparse as sp",
+    "ad": "import anndata as ad",
+    "anndata": "import anndata",
+    "scvi": "import scvi",
+    "mpl": "import matplotlib as mpl",
+    "gridspec": "import matplotlib.gridspec as gridspec",
+    "itertools": "import itertools",
+    "re": "import re",
+    "os": "import os",
+    "math": "import math",
+    "warnings": "import warnings",
+    "defaultdict": "from collections import defaultdict",
+    "Counter": "from collections import Counter",
+    "mannwhitneyu": "from scipy.stats import mannwhitneyu",
+    "ttest_ind": "from scipy.stats import ttest_ind",
+    "ranksums": "from scipy.stats import ranksums",
+    "spearmanr": "from scipy.stats import spearmanr",
+    "pearsonr": "from scipy.stats import pearsonr",
+    "chi2_contingency": "from scipy.stats import chi2_contingency",
+    "kruskal": "from scipy.stats import kruskal",
+    "multipletests": None,  # statsmodels is not an allowed package
+}
+
+# Renamed or relocated scanpy/scvi functions: old dotted name -> new dotted name
+API_RENAMES = {
+    "sc.pp.normalize_per_cell": "sc.pp.normalize_total",
+    "sc.tl.rank_genes_groups_df": "sc.get.rank_genes_groups_df",
+    "sc.pl.rank_genes_groups_df": "sc.get.rank_genes_groups_df",
+    "sc.logging.print_versions": "sc.logging.print_header",
+    "sc.pp.mnn_correct": "sc.external.pp.mnn_correct",
+    "sc.pp.bbknn": "sc.external.pp.bbknn",
+    "sc.pp.harmony_integrate": "sc.external.pp.harmony_integrate",
+    "sc.tl.harmony_integrate": "sc.external.pp.harmony_integrate",
+    "sc.tl.phate": "sc.external.tl.phate",
+    "sc.tl.palantir": "sc.external.tl.palantir",
+    "scvi.data.setup_anndata": "scvi.model.SCVI.setup_anndata",
+}
+
+# Renamed keyword arguments: (function name, old keyword) -> new keyword
+KWARG_RENAMES = {
+    ("normalize_total", "counts_per_cell_after"): "target_sum",
+    ("normalize_total", "fraction"): "max_fraction",
+    ("highly_variable_genes", "n_top"): "n_top_genes",
+    ("highly_variable_genes", "flavour"): "flavor",
+    ("rank_genes_groups", "group_by"): "groupby",
+    ("rank_genes_groups", "n_top_genes"): "n_genes",
+    ("neighbors", "n_neighbours"): "n_neighbors",
+    ("leiden", "key"): "key_added",
+    ("louvain", "key"): "key_added",
+}
+
+# Categorical errors -> how the categorical column is read on the failing line instead
+CATEGORICAL_ERRORS = {
+    "Categoricals can only be compared if 'categories' are the same": ".astype(str)",
+    "Object with dtype category cannot perform the numpy op": ".astype(str).astype(float)",
+    "does not support reduction": ".astype(str).astype(float)",
+    "Cannot cast object dtype to float": ".astype(str).astype(float)",
+}
+NEW_CATEGORY_ERROR = re.compile(r"Cannot setitem on a Categorical with a new category \((.*)\), set the categories first")
+
+
+class FastFixer:
+    """Rule-based fixer for predictable errors, with per-rule hit statistics"""
+
+    def __init__(self):
+        self.rules = [
+            ("missing_import", self._fix_missing_import),
+            ("name_near_miss", self._fix_name_near_miss),
+            ("obs_column_near_miss", self._fix_obs_column),
+            ("sparse_dense", self._fix_sparse_dense),
+            ("categorical_dtype", self._fix_categorical),
+            ("api_rename", self._fix_api_rename),
+            ("kwarg_rename", self._fix_kwarg_rename),
+        ]
+        self.stats = OrderedDict((name, {"applied": 0, "succeeded": 0}) for name, _ in self.rules)
+
+    def suggest(self, code, ename, evalue, traceback="", obs_dtypes=None, namespace=None):
+        """
+        Args:
+            code (str): Code of the failing cell
+            ename (str): Exception class name, e.g. "KeyError"
+            evalue (str): Exception message
+            traceback (str): Plain-text traceback
+            obs_dtypes (dict): adata.obs column -> dtype name
+            namespace (callable): Returns the names defined in the kernel (called only when needed)
+
+        Returns:
+            tuple: (patched code, rule name), or (None, None) if no rule applies
+        """
+        context = {
+            "ename": ename, "evalue": evalue, "traceback": traceback,
+            "obs_dtypes": obs_dtypes or {}, "namespace": namespace or (lambda: []),
+        }
+        for name, rule in self.rules:
+            try:
+                patched = rule(code, context)
+            except Exception:
+                patched = None
+            if patched is not None and patched != code:
+                self.stats[name]["applied"] += 1
+                return patched, name
+        return None, None
+
+    def record(self, rule, success):
+        """Record whether the cell patched by `rule` ran successfully"""
+        if success:
+            self.stats[rule]["succeeded"] += 1
+
+    def summary(self):
+        applied = {name: stats for name, stats in self.stats.items() if stats["applied"]}
+        if not applied:
+            return "no rule-based fixes applied"
+        return ", ".join(f"{name}: {stats['succeeded']}/{stats['applied']} succeeded" for name, stats in applied.items())
+
+    # --- rules ---
+
+    @staticmethod
+    def _failing_lines(code, context):
+        """Lines of the cell marked in the traceback as executing when it raised ("----> 5 ...")"""
+        code_lines = {line.strip() for line in code.splitlines() if line.strip()}
+        marked = (match.group(1).strip() for match in re.finditer(r"^-+>\s*\d+\s(.*)$", context["traceback"], re.M))
+        return [line for line in marked if line in code_lines]
+
+    @staticmethod
+    def _undefined_name(context):
+        if context["ename"] != "NameError":
+            return None
+        match = re.search(r"name '(\w+)' is not defined", context["evalue"])
+        return match.group(1) if match else None
+
+    def _fix_missing_import(self, code, context):
+        name = self._undefined_name(context)
+        if not KNOWN_IMPORTS.get(name):
+            return None
+        return f"{KNOWN_IMPORTS[name]}\n{code}"
+
+    def _fix_name_near_miss(self, code, context):
+        name = self._undefined_name(context)
+        if name is None:
+            return None
+        matches = difflib.get_close_matches(name, context["namespace"](), n=1, cutoff=0.8)
+        if not matches:
+            return None
+        return re.sub(r"(?<![\w.])%s\b" % re.escape(name), matches[0], code)
+
+    def _fix_obs_column(self, code, context):
+        if context["ename"] != "KeyError" or not context["obs_dtypes"]:
+            return None
+        match = re.search(r"""['"]([^'"]+)['"]""", context["evalue"])
+        if not match:
+            return None
+        missing = match.group(1)
+        columns = list(context["obs_dtypes"])
+        if missing in columns:
+            return None
+        # Other KeyErrors (gene names, other DataFrames, dict keys) are not misspelled obs columns
+        indexes_obs = re.compile(r"""obs(?:\.loc\[[^\]]*,\s*|\[)(['"])%s\1""" % re.escape(missing))
+        if not any(indexes_obs.search(line) for line in self._failing_lines(code, context)):
+            return None
+        # Prefer a case-insensitive exact match, then the closest spelling
+        lowered = {column.lower(): column for column in columns}
+        replacement = lowered.get(missing.lower())
+        if replacement is None:
+            matches = difflib.get_close_matches(missing, columns, n=1, cutoff=0.6)
+            if not matches:
+                return None
+            replacement = matches[0]
+        return re.sub(r"""(['"])%s\1""" % re.escape(missing), lambda m: f"{m.group(1)}{replacement}{m.group(1)}", code)
+
+    def _fix_sparse_dense(self, code, context):
+        if context["ename"] != "AttributeError":
+            return None
+        match = re.search(r"'(\w+)' object has no attribute '(A1?)'", context["evalue"])
+        if not match or "matrix" not in match.group(1) and "array" not in match.group(1):
+            return None
+        # Patch every dense-matrix shorthand in the cell, not just the one that failed first
+        code = re.sub(r"\.A1\b", ".toarray().ravel()", code)
+        return re.sub(r"\.A\b(?!\()", ".toarray()", code)
+
+    def _fix_categorical(self, code, context):
+        """Patch the failing line only; adata.obs keeps its categorical columns for later steps"""
+        message = f"{context['evalue']}\n{context['traceback']}"
+        new_category = NEW_CATEGORY_ERROR.search(message)
+        conversion = next((conversion for pattern, conversion in CATEGORICAL_ERRORS.items() if pattern in message), None)
+        if new_category is None and conversion is None:
+            return None
+        categorical = [column for column, dtype in context["obs_dtypes"].items() if dtype == "category"]
+        for line in self._failing_lines(code, context):
+            referenced = [column for column in categorical if re.search(r"""['"]%s['"]""" % re.escape(column), line)]
+            if len(referenced) != 1:
+                continue
+            column = referenced[0]
+            if new_category is not None:
+                # Register the new label as a category of the column before the assignment
+                frame = re.search(r"([\w.]*obs)\b", line)
+                frame = frame.group(1) if frame else "adata.obs"
+                value = new_category.group(1)
+                indent = re.match(r"\s*", next(l for l in code.splitlines() if l.strip() == line)).group(0)
+                guard = (f"{indent}if {value!r} not in {frame}[{column!r}].cat.categories: "
+                         f"{frame}[{column!r}] = {frame}[{column!r}].cat.add_categories([{value!r}])")
+                return self._replace_line(code, line, f"{guard}\n{indent}{line}")
+            # Read the column as labels (or numbers) on this line, without assigning to it
+            read = re.compile(r"""\b([\w.]*obs\[(['"])%s\2\])(?!\s*=[^=])""" % re.escape(column))
+            patched_line = read.sub(lambda m: m.group(1) + conversion, line)
+            if patched_line != line:
+                indent = re.match(r"\s*", next(l for l in code.splitlines() if l.strip() == line)).group(0)
+                return self._replace_line(code, line, indent + patched_line)
+        return None
+
+    @staticmethod
+    def _replace_line(code, line, replacement):
+        """Replace the first line of `code` whose stripped text is `line`"""
+        lines = code.splitlines()
+        index = next(i for i, l in enumerate(lines) if l.strip() == line)
+        lines[index] = replacement
+        return "\n".join(lines)
+
+    def _fix_api_rename(self, code, context):
+        if context["ename"] != "AttributeError":
+            return None
+        match = re.search(r"has no attribute '(\w+)'", context["evalue"])
+        if not match:
+            return None
+        patched = code
+        for old, new in API_RENAMES.items():
+            if old.rsplit(".", 1)[1] == match.group(1):
+                patched = re.sub(r"(?<![\w.])%s\b" % re.escape(old), new, patched)
+        if patched == code:
+            return None
+        # Renamed functions often also renamed their keywords
+        for (function, old_kwarg), new_kwarg in KWARG_RENAMES.items():
+            patched = self._rename_kwarg(patched, function, old_kwarg, new_kwarg)
+        return patched
+
+    def _fix_kwarg_rename(self, code, context):
+        if context["ename"] != "TypeError":
+            return None
+        match = re.search(r"(\w+)\(\) got an unexpected keyword argument '(\w+)'", context["evalue"])
+        if not match:
+            return None
+        new_kwarg = KWARG_RENAMES.get((match.group(1), match.group(2)))
+        if new_kwarg is None:
+            return None
+        return self._rename_kwarg(code, match.group(1), match.group(2), new_kwarg)
+
+    @staticmethod
+    def _rename_kwarg(code, function, old_kwarg, new_kwarg):
+        """Rename a keyword argument inside calls to `function` (single-line or multi-line calls)"""
+        pattern = re.compile(r"\b%s\(" % re.escape(function))
+        patched, position = code, 0
+        while True:
+            match = pattern.search(patched, position)
+            if not match:
+                return patched
+            # Find the matching closing parenthesis of the call
+            depth, end = 1, match.end()
+            while end < len(patched) and depth:
+                depth += {"(": 1, ")": -1}.get(patched[end], 0)
+                end += 1
+            call = re.sub(r"\b%s(\s*=)" % re.escape(old_kwarg), new_kwarg + r"\1", patched[match.end():end])
+            patched = patched[:match.end()] + call + patched[end:]
+            position = match.end() + len(call)
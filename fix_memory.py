@@ -0,0 +1,171 @@
+"""Persistent memory of successful fixes, keyed by normalized error signature.
+
+Errors recur across analyses and runs on the same dataset (a wrong column name, an API
+mismatch). Each successful fix is stored as a line diff of the failing cell under the
+signature of the error and the line that raised it. When the same error shows up again the
+diff is re-applied directly, or shown to the LLM as a hint if it no longer applies cleanly.
+"""
+import difflib
+import hashlib
+import json
+import os
+import re
+import time
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def normalize_error(error_msg):
+    """Error signature: exception name and message with run-specific details (numbers, addresses, paths) masked"""
+    text = ANSI_ESCAPE.sub("", error_msg or "").strip().splitlines()
+    text = text[0] if text else ""
+    text = re.sub(r"0x[0-9a-fA-F]+", "<addr>", text)
+    text = re.sub(r"(?:/[\w.\-]+)+", "<path>", text)
+    text = re.sub(r"\b\d+(?:\.\d+)?(?:e[-+]?\d+)?\b", "<num>", text)
+    text = re.sub(r"\s+", " ", text)
+    return text[:300]
+
+
+def failing_line(traceback):
+    """Source line of the notebook cell that raised, from an IPython traceback"""
+    for line in ANSI_ESCAPE.sub("", traceback or "").splitlines():
+        match = re.match(r"^\s*-*>\s*\d+\s(.*)$", line)
+        if match:
+            return re.sub(r"\s+", " ", match.group(1)).strip()
+    return ""
+
+
+def compute_edits(failed_code, fixed_code):
+    """
+    Line-level edits turning `failed_code` into `fixed_code`, as (before, after) text blocks
+
+    A blank `before` would match anywhere, so blocks of blank lines (and insertions) are anchored on
+    the lines back to the nearest non-blank one; `before` is None when there is none, meaning "prepend".
+    """
+    old, new = failed_code.splitlines(), fixed_code.splitlines()
+    edits = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag == "equal":
+            continue
+        start = i1
+        if not "".join(old[i1:i2]).strip():
+            while start > 0 and not old[start - 1].strip():
+                start -= 1
+            start = max(start - 1, 0)
+            if not old[start:i1] or not old[start].strip():
+                edits.append([None, "\n".join(new[j1:j2])])
+                continue
+        edits.append(["\n".join(old[start:i2]), "\n".join(old[start:i1] + new[j1:j2])])
+    return edits
+
+
+def apply_edits(code, edits):
+    """Apply stored edits to `code`; returns None if any edit does not apply"""
+    for before, after in edits:
+        if before is None:
+            code = f"{after}\n{code}"
+        elif before.strip() and before in code:
+            code = code.replace(before, after, 1)
+        else:
+            return None
+    return code
+
+
+class FixMemory:
+    """JSON-backed store of (error signature, failing line) -> successful fix"""
+
+    def __init__(self, path, max_entries=500):
+        """
+        Args:
+            path (str): JSON file holding the memory (created on first save)
+            max_entries (int): Least recently used entries beyond this are evicted on save
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.suggestions = 0
+        self.misses = 0
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Warning: Could not read fix memory {path}: {e}")
+
+    @staticmethod
+    def key(signature, line):
+        return hashlib.sha1(f"{signature}\n{line}".encode("utf-8")).hexdigest()
+
+    def lookup(self, code, error_msg, traceback=""):
+        """
+        Find a stored fix for an error
+
+        Returns:
+            tuple: (key, patched code or None, diff hint or None); key is None if nothing matches
+        """
+        signature = normalize_error(error_msg)
+        exact = self.entries.get(self.key(signature, failing_line(traceback)))
+        candidates = [exact] if exact else []
+        # Same error raised from a different line: the fix may still apply
+        candidates += sorted((entry for entry in self.entries.values()
+                              if entry["signature"] == signature and entry is not exact),
+                             key=lambda entry: entry["successes"] - entry["failures"], reverse=True)
+        for entry in candidates:
+            if entry["failures"] > entry["successes"]:
+                continue
+            patched = apply_edits(code, entry["edits"])
+            if patched is not None and patched != code:
+                self.hits += 1
+                return self.key(entry["signature"], entry["line"]), patched, None
+        if candidates:
+            self.suggestions += 1
+            return None, None, candidates[0]["diff"]
+        self.misses += 1
+        return None, None, None
+
+    def record(self, key, success):
+        """Record whether an applied fix made the cell run"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry["successes" if success else "failures"] += 1
+        entry["last_used"] = time.time()
+        self.save()
+
+    def learn(self, error_msg, traceback, failed_code, fixed_code):
+        """Store the fix that turned `failed_code` (which raised `error_msg`) into working `fixed_code`"""
+        edits = compute_edits(failed_code, fixed_code)
+        if not edits:
+            return
+        signature, line = normalize_error(error_msg), failing_line(traceback)
+        key = self.key(signature, line)
+        previous = self.entries.get(key, {})
+        self.entries[key] = {
+            "signature": signature,
+            "line": line,
+            "edits": edits,
+            "diff": "".join(difflib.unified_diff(failed_code.splitlines(True), fixed_code.splitlines(True),
+                                                 "failing cell", "fixed cell")),
+            "successes": previous.get("successes", 0) + 1,
+            "failures": 0,
+            "last_used": time.time(),
+        }
+        self.save()
+
+    def save(self):
+        if len(self.entries) > self.max_entries:
+            kept = sorted(self.entries.items(), key=lambda item: item[1]["last_used"], reverse=True)
+            self.entries = dict(kept[:self.max_entries])
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Warning: Could not save fix memory {self.path}: {e}")
+
+    def summary(self):
+        return (f"{len(self.entries)} stored fixes, {self.hits} applied, "
+                f"{self.suggestions} suggested, {self.misses} misses")
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import io
+from collections import OrderedDict
+
+
+class ImagePipeline:
+    """Prepares notebook figures for the VLM: dedupes, downscales and recompresses them"""
+
+    def __init__(self, max_side=1024, max_bytes=400_000):
+        """
+        Args:
+            max_side (int): Maximum width/height in pixels of an uploaded image
+            max_bytes (int): Target maximum encoded size of an uploaded image
+        """
+        self.max_side = max_side
+        self.max_bytes = max_bytes
+
+    def prepare(self, images_b64):
+        """
+        Args:
+            images_b64 (list): Base64-encoded PNGs (optionally with a data URL prefix)
+
+        Returns:
+            list: One dict per distinct image with keys 'data' (base64), 'mime' and 'digest' (pixel digest)
+        """
+        from PIL import Image  # only needed once figures are interpreted
+
+        prepared, seen = [], set()
+        for image_b64 in images_b64:
+            if "," in image_b64:
+                image_b64 = image_b64.split(",")[1]
+            try:
+                image = Image.open(io.BytesIO(base64.b64decode(image_b64)))
+                image.load()
+            except Exception as e:
+                print(f"Warning: Error decoding image: {str(e)}")
+                continue
+
+            # Only pixel-identical figures are dropped: figures of one cell that share a layout (e.g. the
+            # same UMAP colored by different genes) look alike but differ in content
+            digest = hashlib.sha256(f"{image.mode}{image.size}".encode("ascii") + image.tobytes()).hexdigest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+
+            data, mime = self._compress(image)
+            prepared.append({"data": base64.b64encode(data).decode("ascii"), "mime": mime,
+                             "digest": digest})
+        return prepared
+
+    def _compress(self, image):
+        """Downscale to max_side and re-encode, falling back to JPEG and smaller sizes until under max_bytes"""
+        from PIL import Image
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA")
+        side = self.max_side
+        while True:
+            resized = image.copy()
+            resized.thumbnail((side, side), Image.LANCZOS)
+
+            buffer = io.BytesIO()
+            resized.save(buffer, format="PNG", optimize=True)
+            if buffer.tell() <= self.max_bytes:
+                return buffer.getvalue(), "image/png"
+
+            # Plots compress well as PNG; photographs-like heatmaps often need JPEG
+            flattened = resized
+            if resized.mode == "RGBA":
+                flattened = Image.new("RGB", resized.size, "white")
+                flattened.paste(resized, mask=resized.split()[3])
+            for quality in (85, 70):
+                buffer = io.BytesIO()
+                flattened.save(buffer, format="JPEG", quality=quality, optimize=True)
+                if buffer.tell() <= self.max_bytes:
+                    return buffer.getvalue(), "image/jpeg"
+
+            if side <= 256:
+                return buffer.getvalue(), "image/jpeg"
+            side = int(side * 0.75)
+
+
+class InterpretationCache:
+    """
+    In-memory LRU cache of results interpretations keyed by (image pixel digests, text output)
+
+    Only exact repeats hit: fix retries that reproduce the same figures and text reuse the
+    interpretation, while plots that merely look alike (the same embedding colored by another
+    gene) never share one.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image_digests, text_output):
+        return hashlib.sha256(text_output.encode("utf-8")).hexdigest(), tuple(image_digests)
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def clear(self):
+        self._entries.clear()
+
+    def put(self, key, interpretation):
+        self._entries[key] = interpretation
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,319 @@
+"""Kernel providers: where the agent's persistent kernels run.
+
+A provider hands out a (manager, client) pair for one analysis. The manager exposes the subset
+of jupyter_client's KernelManager the agent relies on (`is_alive()`, `shutdown_kernel(now)`),
+and the client is a regular blocking kernel client, so `run_last_cell` works unchanged for
+local and remote kernels.
+
+- LocalKernelProvider starts kernels on this machine. With `reported_memory` it can stand in
+  for a remote node when testing placement on a single machine.
+- ConnectionFileKernelProvider attaches over ZMQ to a kernel already running on another host
+  (e.g. started there with `jupyter kernel --KernelManager.connection_file=...` and reachable
+  directly or through SSH tunnels). Several agent processes may be given the same connection
+  file, so the kernel is claimed inside the kernel itself: the claim is a lease held in `sys`
+  (which survives `%reset`), renewed after each cell the owner runs and periodically while it
+  is idle. A claim whose owner crashed expires after its lease. The namespace is reset when
+  the kernel is claimed and when it is released.
+
+`place_kernel` picks the available provider with the most free memory.
+"""
+import ast
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Evaluated in a kernel to report the free memory of its host, in bytes
+FREE_MEMORY_EXPRESSION = (
+    "(lambda os: next((int(line.split()[1]) * 1024 for line in open('/proc/meminfo') "
+    "if line.startswith('MemAvailable:')), None) if os.path.exists('/proc/meminfo') "
+    "else os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))(__import__('os'))"
+)
+
+# Defined in a remote kernel with each claim request; returns the owner holding the claim afterwards
+CLAIM_HELPER = r'''
+def _cv_claim(owner, lease):
+    import sys, time
+    claim = getattr(sys, "_cv_claim", None)
+    if claim is not None and claim["owner"] != owner and claim["expires"] > time.time():
+        return claim["owner"]
+    if claim is None or claim["owner"] != owner:
+        if claim is not None:
+            # Take over an expired claim of an owner that is gone
+            try:
+                get_ipython().events.unregister("post_run_cell", claim["renew"])
+            except ValueError:
+                pass
+
+        def renew(*args):
+            current = getattr(sys, "_cv_claim", None)
+            if current is not None and current["owner"] == owner:
+                current["expires"] = time.time() + lease
+
+        # Cells run by the owner renew the lease as they finish, before any queued claim request runs
+        get_ipython().events.register("post_run_cell", renew)
+        claim = sys._cv_claim = {"owner": owner, "renew": renew}
+    claim["expires"] = time.time() + lease
+    return owner
+
+
+def _cv_release(owner):
+    import sys
+    claim = getattr(sys, "_cv_claim", None)
+    if claim is None or claim["owner"] != owner:
+        return False
+    try:
+        get_ipython().events.unregister("post_run_cell", claim["renew"])
+    except ValueError:
+        pass
+    del sys._cv_claim
+    return True
+'''
+
+# Evaluated in a kernel: owner of a live claim, or None
+CLAIMED_BY_EXPRESSION = (
+    "(lambda sys, time: (lambda claim: claim['owner'] if claim and claim['expires'] > time.time() else None)"
+    "(getattr(sys, '_cv_claim', None)))(__import__('sys'), __import__('time'))"
+)
+
+RESET_EXPRESSION = "get_ipython().run_line_magic('reset', '-f')"
+
+
+def local_free_memory():
+    """Available memory of this machine in bytes, or None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def evaluate(client, expression, timeout=10, code=""):
+    """Evaluate an expression (after running `code`) silently with a started client; returns its plain-text repr or None"""
+    msg_id = client.execute(code, silent=True, store_history=False, user_expressions={"value": expression})
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            msg = client.get_shell_msg(timeout=max(0.1, deadline - time.time()))
+        except Exception:
+            return None
+        if msg["parent_header"].get("msg_id") != msg_id:
+            continue
+        value = msg["content"].get("user_expressions", {}).get("value", {})
+        if value.get("status") != "ok":
+            return None
+        return value.get("data", {}).get("text/plain")
+    return None
+
+
+def _literal(text):
+    try:
+        return ast.literal_eval(text) if text is not None else None
+    except (ValueError, SyntaxError):
+        return None
+
+
+class KernelUnavailable(RuntimeError):
+    """The provider's kernel is held by this or another agent process and cannot be used now"""
+
+
+class KernelProvider:
+    """Interface of a source of kernels"""
+
+    name = "kernel"
+    is_local = False  # whether the kernel process runs on this machine (and can be pinned to CPUs)
+
+    def free_memory(self):
+        """
+        Free memory in bytes of the host the next kernel would run on, or None if it cannot be measured
+
+        Raises:
+            KernelUnavailable: If the provider's kernel is held by another run
+        """
+        raise NotImplementedError
+
+    def start(self, env=None):
+        """
+        Start or attach to a kernel
+
+        Returns:
+            tuple: (manager with is_alive() and shutdown_kernel(now), started and ready blocking client)
+        """
+        raise NotImplementedError
+
+
+class LocalKernelProvider(KernelProvider):
+    """Kernels started on this machine with jupyter_client's KernelManager"""
+
+    is_local = True
+
+    def __init__(self, kernel_name="python3", name="local", reported_memory=None):
+        """
+        Args:
+            kernel_name (str): Kernel spec to start
+            name (str): Label shown in logs
+            reported_memory (int): Free memory to report instead of measuring it, to stand in for
+                another node when testing placement on one machine
+        """
+        self.kernel_name = kernel_name
+        self.name = name
+        self.reported_memory = reported_memory
+
+    def free_memory(self):
+        return self.reported_memory if self.reported_memory is not None else local_free_memory()
+
+    def start(self, env=None):
+        from jupyter_client import KernelManager
+
+        manager = KernelManager(kernel_name=self.kernel_name)
+        manager.start_kernel(**({"env": env} if env is not None else {}))
+        client = manager.client()
+        client.start_channels()
+        client.wait_for_ready()
+        return manager, client
+
+
+class ConnectionFileKernelProvider(KernelProvider):
+    """A kernel already running on another host, reached through its connection file over ZMQ"""
+
+    def __init__(self, connection_file, name=None, ready_timeout=60, lease=300):
+        """
+        Args:
+            connection_file (str): Connection file of the running kernel
+            name (str): Label shown in logs (default: the file name)
+            ready_timeout (float): Seconds to wait for the kernel to answer
+            lease (float): Seconds a claim stays valid without being renewed
+        """
+        self.connection_file = connection_file
+        self.name = name or os.path.splitext(os.path.basename(connection_file))[0]
+        self.ready_timeout = ready_timeout
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.in_use = False
+
+    def _client(self):
+        from jupyter_client import BlockingKernelClient
+
+        client = BlockingKernelClient()
+        client.load_connection_file(self.connection_file)
+        client.start_channels()
+        client.wait_for_ready(timeout=self.ready_timeout)
+        return client
+
+    def free_memory(self):
+        if self.in_use:
+            raise KernelUnavailable(f"kernel {self.name} is in use by this process")
+        client = self._client()
+        try:
+            owner = _literal(evaluate(client, CLAIMED_BY_EXPRESSION))
+            if owner not in (None, self.owner):
+                raise KernelUnavailable(f"kernel {self.name} is in use by {owner}")
+            value = evaluate(client, FREE_MEMORY_EXPRESSION)
+        finally:
+            client.stop_channels()
+        try:
+            return int(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def claim(self, client):
+        """Claim (or renew the claim on) the kernel; returns the owner holding it afterwards"""
+        return _literal(evaluate(client, f"_cv_claim({self.owner!r}, {float(self.lease)!r})", code=CLAIM_HELPER))
+
+    def release(self, client):
+        evaluate(client, f"_cv_release({self.owner!r})", code=CLAIM_HELPER)
+
+    def start(self, env=None):
+        # The remote kernel was started with its own environment; `env` only applies to local kernels
+        client = self._client()
+        owner = self.claim(client)
+        if owner != self.owner:
+            client.stop_channels()
+            raise KernelUnavailable(f"kernel {self.name} is in use by {owner or 'another process (no reply to the claim)'}")
+        # Start from an empty namespace, even if a previous run crashed without releasing it
+        evaluate(client, RESET_EXPRESSION)
+        self.in_use = True
+        return RemoteKernelHandle(self, client), client
+
+
+class RemoteKernelHandle:
+    """Manager-like handle for an attached remote kernel; liveness comes from its heartbeat"""
+
+    def __init__(self, provider, client):
+        self.provider = provider
+        self.client = client
+        # Renew the claim while the agent is busy elsewhere (e.g. waiting for the LLM) on a separate client
+        self._stop = threading.Event()
+        self._renewer = threading.Thread(target=self._renew, name=f"kernel-claim-{provider.name}", daemon=True)
+        self._renewer.start()
+
+    def _renew(self):
+        client = None
+        try:
+            client = self.provider._client()
+            while not self._stop.wait(self.provider.lease / 5):
+                owner = self.provider.claim(client)
+                if owner not in (None, self.provider.owner):
+                    print(f"⚠️ Warning: claim on kernel {self.provider.name} was taken over by {owner}")
+                    return
+        except Exception as e:
+            print(f"⚠️ Warning: Could not renew the claim on kernel {self.provider.name}: {e}")
+        finally:
+            if client is not None:
+                client.stop_channels()
+
+    def is_alive(self):
+        return self.client.is_alive()
+
+    def shutdown_kernel(self, now=False):
+        """Leave the kernel running on its host for the next analysis, but clear its namespace and release it"""
+        self._stop.set()
+        try:
+            client = self.provider._client()
+            try:
+                if _literal(evaluate(client, CLAIMED_BY_EXPRESSION)) == self.provider.owner:
+                    evaluate(client, RESET_EXPRESSION)
+                    self.provider.release(client)
+            finally:
+                client.stop_channels()
+        finally:
+            self.provider.in_use = False
+
+
+def place_kernel(providers):
+    """
+    Choose the provider with the most free memory
+
+    Raises:
+        RuntimeError: If no provider can host a kernel
+    """
+    best, best_memory = None, -1
+    held = []
+    for provider in providers:
+        try:
+            memory = provider.free_memory()
+        except KernelUnavailable as e:
+            print(f"⚠️ Kernel provider {provider.name} unavailable: {e}")
+            held.append(provider)
+            continue
+        except Exception as e:
+            print(f"⚠️ Kernel provider {provider.name} unavailable: {e}")
+            continue
+        if memory is None:
+            continue
+        if memory > best_memory:
+            best, best_memory = provider, memory
+    if best is None:
+        # Providers that cannot measure memory are still usable when nothing else is, unlike held kernels
+        best = next((provider for provider in providers
+                     if provider not in held and not getattr(provider, "in_use", False)), None)
+    if best is None:
+        raise RuntimeError("No kernel provider is available")
+    return best
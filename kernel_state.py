@@ -0,0 +1,268 @@
+"""Per-step checkpoints of the kernel namespace, restored before each fix attempt.
+
+A step that raises part-way may already have rebound, deleted or mutated variables (e.g.
+normalized `adata.X` in place). The helper below is defined inside the kernel. A checkpoint
+keeps a reference and a fingerprint of every user variable, which is enough to undo
+rebinding and deletion and to detect in-place changes. Copies are only taken of the
+variables the step's code may modify in place, found from its AST (`mutated_names`), and
+only up to a size cap. Each fix attempt extends the checkpoint with the variables its code
+may modify, as long as they are still unchanged. AnnData objects are copied structurally:
+X, obs, var and uns are copied, while layers, obsm, varm and obsp arrays are shared and only
+their mappings are copied, since code replaces those entries rather than writing into them.
+A rollback restores rebound and deleted names, drops names the step introduced, and
+re-copies only the objects whose fingerprint changed.
+"""
+import ast
+import builtins
+
+# Calls that modify AnnData arguments in place (unless copy=True): preprocessing, tools, model setup
+MUTATING_CALL_PREFIXES = ("sc.pp.", "sc.tl.", "sc.external.pp.", "sc.external.tl.", "scanpy.pp.", "scanpy.tl.",
+                          "scvi.model.")
+
+# Methods that modify their receiver in place
+MUTATING_METHODS = {
+    "append", "extend", "insert", "pop", "popitem", "remove", "clear", "update", "setdefault", "sort",
+    "reverse", "add", "discard", "obs_names_make_unique", "var_names_make_unique", "strings_to_categoricals",
+    "rename_categories", "_inplace_subset_obs", "_inplace_subset_var",
+}
+
+KERNEL_HELPER = r'''
+def _cv_fingerprint(value):
+    import hashlib
+    import numpy as np
+    digest = hashlib.blake2b(digest_size=16)
+
+    def add_array(array):
+        array = np.asarray(array)
+        digest.update(repr((array.shape, str(array.dtype))).encode())
+        flat = array.reshape(-1)
+        # Hash large arrays on a strided sample so fingerprints stay cheap
+        step = max(1, flat.size // 2_000_000)
+        digest.update(np.ascontiguousarray(flat[::step]).tobytes())
+
+    def add(value):
+        try:
+            import scipy.sparse as sparse
+            if sparse.issparse(value):
+                digest.update(repr(value.shape).encode())
+                add_array(value.data)
+                add_array(value.indices if hasattr(value, "indices") else value.nnz)
+                return
+        except ImportError:
+            pass
+        import pandas as pd
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            digest.update(repr((value.shape, list(getattr(value, "columns", [])))).encode())
+            digest.update(repr(pd.util.hash_pandas_object(value, index=True).sum()).encode())
+            if isinstance(value, pd.DataFrame):
+                digest.update(repr(list(value.dtypes.astype(str))).encode())
+        elif isinstance(value, np.ndarray):
+            add_array(value)
+        elif type(value).__name__ == "AnnData":
+            digest.update(repr((value.shape, value.is_view)).encode())
+            if value.X is not None:
+                add(value.X)
+            add(value.obs)
+            add(value.var)
+            for mapping in (value.obsm, value.varm, value.obsp, value.layers):
+                digest.update(repr([(key, id(item)) for key, item in mapping.items()]).encode())
+            digest.update(repr(sorted((key, id(item)) for key, item in value.uns.items())).encode())
+        elif isinstance(value, (list, dict, set)):
+            digest.update(repr(value).encode()[:1_000_000])
+        else:
+            digest.update(repr(id(value)).encode())
+
+    add(value)
+    return digest.hexdigest()
+
+
+def _cv_nbytes(value):
+    import sys
+    import numpy as np
+    if type(value).__name__ == "AnnData":
+        return _cv_nbytes(value.X) + _cv_nbytes(value.obs) + _cv_nbytes(value.var)
+    if hasattr(value, "memory_usage") and hasattr(value, "columns"):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "data") and hasattr(value, "nnz"):
+        return value.data.nbytes + getattr(value, "indices", value.data).nbytes
+    return sys.getsizeof(value)
+
+
+def _cv_copy(value):
+    import copy
+    if type(value).__name__ == "AnnData":
+        import anndata
+        if value.is_view:
+            return value.copy()
+        X = value.X.copy() if value.X is not None else None
+        return anndata.AnnData(X=X, obs=value.obs.copy(), var=value.var.copy(), uns=copy.deepcopy(dict(value.uns)),
+                               obsm=dict(value.obsm), varm=dict(value.varm), obsp=dict(value.obsp),
+                               layers=dict(value.layers), raw=value.raw)
+    if hasattr(value, "copy"):
+        return value.copy()
+    return copy.deepcopy(value)
+
+
+def _cv_tracked(value):
+    import types
+    if isinstance(value, (types.ModuleType, types.FunctionType, type)):
+        return False
+    try:
+        import numpy as np
+        import pandas as pd
+        if isinstance(value, (np.ndarray, pd.DataFrame, pd.Series)):
+            return True
+    except ImportError:
+        pass
+    if type(value).__name__ == "AnnData" or hasattr(value, "nnz"):
+        return True
+    return isinstance(value, (list, dict, set))
+
+
+_CV_IGNORED = {"In", "Out", "exit", "quit", "get_ipython"}
+
+
+def _cv_user_names():
+    return [name for name in globals() if not name.startswith("_") and name not in _CV_IGNORED]
+
+
+def _cv_checkpoint(max_bytes, names, extend=False):
+    import json
+    state = globals().get("_cv_state") if extend else None
+    if state is None:
+        state = {"refs": {}, "copies": {}, "fingerprints": {}, "uncopied": []}
+        for name in _cv_user_names():
+            value = globals()[name]
+            state["refs"][name] = value
+            if _cv_tracked(value):
+                try:
+                    state["fingerprints"][name] = _cv_fingerprint(value)
+                except Exception:
+                    pass
+        globals()["_cv_state"] = state
+    copied, uncopied = [], []
+    for name in names:
+        if name in state["copies"] or name in state["uncopied"] or name not in state["fingerprints"]:
+            continue
+        value = globals().get(name)
+        try:
+            # A variable changed since the checkpoint can no longer provide its pre-step state
+            if extend and (value is not state["refs"][name] or _cv_fingerprint(value) != state["fingerprints"][name]):
+                continue
+            if _cv_nbytes(value) <= max_bytes:
+                state["copies"][name] = _cv_copy(value)
+                copied.append(name)
+            else:
+                uncopied.append(name)
+        except Exception:
+            uncopied.append(name)
+    state["uncopied"].extend(uncopied)
+    return json.dumps({"variables": len(state["refs"]), "copied": sorted(copied), "uncopied": uncopied})
+
+
+def _cv_rollback():
+    import json
+    import types
+    state = globals().get("_cv_state")
+    if state is None:
+        return json.dumps(None)
+    removed, rebound, restored, unrecoverable = [], [], [], []
+    for name in _cv_user_names():
+        if name not in state["refs"] and not isinstance(globals()[name], types.ModuleType):
+            del globals()[name]
+            removed.append(name)
+    for name, value in state["refs"].items():
+        if globals().get(name, None) is not value or name not in globals():
+            globals()[name] = value
+            rebound.append(name)
+        if name not in state["fingerprints"]:
+            continue
+        try:
+            changed = _cv_fingerprint(value) != state["fingerprints"][name]
+        except Exception:
+            changed = True
+        if not changed:
+            continue
+        if name in state["copies"]:
+            # Keep the checkpoint pristine for later rollbacks: restore a copy of the copy
+            restored_value = _cv_copy(state["copies"][name])
+            globals()[name] = restored_value
+            state["refs"][name] = restored_value
+            state["fingerprints"][name] = _cv_fingerprint(restored_value)
+            restored.append(name)
+        else:
+            unrecoverable.append(name)
+    return json.dumps({"removed": removed, "rebound": rebound, "restored": restored,
+                       "unrecoverable": unrecoverable})
+'''
+
+
+def _root_name(node):
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _dotted_name(node):
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return ""
+    return ".".join([node.id] + parts[::-1])
+
+
+def mutated_names(code):
+    """
+    Variables that `code` may modify in place (rather than only rebind), from its AST
+
+    Covers item/attribute assignment and deletion (`adata.obs["x"] = ...`), augmented assignment
+    (`X += 1`), mutating methods (`cells.append(...)`, `inplace=True`, `out=`), scanpy/scvi
+    functions that modify their AnnData arguments, and arguments passed to user-defined
+    functions. Code that does not parse modifies nothing.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return []
+    names = set()
+
+    def add(node):
+        name = _root_name(node)
+        if name is not None:
+            names.add(name)
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Assign, ast.AnnAssign, ast.Delete)):
+            targets = node.targets if isinstance(node, (ast.Assign, ast.Delete)) else [node.target]
+            for target in targets:
+                for element in (target.elts if isinstance(target, (ast.Tuple, ast.List)) else [target]):
+                    if isinstance(element, (ast.Attribute, ast.Subscript)):
+                        add(element)
+        elif isinstance(node, ast.AugAssign):
+            add(node.target)
+        elif isinstance(node, ast.Call):
+            function = _dotted_name(node.func)
+            for keyword in node.keywords:
+                if keyword.arg == "out":
+                    add(keyword.value)
+                elif keyword.arg == "inplace" and isinstance(node.func, ast.Attribute):
+                    add(node.func.value)
+            if isinstance(node.func, ast.Attribute) and node.func.attr in MUTATING_METHODS:
+                add(node.func.value)
+            user_function = isinstance(node.func, ast.Name) and not hasattr(builtins, node.func.id)
+            if user_function or function.startswith(MUTATING_CALL_PREFIXES):
+                for argument in list(node.args) + [keyword.value for keyword in node.keywords]:
+                    add(argument)
+    return sorted(names)
+
+
+def checkpoint_expression(max_bytes, names=(), extend=False):
+    """Kernel expression checkpointing the namespace and copying `names` (adding to the last checkpoint if `extend`)"""
+    return f"_cv_checkpoint({int(max_bytes)}, {list(names)!r}, {bool(extend)!r})"
+
+
+ROLLBACK_EXPRESSION = "_cv_rollback()"
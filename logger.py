@@ -1,67 +1,245 @@
-import os
+"""Per-agent structured event log, written off the calling thread.
+
+Every record is an event with a type, the current analysis/step ids and its own fields
+(timings, token counts, texts). Records are put on a queue and a QueueListener thread writes
+them as JSON lines to `{analysis_name}_events_{timestamp}.jsonl` and, readably, to the
+`.log` file next to it. Each Logger has its own (non-propagating) logging.Logger, so several
+agents in one process keep separate logs.
+
+Logged prompts are stored in the content-addressed blob store (blob_store.py) in `blobs/`
+next to the logs; their events reference the stored parts, so repeated context is written once.
+
+`read_events` and `summarize_events` read an event log back; from the command line:
+
+    python logger.py logs/covid19_events_20250101_120000.jsonl [--event llm_call] [--analysis 2] [--show]
+"""
+import argparse
+import atexit
 import datetime
+import itertools
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from blob_store import BlobStore, store_messages
+
+_instance_ids = itertools.count(1)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """Formats the event attached to a record as one JSON line"""
+
+    def format(self, record):
+        event = getattr(record, "event", None) or {"ts": record.created, "event": "message",
+                                                   "text": record.getMessage()}
+        return json.dumps(event, default=str, ensure_ascii=False)
+
 
 class Logger:
-    """Minimalist logger to track prompts and analysis outputs"""
-    
+    """Minimalist logger to track prompts, analysis outputs and structured events"""
+
     def __init__(self, analysis_name, log_dir="logs"):
         # Create log directory if it doesn't exist
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-            
-        # Create timestamp for this run
+        os.makedirs(log_dir, exist_ok=True)
+
+        # Create timestamp for this run; agents started in the same second get distinct files
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.log_file = os.path.join(log_dir, f"{analysis_name}_log_{timestamp}.log")
-        
-        # Set up logger
-        self.logger = logging.getLogger("agent_logger")
+        suffix = ""
+        for n in itertools.count(2):
+            if not os.path.exists(os.path.join(log_dir, f"{analysis_name}_events_{timestamp}{suffix}.jsonl")):
+                break
+            suffix = f"_{n}"
+        self.log_file = os.path.join(log_dir, f"{analysis_name}_log_{timestamp}{suffix}.log")
+        self.event_file = os.path.join(log_dir, f"{analysis_name}_events_{timestamp}{suffix}.jsonl")
+
+        # Set up a logger owned by this instance
+        self.logger = logging.getLogger(f"cellvoyager.agent.{next(_instance_ids)}")
         self.logger.setLevel(logging.INFO)
-        
-        # Clear any existing handlers
-        if self.logger.handlers:
-            self.logger.handlers.clear()
-        
-        # Create file handler
+        self.logger.propagate = False
+
+        # Create file handlers: readable log (rotated) and JSONL events
         file_handler = RotatingFileHandler(
-            self.log_file, 
+            self.log_file,
             maxBytes=50*1024*1024,  # 50MB max file size
             backupCount=5
         )
-        
+
         # Create formatter for clean, readable logs
         formatter = logging.Formatter(
-            "\n\n" + "="*80 + "\n%(asctime)s - %(levelname)s\n" + 
+            "\n\n" + "="*80 + "\n%(asctime)s - %(levelname)s\n" +
             "="*80 + "\n%(message)s"
         )
-        
+
         file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
-        
+        event_handler = logging.FileHandler(self.event_file, encoding="utf-8")
+        event_handler.setFormatter(JSONLinesFormatter())
+
+        # Callers only enqueue records; formatting and file I/O happen on the listener thread
+        self._queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(self._queue))
+        self._handlers = (file_handler, event_handler)
+        self._listener = QueueListener(self._queue, *self._handlers)
+        self._listener.start()
+        self._closed = False
+        atexit.register(self.close)
+
+        # Ids added to every event (analysis, step)
+        self.context = {}
+
+        # Prompt texts are stored once by content, shared by all runs logging to this directory
+        self.blobs = BlobStore(os.path.join(log_dir, "blobs"))
+
         # Log initialization
-        self.logger.info(f"Logging started. Log file: {self.log_file}")
-    
+        self.log_event("log_started", text=f"Logging started. Log file: {self.log_file}", event_file=self.event_file)
+
+    def set_context(self, **ids):
+        """Set ids added to all later events (e.g. analysis=2, step=3); None removes an id"""
+        for key, value in ids.items():
+            if value is None:
+                self.context.pop(key, None)
+            else:
+                self.context[key] = value
+
+    def log_event(self, event, text=None, level=logging.INFO, **fields):
+        """
+        Record a structured event
+
+        Args:
+            event (str): Event type (e.g. "llm_call", "cell_executed")
+            text (str): Free text, also shown in the readable log
+            level (int): Logging level
+            **fields: JSON-serializable fields (ids, timings in seconds, token counts, ...)
+        """
+        record = {"ts": round(time.time(), 3), "event": event, **self.context, **fields}
+        if text is not None:
+            record["text"] = text
+        if text is None:
+            # Blob references and other structured fields are only kept in the JSONL events
+            details = ", ".join(f"{key}={value}" for key, value in fields.items() if not isinstance(value, (list, dict)))
+            text = f"{event.upper()}" + (f": {details}" if details else "")
+        self.logger.log(level, text, extra={"event": record})
+
+    @contextmanager
+    def timed(self, event, **fields):
+        """Log `event` with its duration (`duration_s`) when the block exits; the yielded dict adds fields"""
+        extra = {}
+        start = time.perf_counter()
+        try:
+            yield extra
+        except Exception as e:
+            extra.setdefault("error", f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self.log_event(event, duration_s=round(time.perf_counter() - start, 3), **fields, **extra)
+
     def log_prompt(self, role, prompt_text, prompt_name=""):
-        """Log a prompt sent to the model"""
+        """Log a prompt sent to the model (stored in the blob store, referenced by the event)"""
         header = f"PROMPT: {prompt_name}" if prompt_name else "PROMPT"
-        self.logger.info(f"{header} ({role})\n\n{prompt_text}")
-    
+        messages = store_messages(self.blobs, [{"role": role, "content": prompt_text}])
+        self.log_event("prompt", text=f"{header} ({role}) [{self._digest_summary(messages)}]", role=role,
+                       name=prompt_name, messages=messages)
+
+    def message_refs(self, messages):
+        """Store chat messages in the blob store; returns the references to put in an event"""
+        return store_messages(self.blobs, messages)
+
+    def _digest_summary(self, refs):
+        digests = [digest for ref in refs for digest in ref.get("parts", [])]
+        return ", ".join(digest[:12] for digest in digests[:4]) + (", ..." if len(digests) > 4 else "")
+
     def log_response(self, response_text, source="model"):
         """Log a response from the model or analysis output"""
-        self.logger.info(f"RESPONSE/OUTPUT: {source}\n\n{response_text}")
-    
+        self.log_event("response", text=f"RESPONSE/OUTPUT: {source}\n\n{response_text}", source=source)
+
     def log_code(self, code, iteration=None, analysis=None):
         """Log code generated or executed"""
-        self.logger.info(f"CODE\n\n```python\n{code}\n```")
-    
+        self.log_event("code", text=f"CODE\n\n```python\n{code}\n```", iteration=iteration)
+
     def format_traceback(self, error_name, error_value, traceback):
         """Format error information for error messages"""
         return f"ERROR: {error_name}: {error_value}\n\n{traceback}"
-    
+
     def log_error(self, error_msg, code=None):
         """Log critical errors that need investigation"""
         msg = f"ERROR\n\n{error_msg}"
         if code:
             msg += f"\n\nIn code:\n```python\n{code}\n```"
-        self.logger.error(msg)
\ No newline at end of file
+        self.log_event("error", text=msg, level=logging.ERROR)
+
+    def close(self):
+        """Flush the queued records and close the log files"""
+        if self._closed:
+            return
+        self._closed = True
+        self._listener.stop()
+        for handler in self._handlers:
+            handler.close()
+        atexit.unregister(self.close)
+
+
+def read_events(path, event=None, **filters):
+    """
+    Iterate over the events of a JSONL event log
+
+    Args:
+        path (str): Event log written by Logger
+        event (str): Only events of this type
+        **filters: Only events whose fields have these values (e.g. analysis=2)
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # partially written last line
+            if event is not None and record.get("event") != event:
+                continue
+            if any(record.get(key) != value for key, value in filters.items()):
+                continue
+            yield record
+
+
+def summarize_events(events):
+    """Count, total duration and token counts per event type (and call type), as a plain-text table"""
+    rows = OrderedDict()
+    for record in events:
+        key = record["event"] + (f"/{record['call_type']}" if "call_type" in record else "")
+        row = rows.setdefault(key, {"count": 0, "duration_s": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+        row["count"] += 1
+        for field in ("duration_s", "prompt_tokens", "completion_tokens"):
+            if isinstance(record.get(field), (int, float)):
+                row[field] += record[field]
+    lines = [f"{'event':<28} {'count':>6} {'seconds':>9} {'prompt tok':>11} {'output tok':>11}"]
+    for key, row in rows.items():
+        lines.append(f"{key:<28} {row['count']:>6} {row['duration_s']:>9.1f} {row['prompt_tokens']:>11} "
+                     f"{row['completion_tokens']:>11}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize or print a CellVoyager event log")
+    parser.add_argument("path", help="JSONL event log")
+    parser.add_argument("--event", help="Only events of this type")
+    parser.add_argument("--analysis", type=int, help="Only events of this analysis")
+    parser.add_argument("--step", type=int, help="Only events of this step")
+    parser.add_argument("--show", action="store_true", help="Print the events (texts shortened) instead of a summary")
+    args = parser.parse_args()
+
+    filters = {key: value for key, value in (("analysis", args.analysis), ("step", args.step)) if value is not None}
+    events = read_events(args.path, event=args.event, **filters)
+    if not args.show:
+        print(summarize_events(events))
+        return
+    for record in events:
+        if "text" in record and len(record["text"]) > 200:
+            record["text"] = record["text"][:200] + "..."
+        print(json.dumps(record, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""Prometheus-style operational metrics of a running agent.
+
+Counters and histograms are updated in-process by the agent (LLM calls, cell executions, fix
+attempts, kernel restarts, cache lookups, saved notebooks) and rendered in the Prometheus text
+exposition format, either served on a local HTTP endpoint for scraping or written periodically
+to a file for node_exporter's textfile collector:
+
+    python run.py ... --metrics-port 9464          # curl localhost:9464/metrics
+    python run.py ... --metrics-textfile /var/lib/node_exporter/textfile/cellvoyager.prom
+"""
+import math
+import os
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Histogram bucket upper bounds (a +Inf bucket is always added)
+LLM_SECONDS_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+KERNEL_SECONDS_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600)
+NOTEBOOK_BYTES_BUCKETS = (10e3, 100e3, 500e3, 1e6, 5e6, 20e6, 100e6)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = None
+    suffix = ""  # appended to the name to form the family name of the HELP and TYPE lines
+
+    def __init__(self, name, documentation, labels, lock):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = lock
+        self._values = {}  # label values -> value (counter) or [bucket counts, sum, count] (histogram)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self, const_labels):
+        family = self.name + self.suffix
+        lines = [f"# HELP {family} {self.documentation}", f"# TYPE {family} {self.kind}"]
+        with self._lock:
+            # Snapshot histogram states, which observe() updates in place
+            items = [(key, [list(value[0]), value[1], value[2]] if isinstance(value, list) else value)
+                     for key, value in sorted(self._values.items())]
+        for key, value in items:
+            lines.extend(self._samples(const_labels + tuple(zip(self.labels, key)), value))
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count per label combination"""
+
+    kind = "counter"
+    suffix = "_total"  # counter samples are <name>_total, so their family must be too
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self, pairs, value):
+        return [f"{self.name}_total{_format_labels(pairs)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (cumulative buckets, sum and count) per label combination"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels, lock, buckets):
+        super().__init__(name, documentation, labels, lock)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, pairs, state):
+        counts, total, count = state
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(pairs + (('le', _format_value(bound)),))} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(pairs)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """A set of metrics rendered together, exposed over HTTP and/or as a textfile"""
+
+    def __init__(self, const_labels=None):
+        """
+        Args:
+            const_labels (dict): Labels added to every sample (e.g. the analysis name)
+        """
+        self.const_labels = tuple(sorted((const_labels or {}).items()))
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._textfile = None
+        self._stop = threading.Event()
+        self._writer = None
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels, self._lock)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=KERNEL_SECONDS_BUCKETS):
+        metric = Histogram(name, documentation, labels, self._lock, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(self.const_labels))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics to `path` atomically (textfile collectors may read it at any time)"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics at http://host:port/metrics from a daemon thread; returns the bound port"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes would otherwise be printed to stderr
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        return self._server.server_address[1]
+
+    def start_textfile(self, path, interval=15):
+        """Rewrite the textfile at `path` every `interval` seconds, and once more on close()"""
+        self._textfile = path
+
+        def write_periodically():
+            while not self._stop.wait(interval):
+                try:
+                    self.write_textfile(path)
+                except OSError as e:
+                    print(f"⚠️ Warning: Could not write metrics to {path}: {e}")
+
+        self.write_textfile(path)
+        self._writer = threading.Thread(target=write_periodically, name="metrics-textfile", daemon=True)
+        self._writer.start()
+
+    def close(self):
+        """Stop the HTTP endpoint and the textfile writer, writing the final values"""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._textfile is not None:
+            try:
+                self.write_textfile(self._textfile)
+            except OSError as e:
+                print(f"⚠️ Warning: Could not write metrics to {self._textfile}: {e}")
+            self._textfile = None
+
+
+class AgentMetrics(MetricsRegistry):
+    """The metrics recorded by AnalysisAgent"""
+
+    def __init__(self, const_labels=None):
+        super().__init__(const_labels)
+        self.llm_seconds = self.histogram("cellvoyager_llm_request_duration_seconds",
+                                          "Latency of LLM requests", ("call_type", "model"), LLM_SECONDS_BUCKETS)
+        self.llm_tokens = self.counter("cellvoyager_llm_tokens",
+                                       "Tokens of LLM requests (kind: prompt, completion, cached prompt)",
+                                       ("call_type", "kind"))
+        self.llm_errors = self.counter("cellvoyager_llm_errors", "LLM requests that raised", ("call_type",))
+        self.cell_seconds = self.histogram("cellvoyager_cell_execution_duration_seconds",
+                                           "Execution time of notebook cells (status: ok, error, timeout)",
+                                           ("status",), KERNEL_SECONDS_BUCKETS)
+        self.timeouts = self.counter("cellvoyager_timeouts", "Operations abandoned after their timeout",
+                                     ("operation",))
+        self.kernel_restarts = self.counter("cellvoyager_kernel_restarts",
+                                            "Kernel restarts after a crash, by whether the replay succeeded",
+                                            ("outcome",))
+        self.fix_attempts = self.counter("cellvoyager_fix_attempts",
+                                         "Fix attempts (source: llm, fix_memory or a rule name) by outcome",
+                                         ("source", "outcome"))
+        self.cache_lookups = self.counter("cellvoyager_cache_lookups", "Cache lookups by cache and result",
+                                          ("cache", "result"))
+        self.notebook_bytes = self.histogram("cellvoyager_notebook_size_bytes", "Size of saved notebooks", (),
+                                             NOTEBOOK_BYTES_BUCKETS)
+
+    def record_llm_call(self, call_type, model, seconds, prompt_tokens, completion_tokens=None,
+                        cached_tokens=None, error=False):
+        self.llm_seconds.observe(seconds, call_type=call_type, model=model)
+        for kind, tokens in (("prompt", prompt_tokens), ("completion", completion_tokens), ("cached", cached_tokens)):
+            if tokens:
+                self.llm_tokens.inc(tokens, call_type=call_type, kind=kind)
+        if error:
+            self.llm_errors.inc(call_type=call_type)
+
+    def record_cache(self, cache, hit):
+        self.cache_lookups.inc(cache=cache, result="hit" if hit else "miss")
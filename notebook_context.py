@@ -0,0 +1,123 @@
+import hashlib
+import re
+
+
+def estimate_tokens(text):
+    """Rough token estimate used when no tokenizer is supplied"""
+    return len(text) // 4
+
+
+class NotebookContext:
+    """Incrementally maintained, token-budgeted digest of the analysis notebook.
+
+    The most recent cells are kept verbatim while older cells are replaced by short
+    summaries that are computed once per cell and cached. The digest for a given
+    notebook state is memoized so every prompt built during a step shares it.
+    """
+
+    CELL_TYPES = ('code', 'markdown', 'error')
+
+    def __init__(self, token_budget=6000, recent_cells=6, summary_chars=300, count_tokens=None):
+        """
+        Args:
+            token_budget (int): Maximum number of tokens the digest may use
+            recent_cells (int): Number of most recent cells to keep verbatim (budget permitting)
+            summary_chars (int): Maximum length of the summary kept for an older cell
+            count_tokens (callable): Function returning the token count of a string
+        """
+        self.token_budget = token_budget
+        self.recent_cells = recent_cells
+        self.summary_chars = summary_chars
+        self.count_tokens = count_tokens or estimate_tokens
+
+        self._summaries = {}  # cell hash -> compressed summary
+        self._last_key = None
+        self._last_digest = ""
+
+    def reset(self):
+        """Forget cached summaries, e.g. when a new analysis (notebook) starts"""
+        self._summaries.clear()
+        self._last_key = None
+        self._last_digest = ""
+
+    def digest(self, notebook_cells):
+        """Return the notebook digest, reusing the previous one if the notebook is unchanged"""
+        if notebook_cells is None:
+            return ""
+
+        cells = [(cell['cell_type'], cell['source']) for cell in notebook_cells
+                 if cell['cell_type'] in self.CELL_TYPES]
+        hashes = tuple(self._hash_cell(cell_type, source) for cell_type, source in cells)
+        if hashes == self._last_key:
+            return self._last_digest
+
+        self._last_digest = self._build_digest(cells, hashes)
+        self._last_key = hashes
+        return self._last_digest
+
+    def _build_digest(self, cells, hashes):
+        # Walk from the newest cell backwards so recent cells get the budget first
+        remaining = self.token_budget
+        parts = []
+        omitted = 0
+        for position, ((cell_type, source), cell_hash) in enumerate(zip(reversed(cells), reversed(hashes))):
+            if omitted:
+                omitted += 1
+                continue
+
+            text = None
+            if position < self.recent_cells:
+                verbatim = f"{source}\n"
+                cost = self.count_tokens(verbatim)
+                if cost <= remaining:
+                    text = verbatim
+                    remaining -= cost
+
+            if text is None:
+                summary = f"{self._summarize(cell_type, source, cell_hash)}\n"
+                cost = self.count_tokens(summary)
+                if cost <= remaining:
+                    text = summary
+                    remaining -= cost
+                else:
+                    omitted = 1
+                    continue
+
+            parts.append(text)
+
+        if omitted:
+            parts.append(f"...({omitted} earlier cells omitted)...\n")
+
+        return "".join(reversed(parts))
+
+    def _summarize(self, cell_type, source, cell_hash):
+        summary = self._summaries.get(cell_hash)
+        if summary is None:
+            if cell_type == 'code':
+                summary = self._summarize_code(source)
+            else:
+                summary = "[summary] " + " ".join(source.split())
+            if len(summary) > self.summary_chars:
+                summary = summary[:self.summary_chars] + "..."
+            self._summaries[cell_hash] = summary
+        return summary
+
+    def _summarize_code(self, source):
+        """Keep the comments and the distinct calls made by a code cell"""
+        comments = [line.strip().lstrip('#').strip() for line in source.splitlines()
+                    if line.strip().startswith('#') and line.strip().lstrip('#').strip()]
+        calls = []
+        for name in re.findall(r'\b([A-Za-z_][\w.]*)\(', source):
+            if name not in calls and name not in ('print', 'len', 'str', 'int', 'float', 'range', 'list', 'dict'):
+                calls.append(name)
+
+        summary = "[summarized code cell]"
+        if comments:
+            summary += " " + "; ".join(comments)
+        if calls:
+            summary += " | calls: " + ", ".join(calls[:12])
+        return summary
+
+    @staticmethod
+    def _hash_cell(cell_type, source):
+        return hashlib.sha1(f"{cell_type}\0{source}".encode('utf-8')).hexdigest()
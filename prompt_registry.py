@@ -0,0 +1,113 @@
+import os
+import string
+
+
+def _escape(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def template_fields(text):
+    """Return the set of placeholder names used in a str.format template"""
+    return {field for _, field, _, _ in string.Formatter().parse(text) if field}
+
+
+def prerender(text, static_values):
+    """
+    Substitute the static placeholders of a template and keep the remaining ones,
+    returning a template that can still be filled in with str.format
+    """
+    rendered = []
+    for literal, field, format_spec, conversion in string.Formatter().parse(text):
+        rendered.append(_escape(literal))
+        if field is None:
+            continue
+        if field in static_values:
+            value = static_values[field]
+            if conversion:
+                value = {"r": repr, "s": str, "a": ascii}[conversion](value)
+            rendered.append(_escape(format(value, format_spec or "")))
+        else:
+            rendered.append("{" + field + (f"!{conversion}" if conversion else "") + (f":{format_spec}" if format_spec else "") + "}")
+    return "".join(rendered)
+
+
+class PromptRegistry:
+    """Prompt templates loaded once, validated up front and pre-rendered with static values.
+
+    Each template is declared with the dynamic fields the caller supplies at render time.
+    Any placeholder that is neither static nor declared, and any declared field missing
+    from the template, is reported when the registry is built rather than mid-run.
+    """
+
+    def __init__(self, prompt_dir, specs, static_values=None, hot_reload=False):
+        """
+        Args:
+            prompt_dir (str): Directory containing the prompt templates
+            specs (dict): Template name -> (path relative to prompt_dir, tuple of dynamic fields)
+            static_values (dict): Values substituted once when the templates are loaded
+            hot_reload (bool): Re-read a template when its file changes (for prompt engineering)
+        """
+        self.prompt_dir = prompt_dir
+        self.specs = specs
+        self.static_values = dict(static_values or {})
+        self.hot_reload = hot_reload
+
+        self._templates = {}
+        self._mtimes = {}
+        errors = []
+        for name in specs:
+            try:
+                self._load(name)
+            except ValueError as e:
+                errors.append(str(e))
+        if errors:
+            raise ValueError("Invalid prompt templates:\n" + "\n".join(errors))
+
+    def _path(self, name):
+        return os.path.join(self.prompt_dir, self.specs[name][0])
+
+    def _load(self, name):
+        path = self._path(name)
+        try:
+            with open(path) as f:
+                text = f.read()
+        except OSError as e:
+            raise ValueError(f"{name}: cannot read {path} ({e})")
+
+        dynamic_fields = set(self.specs[name][1])
+        try:
+            fields = template_fields(text)
+        except ValueError as e:
+            raise ValueError(f"{name}: malformed template {path} ({e})")
+        unknown = fields - dynamic_fields - set(self.static_values)
+        missing = dynamic_fields - fields
+        if unknown or missing:
+            problems = []
+            if unknown:
+                problems.append(f"unknown placeholders {sorted(unknown)}")
+            if missing:
+                problems.append(f"missing placeholders {sorted(missing)}")
+            raise ValueError(f"{name} ({path}): " + ", ".join(problems))
+
+        self._templates[name] = prerender(text, self.static_values)
+        self._mtimes[name] = os.path.getmtime(path)
+
+    def _maybe_reload(self, name):
+        try:
+            mtime = os.path.getmtime(self._path(name))
+        except OSError:
+            return
+        if mtime != self._mtimes[name]:
+            try:
+                self._load(name)
+                print(f"🔄 Reloaded prompt template: {name}")
+            except ValueError as e:
+                # Keep serving the last valid version while the template is being edited
+                self._mtimes[name] = mtime
+                print(f"⚠️ Keeping previous prompt template after failed reload: {e}")
+
+    def render(self, name, **values):
+        """Fill in the dynamic fields of a template"""
+        if self.hot_reload:
+            self._maybe_reload(name)
+        return self._templates[name].format(**values)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+
+# Call types that try the fast model first and escalate to the main model on failure
+CASCADED_CALL_TYPES = ("description", "fix", "critique", "compress")
+
+
+class ModelRouter:
+    """Per-call-type model selection with escalation from a cheap, fast model to the main model"""
+
+    def __init__(self, main_model, fast_model=None, routes=None):
+        """
+        Args:
+            main_model (str): The agent's main model
+            fast_model (str): Cheap model tried first for cascaded call types (None disables the cascade)
+            routes (dict): Optional call type -> list of models, tried in order, overriding the defaults
+        """
+        self.main_model = main_model
+        self.routes = {}
+        if fast_model and fast_model != main_model:
+            for call_type in CASCADED_CALL_TYPES:
+                self.routes[call_type] = [fast_model, main_model]
+        self.routes.update(routes or {})
+        self.stats = OrderedDict()
+
+    def model_for(self, call_type, tier=0):
+        """Model to use for `call_type` after `tier` escalations"""
+        models = self.routes.get(call_type, [self.main_model])
+        return models[min(tier, len(models) - 1)]
+
+    def num_tiers(self, call_type):
+        return len(self.routes.get(call_type, [self.main_model]))
+
+    def record(self, call_type, tier, success):
+        """
+        Record the outcome of a routed call
+
+        Args:
+            call_type (str): Kind of call
+            tier (int): Escalation level the call was made at
+            success (bool): Whether the result was accepted (e.g. the fixed code ran)
+        """
+        stats = self.stats.setdefault(call_type, {"calls": 0, "hits": 0, "escalations": 0, "failures": 0})
+        stats["calls"] += 1
+        if success and tier == 0:
+            stats["hits"] += 1
+        if not success:
+            if tier + 1 < self.num_tiers(call_type):
+                stats["escalations"] += 1
+            else:
+                stats["failures"] += 1
+
+    def call(self, call_type, request, accept=None):
+        """
+        Run `request(model)` along the call type's route, escalating when it raises or its result is rejected
+
+        Args:
+            call_type (str): Kind of call
+            request (callable): Performs the call with the given model and returns its result
+            accept (callable): Returns whether a result is acceptable (defaults to non-empty)
+        """
+        accept = accept or bool
+        for tier in range(self.num_tiers(call_type)):
+            model = self.model_for(call_type, tier)
+            last_tier = tier + 1 == self.num_tiers(call_type)
+            try:
+                result = request(model)
+            except Exception as e:
+                self.record(call_type, tier, False)
+                if last_tier:
+                    raise
+                print(f"⚠️ {call_type} call with {model} failed ({e}); escalating")
+                continue
+            if accept(result) or last_tier:
+                self.record(call_type, tier, accept(result))
+                return result
+            self.record(call_type, tier, False)
+            print(f"⚠️ {call_type} result from {model} rejected; escalating")
+
+    def summary_table(self):
+        """Format per-route hit and escalation statistics as a plain-text table"""
+        header = f"{'route':<14}{'models':<32}{'calls':>7}{'hits':>7}{'escalated':>11}{'failed':>8}"
+        lines = [header, "-" * len(header)]
+        for call_type, stats in self.stats.items():
+            models = " -> ".join(self.routes.get(call_type, [self.main_model]))
+            lines.append(f"{call_type:<14}{models:<32}{stats['calls']:>7}{stats['hits']:>7}"
+                         f"{stats['escalations']:>11}{stats['failures']:>8}")
+        return "\n".join(lines)
@@ -1,9 +1,5 @@
 import os
-import json
 import argparse
-import openai
-from agent import AnalysisAgent
-from notebook_generator import generate_notebook
 
 
 def main():
@@ -27,6 +23,11 @@ def main():
                        default="o3-mini",
                        help="OpenAI model name to use (default: o3-mini)")
     
+    parser.add_argument("--fast-model-name", 
+                       default="gpt-4o-mini",
+                       help="Fast model tried first for code descriptions, fixes and critiques; "
+                            "pass an empty string to always use --model-name (default: gpt-4o-mini)")
+    
     parser.add_argument("--num-analyses", 
                        type=int, 
                        default=8,
@@ -42,6 +43,11 @@ def main():
                        default=3,
                        help="Maximum fix attempts per step (default: 3)")
     
+    parser.add_argument("--notebook-context-tokens", 
+                       type=int, 
+                       default=6000,
+                       help="Token budget for the notebook digest included in prompts (default: 6000)")
+    
     parser.add_argument("--output-home", 
                        default=".",
                        help="Home directory for outputs (default: current directory)")
@@ -63,14 +69,99 @@ def main():
                        action="store_true",
                        help="Disable Vision Language Model functionality")
     
+    parser.add_argument("--vlm-max-image-side", 
+                       type=int, 
+                       default=1024,
+                       help="Maximum width/height in pixels of figures sent to the VLM (default: 1024)")
+    
+    parser.add_argument("--vlm-max-image-bytes", 
+                       type=int, 
+                       default=400_000,
+                       help="Target maximum encoded size of figures sent to the VLM (default: 400000)")
+    
     parser.add_argument("--no-documentation", 
                        action="store_true",
                        help="Disable documentation functionality")
     
+    parser.add_argument("--speculative-fixes", 
+                       type=int, 
+                       default=1,
+                       help="Candidate fixes requested per fix round and tested in parallel in forked kernels; "
+                            "each candidate counts as a fix attempt (default: 1, sequential fixing)")
+    
+    parser.add_argument("--no-kernel-checkpoints", 
+                       action="store_true",
+                       help="Do not checkpoint the kernel before each step and roll back to it before fix attempts")
+    
+    parser.add_argument("--checkpoint-max-bytes", 
+                       type=int, 
+                       default=200_000_000,
+                       help="Largest variable copied by kernel checkpoints (only variables the step may modify in place "
+                            "are copied); larger ones can only be rebound (default: 2e8)")
+    
+    parser.add_argument("--cpu-cores", 
+                       type=int, 
+                       default=None,
+                       help="Cores shared by all concurrently running kernels on this machine (default: all available)")
+    
+    parser.add_argument("--kernel-connection-file", 
+                       action="append",
+                       default=[],
+                       help="Connection file of a kernel running on another host; repeat for several hosts. "
+                            "Each analysis runs on the one with the most free memory. The h5ad path must be "
+                            "valid on those hosts (default: start kernels locally)")
+    
+    parser.add_argument("--no-fix-memory", 
+                       action="store_true",
+                       help="Do not reuse or store fixes of recurring errors (stored under $CELLVOYAGER_CACHE_DIR)")
+    
+    parser.add_argument("--no-deepresearch", 
+                       action="store_true",
+                       help="Do not research a biological background for idea generation with DeepResearch")
+    
+    parser.add_argument("--deepresearch-timeout", 
+                       type=float, 
+                       default=1800,
+                       help="Seconds before the DeepResearch request is abandoned (default: 1800)")
+    
+    parser.add_argument("--deepresearch-wait", 
+                       type=float, 
+                       default=0,
+                       help="Seconds the first analysis waits for a DeepResearch background that is not cached yet; "
+                            "later analyses use it once it is ready (default: 0)")
+    
     parser.add_argument("--log-prompts", 
                        action="store_true",
                        help="Enable prompt logging")
     
+    parser.add_argument("--stream", 
+                       action="store_true",
+                       help="Stream LLM responses and start documentation lookups as soon as the code arrives")
+    
+    parser.add_argument("--hot-reload-prompts", 
+                       action="store_true",
+                       help="Re-read prompt templates when they change on disk (for prompt engineering)")
+    
+    parser.add_argument("--trace", 
+                       action="store_true",
+                       help="Trace where each analysis spends its time; writes trace.json (chrome://tracing, Perfetto) "
+                            "and trace.folded (flamegraphs) to the output directory and prints the top time sinks")
+    
+    parser.add_argument("--metrics-port", 
+                       type=int,
+                       default=None,
+                       help="Serve Prometheus metrics (LLM latency and tokens, cell execution times, fix attempts, "
+                            "timeouts, kernel restarts, cache hits, notebook sizes) at http://127.0.0.1:PORT/metrics")
+    
+    parser.add_argument("--metrics-textfile", 
+                       default=None,
+                       help="Write the Prometheus metrics to this file (e.g. for node_exporter's textfile collector)")
+    
+    parser.add_argument("--metrics-interval", 
+                       type=float,
+                       default=15,
+                       help="Seconds between rewrites of --metrics-textfile (default: 15)")
+    
     args = parser.parse_args()
     
     # Check if OpenAI API key is available
@@ -101,6 +192,10 @@ def main():
     print(f"   Documentation: {'❌' if args.no_documentation else '✅'}")
     print()
     
+    # Imported only after validation so that --help and argument errors return immediately
+    from agent import AnalysisAgent
+    from kernel_providers import ConnectionFileKernelProvider
+
     # Initialize the agent
     agent = AnalysisAgent(
         h5ad_path=args.h5ad_path,
@@ -117,7 +212,26 @@ def main():
         use_VLM=not args.no_vlm,
         use_documentation=not args.no_documentation,
         log_prompts=args.log_prompts,
-        max_fix_attempts=args.max_fix_attempts
+        max_fix_attempts=args.max_fix_attempts,
+        notebook_context_tokens=args.notebook_context_tokens,
+        hot_reload_prompts=args.hot_reload_prompts,
+        vlm_max_image_side=args.vlm_max_image_side,
+        vlm_max_image_bytes=args.vlm_max_image_bytes,
+        stream_responses=args.stream,
+        fast_model_name=args.fast_model_name or None,
+        use_fix_memory=not args.no_fix_memory,
+        speculative_fixes=args.speculative_fixes,
+        kernel_checkpoints=not args.no_kernel_checkpoints,
+        checkpoint_max_bytes=args.checkpoint_max_bytes,
+        cpu_cores=args.cpu_cores,
+        kernel_providers=[ConnectionFileKernelProvider(path) for path in args.kernel_connection_file] or None,
+        use_deepresearch_background=not args.no_deepresearch,
+        deepresearch_timeout=args.deepresearch_timeout,
+        deepresearch_wait=args.deepresearch_wait,
+        trace=args.trace,
+        metrics_port=args.metrics_port,
+        metrics_textfile=args.metrics_textfile,
+        metrics_interval=args.metrics_interval
     )
     
     try:
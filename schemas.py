@@ -0,0 +1,292 @@
+"""JSON schemas for structured LLM responses, with local repair and validation.
+
+Responses are requested with strict structured outputs when the model supports them. Whatever
+comes back is repaired and validated locally, so a malformed or incomplete response is fixed
+without another round trip to the API.
+"""
+import json
+import re
+
+
+def _strict_object(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+ANALYSIS_PLAN_SCHEMA = _strict_object({
+    "hypothesis": {"type": "string"},
+    "analysis_plan": {"type": "array", "items": {"type": "string"}, "minItems": 1},
+    "first_step_code": {"type": "string"},
+    "code_description": {"type": "string"},
+    "summary": {"type": "string"},
+})
+
+# Next steps share the plan layout; the plan starts at the step about to be executed
+NEXT_STEP_SCHEMA = ANALYSIS_PLAN_SCHEMA
+
+JUDGE_VERDICT_SCHEMA = _strict_object({
+    "match": {"type": "boolean"},
+    "reason": {"type": "string"},
+})
+
+SCHEMAS = {
+    "analysis_plan": ANALYSIS_PLAN_SCHEMA,
+    "next_step": NEXT_STEP_SCHEMA,
+    "judge_verdict": JUDGE_VERDICT_SCHEMA,
+}
+
+
+# Fields holding code that is executed: a response cut off inside one is rejected, not repaired
+CODE_FIELDS = ("first_step_code",)
+
+# Keywords checked locally only; strict structured outputs reject them
+_LOCAL_KEYWORDS = ("minItems",)
+
+
+def _first_line(text):
+    return next((line.strip() for line in text.splitlines() if line.strip()), "")
+
+
+# Values used when a required field is missing from an otherwise usable response
+DEFAULTS = {
+    "analysis_plan": {
+        "code_description": lambda obj: _first_line(obj["analysis_plan"][0]) if obj.get("analysis_plan") else "Next analysis step",
+        "summary": lambda obj: obj.get("hypothesis", ""),
+    },
+    "next_step": {
+        "code_description": lambda obj: _first_line(obj["analysis_plan"][0]) if obj.get("analysis_plan") else "Next analysis step",
+        "summary": lambda obj: obj.get("hypothesis", ""),
+    },
+}
+
+# Models that accept response_format={"type": "json_schema", "strict": True}
+_STRUCTURED_OUTPUT_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+_STRUCTURED_OUTPUT_EXCLUDED = ("gpt-4o-2024-05-13", "o1-mini", "o1-preview")
+
+
+class StructuredOutputError(ValueError):
+    """Raised when a response cannot be repaired into a valid object"""
+
+
+def supports_structured_outputs(model_name):
+    return model_name.startswith(_STRUCTURED_OUTPUT_PREFIXES) and not model_name.startswith(_STRUCTURED_OUTPUT_EXCLUDED)
+
+
+def _strict_schema(schema):
+    """`schema` without the keywords only validated locally"""
+    if isinstance(schema, dict):
+        return {key: _strict_schema(value) for key, value in schema.items() if key not in _LOCAL_KEYWORDS}
+    if isinstance(schema, list):
+        return [_strict_schema(value) for value in schema]
+    return schema
+
+
+def response_format(schema_name, model_name):
+    """Strict JSON-schema response format where supported, plain JSON mode otherwise"""
+    if supports_structured_outputs(model_name):
+        return {"type": "json_schema",
+                "json_schema": {"name": schema_name, "schema": _strict_schema(SCHEMAS[schema_name]), "strict": True}}
+    return {"type": "json_object"}
+
+
+def repair_json(text):
+    """
+    Fix common defects of LLM-generated JSON: code fences and surrounding prose, raw control
+    characters inside strings, trailing commas, missing commas between values and truncation
+    """
+    return _repair(text)[0]
+
+
+def _repair(text):
+    """repair_json, also returning the key whose string value was cut off and had to be closed (or None)"""
+    text = text.strip()
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+    start = min((i for i in (text.find("{"), text.find("[")) if i != -1), default=-1)
+    if start == -1:
+        return text, None
+    text = text[start:]
+
+    repaired = []
+    stack = []
+    in_string = escape = False
+    last_significant = ""  # last non-whitespace character outside strings, or '"' after a string
+    string_start = 0
+    last_string = key = value_key = None  # key: the last string followed by ':'; value_key: key of the open string
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+                last_significant = '"'
+                last_string = "".join(repaired[string_start:])
+            elif char == "\n":
+                char = "\\n"
+            elif char == "\t":
+                char = "\\t"
+            elif ord(char) < 0x20:
+                continue
+            repaired.append(char)
+            continue
+
+        if char == '"':
+            # A value directly following another value is missing its comma
+            value_key = key if last_significant == ":" else None
+            if stack and (last_significant in ('"', "}", "]") or last_significant.isalnum()):
+                repaired.append(",")
+            in_string = True
+            string_start = len(repaired) + 1
+        elif char == ":":
+            key = last_string
+        elif char in "{[":
+            if last_significant in ('"', "}", "]") and stack:
+                repaired.append(",")
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            # Drop a trailing comma before the closing bracket
+            while repaired and repaired[-1].isspace():
+                repaired.pop()
+            if repaired and repaired[-1] == ",":
+                repaired.pop()
+            if stack:
+                stack.pop()
+            repaired.append(char)
+            last_significant = char
+            if not stack:
+                break
+            continue
+
+        repaired.append(char)
+        if not char.isspace() and char != '"':
+            last_significant = char
+
+    # Close a truncated response
+    truncated_key = None
+    if in_string:
+        repaired.append('"')
+        truncated_key = value_key
+    while repaired and repaired[-1].isspace():
+        repaired.pop()
+    if repaired and repaired[-1] in ",:":
+        repaired.pop()
+    repaired.extend(reversed(stack))
+    return "".join(repaired), truncated_key
+
+
+def salvage_fields(text, schema):
+    """
+    Extract the schema's top-level fields one by one from text that does not parse as a whole
+
+    A value must be followed by ',' or '}': a string ending early (e.g. at an unescaped quote in
+    code) is skipped rather than salvaged with its tail cut off.
+    """
+    decoder = json.JSONDecoder()
+    obj = {}
+    for key in schema.get("properties", {}):
+        match = re.search(r'"%s"\s*:\s*' % re.escape(key), text)
+        if not match:
+            continue
+        try:
+            value, end = decoder.raw_decode(text, match.end())
+        except json.JSONDecodeError:
+            continue
+        if text[end:].lstrip()[:1] in (",", "}"):
+            obj[key] = value
+    return obj
+
+
+def _coerce(value, schema):
+    expected = schema.get("type")
+    if expected == "array" and isinstance(value, str):
+        items = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip() for line in value.splitlines()]
+        return [item for item in items if item] or [value]
+    if expected == "array" and isinstance(value, list) and "items" in schema:
+        return [_coerce(item, schema["items"]) for item in value]
+    if expected == "string" and isinstance(value, list):
+        return "\n".join(str(item) for item in value)
+    if expected == "string" and isinstance(value, (int, float, bool)):
+        return str(value)
+    if expected == "boolean" and isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return value.strip().lower() == "true"
+    return value
+
+
+_TYPES = {"object": dict, "array": list, "string": str, "boolean": bool, "number": (int, float), "integer": int}
+
+
+def validate(obj, schema, path="$"):
+    """Return a list of validation errors (subset of JSON schema: type, required, properties, items, minItems)"""
+    errors = []
+    expected = schema.get("type")
+    if expected and not isinstance(obj, _TYPES[expected]):
+        return [f"{path}: expected {expected}, got {type(obj).__name__}"]
+    if expected == "object":
+        for key in schema.get("required", []):
+            if key not in obj:
+                errors.append(f"{path}: missing required field '{key}'")
+        for key, subschema in schema.get("properties", {}).items():
+            if key in obj:
+                errors.extend(validate(obj[key], subschema, f"{path}.{key}"))
+    elif expected == "array":
+        if len(obj) < schema.get("minItems", 0):
+            errors.append(f"{path}: expected at least {schema['minItems']} items, got {len(obj)}")
+        for i, item in enumerate(obj if "items" in schema else ()):
+            errors.extend(validate(item, schema["items"], f"{path}[{i}]"))
+    return errors
+
+
+def parse_structured(text, schema_name=None):
+    """
+    Parse an LLM response into a validated object, repairing it locally if needed
+
+    Args:
+        text (str): Raw response content
+        schema_name (str): Key into SCHEMAS; if None the JSON is only repaired, not validated
+
+    Returns:
+        The parsed object
+
+    Raises:
+        StructuredOutputError: If the response cannot be repaired into a valid object
+    """
+    if text is None:
+        raise StructuredOutputError("empty response")
+    try:
+        obj = json.loads(text)
+    except json.JSONDecodeError:
+        repaired, truncated_key = _repair(text)
+        if schema_name is not None and truncated_key in CODE_FIELDS:
+            raise StructuredOutputError(f"response cut off inside '{truncated_key}'")
+        try:
+            obj = json.loads(repaired)
+        except json.JSONDecodeError as e:
+            if schema_name is None:
+                raise StructuredOutputError(f"unrepairable JSON: {e}")
+            obj = salvage_fields(text, SCHEMAS[schema_name])
+            if not obj:
+                raise StructuredOutputError(f"unrepairable JSON: {e}")
+
+    if schema_name is None:
+        return obj
+
+    schema = SCHEMAS[schema_name]
+    if isinstance(obj, list) and len(obj) == 1 and isinstance(obj[0], dict):
+        obj = obj[0]
+    if isinstance(obj, dict):
+        for key, subschema in schema.get("properties", {}).items():
+            if key in obj:
+                obj[key] = _coerce(obj[key], subschema)
+        for key, default in DEFAULTS.get(schema_name, {}).items():
+            if key not in obj:
+                obj[key] = default(obj)
+
+    errors = validate(obj, schema)
+    if errors:
+        raise StructuredOutputError("; ".join(errors))
+    return obj
@@ -0,0 +1,132 @@
+"""Speculative execution of candidate fixes in forked copies of the kernel.
+
+The helper below is defined inside the persistent kernel. It forks one child process per
+candidate; each child inherits the kernel's namespace copy-on-write, runs its candidate with
+output suppressed and reports success or the error through a pipe. The first candidate to
+succeed wins and the remaining children are killed. The kernel itself is left untouched, so
+the agent re-runs the winning candidate as a regular cell to record its outputs.
+
+The kernel is multithreaded (OpenMP, BLAS, numba and torch pools), and a forked child only
+inherits the thread that forked it. Each child therefore limits native thread pools to one
+thread before running its candidate. Each candidate gets an outcome: "ok", "error" (it ran and
+raised), or "died", "timeout" or "discarded" when the child did not report a result. Only
+"error" means the fix itself is wrong.
+
+A child may end up copying every page of the kernel it writes to (e.g. a large AnnData it
+modifies), so only as many children run at once as fit in the host's available memory at the
+kernel's resident size each; the others are started as earlier ones finish. If not even one
+fits, nothing is forked and the kernel is left to run the candidates itself.
+"""
+
+KERNEL_HELPER = r'''
+def _cv_try_candidates(candidates, timeout):
+    import json, os, select, signal, sys, time
+    if not hasattr(os, "fork"):
+        return json.dumps({"supported": False, "reason": "os.fork is not available"})
+
+    def memory_kb(path, field):
+        try:
+            with open(path) as f:
+                return next((int(line.split()[1]) for line in f if line.startswith(field)), None)
+        except OSError:
+            return None
+
+    # Children may each duplicate up to the kernel's resident memory: cap how many run at once
+    rss, available = memory_kb("/proc/self/status", "VmRSS:"), memory_kb("/proc/meminfo", "MemAvailable:")
+    parallel = len(candidates)
+    if rss and available is not None:
+        parallel = min(parallel, int(available * 0.8) // rss)
+        if parallel < 1:
+            return json.dumps({"supported": False, "reason": "not enough free memory to fork a %d MB kernel "
+                               "(%d MB available)" % (rss // 1024, available // 1024)})
+
+    def fork(index, code):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = {"outcome": "ok", "error": None}
+            try:
+                # Children must not talk to the frontend: silence output and figure publishing
+                sys.stdout = sys.stderr = open(os.devnull, "w")
+                # The parent's native thread pools are not usable in the child: run single-threaded
+                for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMBA_NUM_THREADS"):
+                    os.environ[variable] = "1"
+                try:
+                    from threadpoolctl import threadpool_limits
+                    threadpool_limits(limits=1)
+                except Exception:
+                    pass
+                if "numba" in sys.modules:
+                    try:
+                        sys.modules["numba"].set_num_threads(1)
+                    except Exception:
+                        pass
+                if "torch" in sys.modules:
+                    try:
+                        sys.modules["torch"].set_num_threads(1)
+                    except Exception:
+                        pass
+                try:
+                    import matplotlib
+                    matplotlib.use("Agg", force=True)
+                except Exception:
+                    pass
+                try:
+                    get_ipython().display_pub.publish = lambda *args, **kwargs: None
+                except Exception:
+                    pass
+                exec(compile(code, "<candidate %d>" % index, "exec"), globals())
+            except BaseException as e:
+                status = {"outcome": "error", "error": ("%s: %s" % (type(e).__name__, e))[:2000]}
+            finally:
+                os.write(write_fd, json.dumps(status).encode("utf-8"))
+                os._exit(0)
+        os.close(write_fd)
+        children[read_fd] = (pid, index)
+
+    children = {}  # read end of the result pipe -> (pid, candidate index)
+    pending = list(enumerate(candidates))
+    outcomes, errors, winner = [None] * len(candidates), [None] * len(candidates), None
+    deadline = time.time() + timeout
+    while (children or pending) and winner is None and time.time() < deadline:
+        while pending and len(children) < parallel:
+            fork(*pending.pop(0))
+        ready, _, _ = select.select(list(children), [], [], max(0.0, deadline - time.time()))
+        for fd in ready:
+            data = b""
+            chunk = os.read(fd, 65536)
+            while chunk:
+                data += chunk
+                chunk = os.read(fd, 65536)
+            os.close(fd)
+            pid, index = children.pop(fd)
+            os.waitpid(pid, 0)
+            try:
+                status = json.loads(data.decode("utf-8"))
+            except ValueError:
+                status = {"outcome": "died", "error": "Candidate process died without reporting a result"}
+            outcomes[index], errors[index] = status["outcome"], status["error"]
+            if status["outcome"] == "ok" and winner is None:
+                winner = index
+
+    # Discard the remaining candidates
+    for fd, (pid, index) in children.items():
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        os.close(fd)
+    for index, outcome in enumerate(outcomes):
+        if outcome is None:
+            outcomes[index] = "timeout" if winner is None else "discarded"
+            errors[index] = "Candidate did not finish" if winner is None else "Candidate discarded"
+    return json.dumps({"supported": True, "parallel": parallel, "winner": winner, "outcomes": outcomes,
+                       "errors": errors})
+'''
+
+
+def candidates_expression(candidates, timeout):
+    """Kernel expression that tests `candidates` in forked kernels and returns the JSON result"""
+    return f"_cv_try_candidates({list(candidates)!r}, {float(timeout)!r})"
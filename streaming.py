@@ -0,0 +1,137 @@
+import json
+import sys
+from types import SimpleNamespace
+
+
+class IncrementalJSONParser:
+    """Incremental parser that reports top-level fields of a JSON object as soon as they close.
+
+    Text is fed in arbitrary chunks (e.g. streamed tokens); `feed` returns the (key, value)
+    pairs of the top-level fields completed by that chunk. Nested values are returned once
+    the whole container has been received.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._state = "key"  # key -> colon -> value -> after (top-level object only)
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+        self._value_kind = None  # "string", "container" or "scalar"
+
+    def feed(self, chunk):
+        """Consume a chunk of text and return the list of newly completed (key, value) pairs"""
+        self.text += chunk
+        completed = []
+        text = self.text
+        while self._pos < len(text):
+            char = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        if self._state == "key":
+                            self._key = json.loads(text[self._key_start:self._pos + 1])
+                            self._state = "colon"
+                        elif self._state == "value" and self._value_kind == "string":
+                            self._complete(text[self._value_start:self._pos + 1], completed)
+            elif char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._state == "key":
+                    self._key_start = self._pos
+                elif self._depth == 1 and self._state == "value" and self._value_start is None:
+                    self._value_start, self._value_kind = self._pos, "string"
+            elif char in "{[":
+                if self._depth == 1 and self._state == "value" and self._value_start is None:
+                    self._value_start, self._value_kind = self._pos, "container"
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 1 and self._state == "value" and self._value_kind == "scalar":
+                    self._complete(text[self._value_start:self._pos], completed)
+                self._depth -= 1
+                if self._depth == 1 and self._state == "value" and self._value_kind == "container":
+                    self._complete(text[self._value_start:self._pos + 1], completed)
+            elif self._depth == 1:
+                if char == ":" and self._state == "colon":
+                    self._state = "value"
+                    self._value_start = None
+                elif char == ",":
+                    if self._state == "value" and self._value_kind == "scalar":
+                        self._complete(text[self._value_start:self._pos], completed)
+                    self._state = "key"
+                elif not char.isspace() and self._state == "value" and self._value_start is None:
+                    self._value_start, self._value_kind = self._pos, "scalar"
+            self._pos += 1
+        return completed
+
+    def _complete(self, raw_value, completed):
+        try:
+            value = json.loads(raw_value)
+        except json.JSONDecodeError:
+            value = raw_value.strip()
+        self.fields[self._key] = value
+        completed.append((self._key, value))
+        self._state = "after"
+        self._value_start = None
+        self._value_kind = None
+
+
+def collect_stream(stream, parse_json=False, on_field=None, label="response"):
+    """
+    Consume a streamed chat completion, showing progress on the console
+
+    Args:
+        stream: Iterator of chat completion chunks
+        parse_json (bool): Parse the content incrementally as a JSON object
+        on_field (callable): Called with (key, value) as soon as a top-level JSON field closes
+        label (str): Name shown in the progress line
+
+    Returns:
+        SimpleNamespace mirroring the non-streamed response (choices[0].message.content/refusal, usage)
+    """
+    parser = IncrementalJSONParser() if parse_json else None
+    content, refusal, usage = [], [], None
+    received = 0
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if getattr(delta, "refusal", None):
+            refusal.append(delta.refusal)
+        text = getattr(delta, "content", None)
+        if not text:
+            continue
+        content.append(text)
+        received += len(text)
+        sys.stdout.write(f"\r  ⏳ {label}: {received} chars received")
+        sys.stdout.flush()
+        if parser is not None:
+            try:
+                completed = parser.feed(text)
+            except Exception:
+                # Early field callbacks are an optimization; the full content is still parsed afterwards
+                parser, completed = None, []
+            for key, value in completed:
+                sys.stdout.write(f"\r  ✓ {label}: '{key}' received{' ' * 20}\n")
+                if on_field is not None:
+                    try:
+                        on_field(key, value)
+                    except Exception as e:
+                        print(f"⚠️ Warning: Streaming callback for '{key}' failed: {e}")
+    if received:
+        sys.stdout.write("\n")
+
+    message = SimpleNamespace(content="".join(content) if content else None,
+                              refusal="".join(refusal) if refusal else None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
@@ -0,0 +1,170 @@
+"""Phase-level tracing of agent runs.
+
+Spans nest as run → analysis → step → phase (LLM calls per call type, kernel execution, fix
+loops, documentation lookups, notebook writes). A finished trace can be exported as Chrome
+trace JSON (chrome://tracing, Perfetto), as folded stacks for flamegraph tools (flamegraph.pl,
+speedscope), and as a text summary of the top time sinks per analysis.
+
+Tracing is off unless requested: NULL_TRACER has the same interface and does nothing, so
+instrumented code costs one method call per span when disabled.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Span categories that contain other spans; the time they do not spend in children is reported as "(other)"
+CONTAINER_CATEGORIES = ("run", "analysis", "step")
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTracer:
+    """Disabled tracer: every operation is a no-op"""
+
+    enabled = False
+    context = {}
+
+    def span(self, name, category="phase", **args):
+        return _NULL_SPAN
+
+    def begin(self, name, category="phase", **args):
+        return None
+
+    def end(self, span):
+        pass
+
+    def set_context(self, **ids):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "category", "args", "start", "end", "child_time", "thread", "stack", "open")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.end(self)
+        return False
+
+
+class Tracer:
+    """Records nested, timed spans per thread"""
+
+    enabled = True
+
+    def __init__(self):
+        self.spans = []  # finished spans
+        self.context = {}  # ids (e.g. analysis) attached to every span
+        self._origin = time.perf_counter_ns()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread_names = {}
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+            with self._lock:
+                self._thread_names[threading.get_ident()] = threading.current_thread().name
+        return stack
+
+    def set_context(self, **ids):
+        """Set ids recorded with all later spans (e.g. analysis=2); None removes an id"""
+        for key, value in ids.items():
+            if value is None:
+                self.context.pop(key, None)
+            else:
+                self.context[key] = value
+
+    def begin(self, name, category="phase", **args):
+        """Open a span on this thread; close it with end()"""
+        stack = self._stack()
+        span = _Span()
+        span.tracer, span.name, span.category = self, name, category
+        span.args = {**self.context, **args}
+        span.thread = threading.get_ident()
+        span.stack = tuple(parent.name for parent in stack) + (name,)
+        span.child_time, span.open = 0, True
+        stack.append(span)
+        span.start = time.perf_counter_ns()
+        return span
+
+    def end(self, span):
+        """Close a span, and any spans opened after it on the same thread that are still open"""
+        if span is None or not span.open:
+            return
+        now = time.perf_counter_ns()
+        stack = self._stack()
+        while stack:
+            top = stack.pop()
+            top.end, top.open = now, False
+            if stack:
+                stack[-1].child_time += top.end - top.start
+            with self._lock:
+                self.spans.append(top)
+            if top is span:
+                break
+
+    def span(self, name, category="phase", **args):
+        """Context manager timing a block"""
+        return self.begin(name, category, **args)
+
+    def export_chrome(self, path):
+        """Write the trace in the Chrome trace event format (complete "X" events, microseconds)"""
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": name}}
+                  for thread, name in self._thread_names.items()]
+        for span in sorted(self.spans, key=lambda span: span.start):
+            events.append({"name": span.name, "cat": span.category, "ph": "X", "pid": pid, "tid": span.thread,
+                           "ts": (span.start - self._origin) / 1000, "dur": (span.end - span.start) / 1000,
+                           "args": span.args})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def export_folded(self, path):
+        """Write folded stacks ("run;analysis 1;step 2;llm:fix <self µs>") for flamegraph tools"""
+        totals = defaultdict(int)
+        for span in self.spans:
+            totals[";".join(span.stack)] += (span.end - span.start - span.child_time) // 1000
+        with open(path, "w") as f:
+            for stack, micros in sorted(totals.items()):
+                f.write(f"{stack} {micros}\n")
+
+    def summary(self, top=8):
+        """Top time sinks (self time of each phase) per analysis, as plain text"""
+        main_thread = threading.main_thread().ident
+        per_analysis = defaultdict(lambda: defaultdict(lambda: [0, 0]))  # analysis -> label -> [ns, count]
+        for span in self.spans:
+            label = span.name if span.category not in CONTAINER_CATEGORIES else f"{span.category} (other)"
+            if span.thread != main_thread:
+                label += " [background]"
+            entry = per_analysis[span.args.get("analysis", "-")][label]
+            entry[0] += span.end - span.start - span.child_time
+            entry[1] += 1
+
+        lines = []
+        for analysis in sorted(per_analysis, key=str):
+            sinks = per_analysis[analysis]
+            # Background spans overlap the main thread, so only main-thread time adds up to wall time
+            wall = sum(ns for label, (ns, _) in sinks.items() if not label.endswith("[background]"))
+            heading = f"Analysis {analysis}" if analysis != "-" else "Outside analyses (setup, run overhead)"
+            lines.append(f"{heading}: {wall / 1e9:.1f} s")
+            for label, (ns, count) in sorted(sinks.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+                share = f"{ns / wall:6.1%}" if wall and not label.endswith("[background]") else "     -"
+                lines.append(f"  {ns / 1e9:8.1f} s {share}  {label} ({count}x)")
+        return "\n".join(lines)
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to a character-based estimate
+    tiktoken = None
+
+FALLBACK_ENCODING = "o200k_base"
+_encodings = {}
+
+
+def _get_encoding(model_name):
+    if tiktoken is None:
+        return None
+    key = model_name or FALLBACK_ENCODING
+    if key not in _encodings:
+        try:
+            _encodings[key] = tiktoken.encoding_for_model(model_name) if model_name else tiktoken.get_encoding(FALLBACK_ENCODING)
+        except Exception:
+            # Unknown model names (e.g. new reasoning models) use the latest encoding
+            _encodings[key] = tiktoken.get_encoding(FALLBACK_ENCODING)
+    return _encodings[key]
+
+
+def count_tokens(text, model_name=None):
+    """Count the tokens of `text` with the model's tokenizer, or estimate them if tiktoken is unavailable"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model_name=None):
+    """Count the text tokens of a list of chat messages (image parts are not counted)"""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            total += count_tokens(content, model_name)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += count_tokens(part.get("text", ""), model_name)
+    return total
+
+
+class UsageTracker:
+    """Accumulates token usage and latency of LLM calls, grouped by call type"""
+
+    def __init__(self):
+        self.calls = OrderedDict()
+
+    def record(self, call_type, prompt_tokens, latency, usage=None):
+        """
+        Record a single LLM call
+
+        Args:
+            call_type (str): Kind of call, e.g. "initial", "next_step", "critique", "fix"
+            prompt_tokens (int): Locally counted prompt tokens
+            latency (float): Wall-clock duration of the call in seconds
+            usage: Usage object returned by the API (chat completions or responses), if any
+        """
+        stats = self.calls.setdefault(call_type, {
+            "calls": 0, "prompt_tokens": 0, "api_input_tokens": 0,
+            "api_output_tokens": 0, "api_cached_tokens": 0, "latency": 0.0, "max_latency": 0.0,
+        })
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        if usage is not None:
+            # Chat completions report prompt/completion tokens, the responses API input/output tokens
+            stats["api_input_tokens"] += getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", 0) or 0
+            stats["api_output_tokens"] += getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", 0) or 0
+            # Prompt tokens served from the provider's prefix cache
+            details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+            stats["api_cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+    def cached_share(self):
+        """Fraction of API input tokens that were served from the provider's prefix cache"""
+        input_tokens = sum(stats["api_input_tokens"] for stats in self.calls.values())
+        cached_tokens = sum(stats["api_cached_tokens"] for stats in self.calls.values())
+        return cached_tokens / input_tokens if input_tokens else 0.0
+
+    def summary_table(self):
+        """Format the per-call-type statistics as a plain-text table"""
+        header = f"{'call type':<14}{'calls':>7}{'prompt tok':>12}{'api in':>12}{'api out':>12}{'cached':>9}{'total s':>10}{'mean s':>9}{'max s':>9}"
+        lines = [header, "-" * len(header)]
+        totals = {"calls": 0, "prompt_tokens": 0, "api_input_tokens": 0, "api_output_tokens": 0, "api_cached_tokens": 0,
+                  "latency": 0.0, "max_latency": 0.0}
+        for call_type, stats in self.calls.items():
+            lines.append(self._format_row(call_type, stats))
+            for key in totals:
+                totals[key] = max(totals[key], stats[key]) if key == "max_latency" else totals[key] + stats[key]
+        lines.append("-" * len(header))
+        lines.append(self._format_row("total", totals))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _format_row(name, stats):
+        mean = stats["latency"] / stats["calls"] if stats["calls"] else 0.0
+        cached = stats["api_cached_tokens"] / stats["api_input_tokens"] if stats["api_input_tokens"] else 0.0
+        return (f"{name:<14}{stats['calls']:>7}{stats['prompt_tokens']:>12}{stats['api_input_tokens']:>12}"
+                f"{stats['api_output_tokens']:>12}{cached:>9.1%}{stats['latency']:>10.1f}{mean:>9.1f}{stats['max_latency']:>9.1f}")
@@ -1,139 +1,57 @@
-import ast
-import inspect
-import importlib
-import sys
-import textwrap
+import os
 
-def extract_call_names(source: str):
-    """
-    Parse `source` and return a sorted, deduplicated list of all
-    function‐call names as dotted strings.
-    """
-    try:
-        tree = ast.parse(source)
-    except (IndentationError, SyntaxError):
-        # Try to fix indentation issues
-        try:
-            fixed_source = textwrap.dedent(source)
-            tree = ast.parse(fixed_source)
-        except (IndentationError, SyntaxError):
-            # If still fails, return empty list
-            return []
-    
-    calls = set()
+from doc_index import DocIndex
+from doc_retrieval import DocRetriever
 
-    def get_full_name(node):
-        # Recursively reconstruct dotted name from ast.Attribute/Name
-        if isinstance(node, ast.Name):
-            return node.id
-        elif isinstance(node, ast.Attribute):
-            parent = get_full_name(node.value)
-            return f"{parent}.{node.attr}"
-        else:
-            return None
 
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Call):
-            fname = get_full_name(node.func)
-            if fname:
-                calls.add(fname)
-    return sorted(calls)
+_doc_retriever = None
 
 
-def resolve_obj(fqname: str, namespace: dict):
+def documentation_index(source=None):
     """
-    Given a dotted name and the exec’d namespace,
-    traverse attributes to return the actual Python object.
+    Documentation index read through `source` (e.g. a doc_index.KernelDocSource), or by introspecting
+    packages in this process if None
     """
-    parts = fqname.split(".")
-    # Try first from the namespace, else import the top module
-    if parts[0] in namespace:
-        obj = namespace[parts[0]]
-    else:
-        obj = importlib.import_module(parts[0])
-    for attr in parts[1:]:
-        obj = getattr(obj, attr)
-    return obj
+    if source is None:
+        return DocIndex(cache_path("doc_index"))
+    return DocIndex(cache_path("doc_index"), introspect=source.introspect, version_of=source.version_of,
+                    describe=source.describe)
+
 
-def load_namespace(source: str, filename="<string>"):
+def get_documentation(code: str, max_characters: int = 10000, error: str = "", token_budget: int = None,
+                      retriever: DocRetriever = None) -> str:
     """
-    Try to exec the full source. If that errors (e.g. due to an undefined call),
-    fall back to only executing the import statements.
+    Documentation of the functions used in `code` that is most relevant to it and to `error`
+
+    Names are resolved from the code's imports without executing it. Docstrings of all allowed
+    packages are ranked against the code, the failing line and the traceback (see
+    doc_retrieval.py), and whole sections are returned within the token budget.
+
+    Args:
+        code (str): Code to document
+        max_characters (int): Size limit used when no token budget is given (about 4 characters per token)
+        error (str): Error message and traceback the code produced, if any
+        token_budget (int): Approximate maximum size of the result in tokens
+        retriever (DocRetriever): Retriever to search, e.g. one per agent reading its own kernel; by
+            default one introspecting packages in this process
     """
-    namespace = {}
-    
-    # First try with original source
-    try:
-        exec(compile(source, filename, 'exec'), namespace)
-        return namespace
-    except (IndentationError, SyntaxError):
-        # Try to fix indentation issues
-        try:
-            fixed_source = textwrap.dedent(source)
-            exec(compile(fixed_source, filename, 'exec'), namespace)
-            return namespace
-        except (IndentationError, SyntaxError):
-            # If still syntax issues, try import-only fallback with original source
-            pass
-    except Exception:
-        # Other execution errors, try import-only fallback
-        pass
-    
-    # Fallback: extract and execute only import statements
-    try:
-        # Try to parse original source first
-        try:
-            tree = ast.parse(source)
-        except (IndentationError, SyntaxError):
-            # Try with dedented source
-            fixed_source = textwrap.dedent(source)
-            tree = ast.parse(fixed_source)
-        
-        imports = [node for node in tree.body 
-                   if isinstance(node, (ast.Import, ast.ImportFrom))]
-        import_mod = ast.Module(body=imports, type_ignores=[])
-        exec(compile(import_mod, filename, 'exec'), namespace)
-    except Exception:
-        # If all fails, return empty namespace
-        pass
-    
-    return namespace
-
-def get_documentation(code: str, max_characters: int = 10000) -> str:
-    try:
-        call_names = extract_call_names(code)
-        ns         = load_namespace(code)
-    except Exception as e:
-        # If extraction completely fails, return empty documentation
-        return f"<documentation extraction failed: {str(e)}>"
-
-    docs = []
-    for name in sorted(set(call_names)):
-        # Only include functions that start with 'sc.' (scanpy) or 'scvi.' (scvi-tools)
-        ###### MODIFY IN NEEDED FOR OTHER PACKAGES ######
-        if not (name.startswith('sc.') or name.startswith('scvi.') or name.startswith('scanpy.')):
-            continue
-            
-        try:
-            fn  = resolve_obj(name, ns)
-            doc = inspect.getdoc(fn) or "<no docstring>"
-        except Exception as e:
-            doc = f"<could not resolve: {e}>"
-        docs.append(f"{name}:\n{doc}")
-    
-    full_docs = "\n\n".join(docs)
-    return full_docs[:max_characters]
+    global _doc_retriever
+    if retriever is None:
+        if _doc_retriever is None:
+            _doc_retriever = DocRetriever(documentation_index())
+        retriever = _doc_retriever
+    if token_budget is None:
+        token_budget = max_characters // 4
+    return retriever.retrieve(code, error=error, token_budget=token_budget)[:max_characters]
 
 
-# --- Usage Example ---
-
-code = """
-import scanpy as sc
-import numpy as np
-from matplotlib import pyplot as plt
-
-X = np.vstack([np.random.random((100, 2)), np.random.random((100, 2))])
-plt.scatter(X[:,0], X[:,1])
-"""
+def cache_path(*parts):
+    """
+    Path inside the persistent cache directory ($CELLVOYAGER_CACHE_DIR, default ~/.cache/cellvoyager),
+    creating its parent directories
+    """
+    root = os.environ.get("CELLVOYAGER_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "cellvoyager")
+    path = os.path.join(root, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
 
-print(len(get_documentation(code)))
\ No newline at end of file